@@ -0,0 +1,183 @@
+import asyncio
+import json
+import logging
+import os
+import struct
+import sys
+from typing import Callable, Dict, List, Optional, Set
+
+# Topic-based pub/sub between worker processes; see cluster.py for what is
+# sent over it. Messages are JSON-serializable dicts. Delivery is
+# asynchronous, at most once, and in publish order per publisher; a
+# publisher that is subscribed to a topic also receives its own messages.
+#
+# InProcessBus connects workers (ConnectionManagers) living in one process,
+# for tests and single-process use. UnixSocketBus connects processes on one
+# host through a BusBroker listening on a Unix socket; run the broker with
+#     python bus.py /run/sheets/bus.sock
+# Frames on the socket are a u32 length followed by a JSON object: {"op":
+# "sub" | "unsub", "topic": ...} from clients, {"op": "pub", "topic": ...,
+# "message": ...} in both directions.
+
+Handler = Callable[[dict], None]
+_LENGTH = struct.Struct("<I")
+
+logger = logging.getLogger(__name__)
+
+
+class InProcessBus:
+    def __init__(self):
+        self.handlers: Dict[str, List[Handler]] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._pump: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._pump = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self) -> None:
+        if self._pump is not None:
+            self._pump.cancel()
+            self._pump = None
+
+    def subscribe(self, topic: str, handler: Handler) -> None:
+        self.handlers.setdefault(topic, []).append(handler)
+
+    def unsubscribe(self, topic: str, handler: Handler) -> None:
+        handlers = self.handlers.get(topic, [])
+        if handler in handlers:
+            handlers.remove(handler)
+        if not handlers:
+            self.handlers.pop(topic, None)
+
+    def publish(self, topic: str, message: dict) -> None:
+        # Serialized like on a real bus, so no state is shared by reference
+        self._queue.put_nowait((topic, json.dumps(message)))
+
+    async def _run(self) -> None:
+        while True:
+            topic, data = await self._queue.get()
+            for handler in list(self.handlers.get(topic, ())):
+                _deliver(handler, json.loads(data))
+
+    async def drain(self) -> None:
+        # Wait until everything published so far has been delivered (tests)
+        while not self._queue.empty():
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+
+def _deliver(handler: Handler, message: dict) -> None:
+    try:
+        handler(message)
+    except Exception:
+        logger.exception("Bus handler failed")
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> dict:
+    length, = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+    return json.loads(await reader.readexactly(length))
+
+
+def _write_frame(writer: asyncio.StreamWriter, frame: dict) -> None:
+    data = json.dumps(frame, separators=(",", ":")).encode()
+    writer.write(_LENGTH.pack(len(data)) + data)
+
+
+class UnixSocketBus:
+    def __init__(self, path: str):
+        self.path = path
+        self.handlers: Dict[str, List[Handler]] = {}
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        reader, self._writer = await asyncio.open_unix_connection(self.path)
+        for topic in self.handlers:
+            _write_frame(self._writer, {"op": "sub", "topic": topic})
+        self._reader_task = asyncio.get_running_loop().create_task(self._run(reader))
+
+    async def close(self) -> None:
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def subscribe(self, topic: str, handler: Handler) -> None:
+        handlers = self.handlers.setdefault(topic, [])
+        handlers.append(handler)
+        if len(handlers) == 1 and self._writer is not None:
+            _write_frame(self._writer, {"op": "sub", "topic": topic})
+
+    def unsubscribe(self, topic: str, handler: Handler) -> None:
+        handlers = self.handlers.get(topic, [])
+        if handler in handlers:
+            handlers.remove(handler)
+        if not handlers and self.handlers.pop(topic, None) is not None and self._writer is not None:
+            _write_frame(self._writer, {"op": "unsub", "topic": topic})
+
+    def publish(self, topic: str, message: dict) -> None:
+        _write_frame(self._writer, {"op": "pub", "topic": topic, "message": message})
+
+    async def _run(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                frame = await _read_frame(reader)
+                for handler in list(self.handlers.get(frame["topic"], ())):
+                    _deliver(handler, frame["message"])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.error("Lost the connection to the bus broker")
+
+
+class BusBroker:
+    # Forwards every published frame to the connections subscribed to its topic
+    def __init__(self, path: str):
+        self.path = path
+        self.subscribers: Dict[str, Set[asyncio.StreamWriter]] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        # A socket file left by a previous broker would make bind fail
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve, self.path)
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        topics: Set[str] = set()
+        try:
+            while True:
+                frame = await _read_frame(reader)
+                op, topic = frame["op"], frame["topic"]
+                if op == "sub":
+                    topics.add(topic)
+                    self.subscribers.setdefault(topic, set()).add(writer)
+                elif op == "unsub":
+                    topics.discard(topic)
+                    self.subscribers.get(topic, set()).discard(writer)
+                elif op == "pub":
+                    for subscriber in list(self.subscribers.get(topic, ())):
+                        _write_frame(subscriber, frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for topic in topics:
+                self.subscribers.get(topic, set()).discard(writer)
+            writer.close()
+
+
+async def _serve_forever(path: str) -> None:
+    broker = BusBroker(path)
+    await broker.start()
+    await broker._server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_serve_forever(sys.argv[1]))
@@ -0,0 +1,112 @@
+import bisect
+import hashlib
+import itertools
+import os
+from typing import Iterable, List, Optional
+from bus import InProcessBus, UnixSocketBus
+
+# Multi-worker mode. Each sheet is owned by one worker, picked by consistent
+# hashing of the sheet id, and only the owner holds the sheet's cells, history,
+# comments and op log. Clients can connect to any worker:
+#   - edits, comments, resync and history requests from clients of another
+#     worker are sent as commands to the owner's topic "worker:<id>"; replies
+#     meant for one client go back to the origin worker's topic
+#   - the owner publishes the resulting cell changes and broadcasts on the
+#     sheet topic "sheet:<id>", which every worker with clients on the sheet
+#     subscribes to and fans out to its own clients (viewport routing and
+#     presence ticks stay local)
+#   - joins, leaves and cursor moves go to the sheet topic too, so every
+#     worker knows all users of the sheet and their cursors
+# REST calls for a sheet must reach its owner; other workers answer 421 with
+# the owner's id in the X-Sheet-Owner header.
+#
+# Configuration (one uvicorn process per worker, each with its own DATA_DIR):
+#   CLUSTER_WORKERS  comma-separated ids of all workers; unset = single worker
+#   WORKER_ID        this worker's id
+#   BUS_SOCKET       Unix socket of the bus broker (python bus.py <path>);
+#                    required with more than one worker, since an
+#                    in-process bus cannot reach the other processes
+
+VNODES = 64
+
+
+def _hash(key: str) -> int:
+    # Stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, nodes: Iterable[str] = (), vnodes: int = VNODES):
+        self.vnodes = vnodes
+        self.points: List[int] = []
+        self.owners: List[str] = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node: str) -> None:
+        for i in range(self.vnodes):
+            point = _hash(f"{node}#{i}")
+            at = bisect.bisect(self.points, point)
+            self.points.insert(at, point)
+            self.owners.insert(at, node)
+
+    def remove(self, node: str) -> None:
+        kept = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != node]
+        self.points = [point for point, _ in kept]
+        self.owners = [owner for _, owner in kept]
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self.points:
+            return None
+        at = bisect.bisect(self.points, _hash(key)) % len(self.points)
+        return self.owners[at]
+
+
+class Cluster:
+    def __init__(self, worker_id: str, workers: Iterable[str], bus, vnodes: int = VNODES):
+        self.worker_id = worker_id
+        self.ring = HashRing(workers, vnodes)
+        self.bus = bus
+        # Ids for this worker's connections, for replies routed back to them
+        self._client_ids = itertools.count(1)
+
+    def owner(self, sheet_id: str) -> str:
+        return self.ring.owner(sheet_id)
+
+    def owns(self, sheet_id: str) -> bool:
+        return self.ring.owner(sheet_id) == self.worker_id
+
+    def next_client_id(self) -> int:
+        return next(self._client_ids)
+
+    @staticmethod
+    def sheet_topic(sheet_id: str) -> str:
+        return f"sheet:{sheet_id}"
+
+    @staticmethod
+    def worker_topic(worker_id: str) -> str:
+        return f"worker:{worker_id}"
+
+    def publish_sheet(self, sheet_id: str, message: dict) -> None:
+        message["sheet"] = sheet_id
+        message["worker"] = self.worker_id
+        self.bus.publish(self.sheet_topic(sheet_id), message)
+
+    def send_to_worker(self, worker_id: str, message: dict) -> None:
+        message["worker"] = self.worker_id
+        self.bus.publish(self.worker_topic(worker_id), message)
+
+
+def cluster_from_env() -> Optional[Cluster]:
+    workers = [worker.strip() for worker in os.environ.get("CLUSTER_WORKERS", "").split(",") if worker.strip()]
+    if not workers:
+        return None
+    worker_id = os.environ.get("WORKER_ID", workers[0])
+    if worker_id not in workers:
+        raise ValueError(f"WORKER_ID {worker_id} is not in CLUSTER_WORKERS")
+    socket_path = os.environ.get("BUS_SOCKET")
+    if not socket_path and len(set(workers)) > 1:
+        # Commands for the other workers' sheets would go nowhere
+        raise ValueError("BUS_SOCKET must be set when CLUSTER_WORKERS lists more than one worker")
+    bus = UnixSocketBus(socket_path) if socket_path else InProcessBus()
+    return Cluster(worker_id, workers, bus)
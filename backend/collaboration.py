@@ -1,5 +1,6 @@
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 from models import Cell
+from oplog import OperationLog
 from spreadsheet import SpreadsheetService
 
 
@@ -7,26 +8,27 @@ class CollaborationService:
     def __init__(self, spreadsheet_service: SpreadsheetService):
         self.spreadsheet_service = spreadsheet_service
         self.cell_versions: Dict[str, Dict[str, int]] = {}
+        self.oplog = OperationLog()
 
-    def apply_edit(self, sheet_id: str, cell_ref: str, value: str, formula: Optional[str], user_id: str) -> Cell:
-        if sheet_id not in self.cell_versions:
-            self.cell_versions[sheet_id] = {}
-        current_version = self.cell_versions[sheet_id].get(cell_ref, 0)
-
-        # Store the user's edit with a unique version for this user
-        sheet = self.spreadsheet_service.get_or_create_sheet(sheet_id)
-        
-        # Create a new cell with an incremented version for each user
-        # This ensures different users get different versions
-        updated_cell = self.spreadsheet_service.set_cell_value(
+    def apply_edit(self, sheet_id: str, cell_ref: str, value: str, formula: Optional[str],
+                   user_id: str) -> Tuple[Cell, List[str]]:
+        # Every edit bumps the cell version; the op log seq gives the global order.
+        # Returns the cell and the refs of the formulas recalculated by the edit.
+        updated_cell, recalculated = self.spreadsheet_service.set_cell(
             sheet_id, cell_ref, value, formula)
-        
-        # Manually increment version to make it unique for each user
-        if user_id not in getattr(updated_cell, '_user_versions', {}):
-            if not hasattr(updated_cell, '_user_versions'):
-                updated_cell._user_versions = {}
-            updated_cell._user_versions[user_id] = updated_cell.version + 1
-            updated_cell.version = updated_cell._user_versions[user_id]
-        
-        self.cell_versions[sheet_id][cell_ref] = updated_cell.version
-        return updated_cell
+        self.cell_versions.setdefault(sheet_id, {})[cell_ref] = updated_cell.version
+        return updated_cell, recalculated
+
+    def apply_edits(self, sheet_id: str, edits: List[Tuple[str, str, Optional[str]]],
+                    user_id: str) -> Tuple[Dict[str, Cell], List[str]]:
+        # Batch edit (paste, fill-down): one validation pass and one recalc
+        cells, recalculated = self.spreadsheet_service.set_cells(sheet_id, edits)
+        versions = self.cell_versions.setdefault(sheet_id, {})
+        for cell_ref, cell in cells.items():
+            versions[cell_ref] = cell.version
+        return cells, recalculated
+
+    def drop_sheet(self, sheet_id: str) -> None:
+        # Release a sheet's edit state when it leaves memory
+        self.cell_versions.pop(sheet_id, None)
+        self.oplog.drop(sheet_id)
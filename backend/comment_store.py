@@ -0,0 +1,209 @@
+import bisect
+from typing import Dict, Iterable, List, Optional, Tuple
+from formula import Area
+from models import Comment
+from utils import MAX_COLUMNS, cell_ref_to_index, index_to_cell_ref
+
+# Comments of one sheet, indexed for the ways clients read them:
+#   - by comment id, a dict
+#   - by time, by author and by cell, each a list of (timestamp, comment_id)
+#     keys kept sorted, so every listing is "keys after the cursor" and pages
+#     with a bisect instead of a scan
+#   - by position, the sorted row-major keys of the cells with comments, so a
+#     viewport's comment markers cost a bisect per commented row, not a scan
+# Every add, edit and delete takes the sheet's next change seq (stored on the
+# comment). The changes feed keeps (seq, comment_id) in seq order plus a
+# tombstone per deleted comment, so "changed since seq N" is a bisect too.
+# Superseded feed rows are dropped once they outnumber the live ones, and only
+# the newest COMMENT_TOMBSTONES deletes are remembered; asking for changes
+# from before `floor` means the client has to reload the comment list.
+
+COMMENT_PAGE_SIZE = 100
+COMMENT_MAX_PAGE_SIZE = 1000
+COMMENT_TOMBSTONES = 10000
+
+Key = Tuple[float, str]
+
+
+def encode_cursor(key: Key) -> str:
+    # repr keeps the float exact
+    return f"{key[0]!r}:{key[1]}"
+
+
+def decode_cursor(cursor: str) -> Key:
+    # Raises ValueError for a malformed cursor
+    timestamp, sep, comment_id = cursor.partition(":")
+    if not sep:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return float(timestamp), comment_id
+
+
+def _remove(keys: List[Key], key: Key) -> None:
+    at = bisect.bisect_left(keys, key)
+    if at < len(keys) and keys[at] == key:
+        del keys[at]
+
+
+class CommentStore:
+    def __init__(self):
+        self.comments: Dict[str, Comment] = {}
+        self.by_time: List[Key] = []
+        self.by_user: Dict[str, List[Key]] = {}
+        # row * MAX_COLUMNS + col -> keys, and the sorted cell keys
+        self.by_cell: Dict[int, List[Key]] = {}
+        self.cells: List[int] = []
+        # Changes feed: parallel seq and comment id lists, in seq order
+        self.feed_seqs: List[int] = []
+        self.feed_ids: List[str] = []
+        # comment_id -> seq of its delete, oldest first
+        self.tombstones: Dict[str, int] = {}
+        self.seq = 0
+        # Oldest seq the feed can answer from
+        self.floor = 0
+
+    def __len__(self) -> int:
+        return len(self.comments)
+
+    @staticmethod
+    def _key(comment: Comment) -> Key:
+        return comment.timestamp, comment.comment_id
+
+    @staticmethod
+    def _cell(cell_ref: str) -> int:
+        row, col = cell_ref_to_index(cell_ref)
+        return row * MAX_COLUMNS + col
+
+    def _log(self, comment_id: str, seq: int) -> None:
+        self.seq = max(self.seq, seq)
+        self.feed_seqs.append(seq)
+        self.feed_ids.append(comment_id)
+        if len(self.feed_seqs) > 2 * (len(self.comments) + len(self.tombstones)) + 64:
+            self._compact_feed()
+
+    def _compact_feed(self) -> None:
+        latest = {comment_id: seq for seq, comment_id in zip(self.feed_seqs, self.feed_ids)}
+        kept = sorted((seq, comment_id) for comment_id, seq in latest.items()
+                      if comment_id in self.comments or comment_id in self.tombstones)
+        self.feed_seqs = [seq for seq, _ in kept]
+        self.feed_ids = [comment_id for _, comment_id in kept]
+
+    def put(self, comment: Comment) -> None:
+        # Add a comment, or replace the one with its id (an edit). A comment
+        # without a seq gets the next one.
+        if not comment.seq:
+            comment.seq = self.seq + 1
+        old = self.comments.get(comment.comment_id)
+        if old is not None:
+            self._unindex(old)
+        self.tombstones.pop(comment.comment_id, None)
+        self.comments[comment.comment_id] = comment
+        key = self._key(comment)
+        bisect.insort(self.by_time, key)
+        bisect.insort(self.by_user.setdefault(comment.user_id, []), key)
+        cell = self._cell(comment.cell_ref)
+        keys = self.by_cell.get(cell)
+        if keys is None:
+            keys = self.by_cell[cell] = []
+            bisect.insort(self.cells, cell)
+        bisect.insort(keys, key)
+        self._log(comment.comment_id, comment.seq)
+
+    def remove(self, comment_id: str, seq: int = 0) -> Optional[Comment]:
+        comment = self.comments.pop(comment_id, None)
+        if comment is None:
+            return None
+        self._unindex(comment)
+        seq = seq or self.seq + 1
+        self.tombstones[comment_id] = seq
+        if len(self.tombstones) > COMMENT_TOMBSTONES:
+            oldest = next(iter(self.tombstones))
+            self.floor = max(self.floor, self.tombstones.pop(oldest))
+        self._log(comment_id, seq)
+        return comment
+
+    def _unindex(self, comment: Comment) -> None:
+        key = self._key(comment)
+        _remove(self.by_time, key)
+        keys = self.by_user[comment.user_id]
+        _remove(keys, key)
+        if not keys:
+            del self.by_user[comment.user_id]
+        cell = self._cell(comment.cell_ref)
+        keys = self.by_cell[cell]
+        _remove(keys, key)
+        if not keys:
+            del self.by_cell[cell]
+            del self.cells[bisect.bisect_left(self.cells, cell)]
+
+    def get(self, comment_id: str) -> Optional[Comment]:
+        return self.comments.get(comment_id)
+
+    def for_cell(self, cell_ref: str) -> List[Comment]:
+        return [self.comments[comment_id] for _, comment_id in self.by_cell.get(self._cell(cell_ref), ())]
+
+    def page(self, cell_ref: Optional[str] = None, user_id: Optional[str] = None,
+             since: Optional[float] = None, until: Optional[float] = None,
+             cursor: Optional[str] = None, limit: int = COMMENT_PAGE_SIZE) -> Tuple[List[Comment], Optional[str]]:
+        # Comments matching every given filter, oldest first, starting after
+        # `cursor`; returns the page and the cursor of the next one (None on
+        # the last page). The time window is [since, until) in seconds.
+        if cell_ref is not None:
+            keys = self.by_cell.get(self._cell(cell_ref), [])
+        elif user_id is not None:
+            keys = self.by_user.get(user_id, [])
+        else:
+            keys = self.by_time
+        lo = 0
+        if cursor is not None:
+            lo = bisect.bisect_right(keys, decode_cursor(cursor))
+        if since is not None:
+            lo = max(lo, bisect.bisect_left(keys, (since, "")))
+        hi = len(keys) if until is None else bisect.bisect_left(keys, (until, ""))
+        page: List[Comment] = []
+        last = None
+        for at in range(lo, hi):
+            comment = self.comments[keys[at][1]]
+            if cell_ref is not None and user_id is not None and comment.user_id != user_id:
+                continue
+            if len(page) == limit:
+                return page, encode_cursor(last)
+            page.append(comment)
+            last = keys[at]
+        return page, None
+
+    def markers(self, area: Area) -> List[Tuple[str, int]]:
+        # (cell_ref, comment count) for every commented cell in the area,
+        # skipping straight past the commented cells outside its columns
+        markers = []
+        cells = self.cells
+        end = area.row_end * MAX_COLUMNS + area.col_end
+        at = bisect.bisect_left(cells, area.row_start * MAX_COLUMNS + area.col_start)
+        while at < len(cells) and cells[at] <= end:
+            row, col = divmod(cells[at], MAX_COLUMNS)
+            if col < area.col_start:
+                at = bisect.bisect_left(cells, row * MAX_COLUMNS + area.col_start, at)
+            elif col > area.col_end:
+                at = bisect.bisect_left(cells, (row + 1) * MAX_COLUMNS + area.col_start, at)
+            else:
+                markers.append((index_to_cell_ref(row, col), len(self.by_cell[cells[at]])))
+                at += 1
+        return markers
+
+    def changes_since(self, seq: int) -> Optional[List[Tuple[int, str, Optional[Comment]]]]:
+        # (seq, comment_id, comment or None when deleted) for every comment
+        # changed after `seq`, in seq order; None when the feed no longer
+        # reaches back that far or `seq` is ahead of this store
+        if seq < self.floor or seq > self.seq:
+            return None
+        at = bisect.bisect_right(self.feed_seqs, seq)
+        changes = []
+        for change_seq, comment_id in zip(self.feed_seqs[at:], self.feed_ids[at:]):
+            comment = self.comments.get(comment_id)
+            if comment is not None and comment.seq == change_seq:
+                changes.append((change_seq, comment_id, comment))
+            elif self.tombstones.get(comment_id) == change_seq:
+                changes.append((change_seq, comment_id, None))
+        return changes
+
+    def all(self) -> Iterable[Comment]:
+        return (self.comments[comment_id] for _, comment_id in self.by_time)
@@ -1,18 +1,35 @@
 import time
 import uuid
-from typing import Dict, List
+from dataclasses import astuple, replace
+from typing import Callable, Dict, List, Optional, Tuple
+from comment_store import COMMENT_MAX_PAGE_SIZE, COMMENT_PAGE_SIZE, CommentStore
+from formula import Area
 from models import Comment
+from utils import validate_cell_ref
 
 class CommentService:
     def __init__(self):
-        # Dict map sheet_id -> cell_ref -> List[Comment]
-        self.comments: Dict[str, Dict[str, List[Comment]]] = {}
+        # Dict map sheet_id -> indexed comments, see comment_store.py
+        self.comments: Dict[str, CommentStore] = {}
+        # journal(method, args) after every change; see SpreadsheetService
+        self.journal: Optional[Callable[[str, list], None]] = None
+        # on_access(sheet_id) before a sheet's data is used; see SpreadsheetService
+        self.on_access: Optional[Callable[[str], None]] = None
+
+    def _touch(self, sheet_id: str) -> None:
+        if self.on_access is not None:
+            self.on_access(sheet_id)
+
+    def _store(self, sheet_id: str) -> CommentStore:
+        store = self.comments.get(sheet_id)
+        if store is None:
+            store = self.comments[sheet_id] = CommentStore()
+        return store
 
     def add_comment(self, sheet_id: str, cell_ref: str, user_id: str, text: str) -> Comment:
-        if sheet_id not in self.comments:
-            self.comments[sheet_id] = {}
-        if cell_ref not in self.comments[sheet_id]:
-            self.comments[sheet_id][cell_ref] = []
+        if not validate_cell_ref(cell_ref):
+            raise ValueError(f"Invalid cell reference: {cell_ref}")
+        self._touch(sheet_id)
         comment_id = str(uuid.uuid4())
         comment = Comment(
             comment_id=comment_id,
@@ -21,8 +38,89 @@ class CommentService:
             text=text,
             timestamp=time.time()
         )
-        self.comments[sheet_id][cell_ref].append(comment)
+        self._store(sheet_id).put(comment)
+        if self.journal is not None:
+            self.journal("restore_comments", [sheet_id, [astuple(comment)]])
+        return comment
+
+    def edit_comment(self, sheet_id: str, comment_id: str, text: str) -> Optional[Comment]:
+        self._touch(sheet_id)
+        store = self.comments.get(sheet_id)
+        old = store.get(comment_id) if store is not None else None
+        if old is None:
+            return None
+        comment = replace(old, text=text, seq=0)
+        store.put(comment)
+        if self.journal is not None:
+            self.journal("restore_comments", [sheet_id, [astuple(comment)]])
         return comment
 
+    def delete_comment(self, sheet_id: str, comment_id: str) -> Optional[Comment]:
+        self._touch(sheet_id)
+        store = self.comments.get(sheet_id)
+        comment = store.remove(comment_id) if store is not None else None
+        if comment is not None and self.journal is not None:
+            self.journal("remove_comments", [sheet_id, [[comment_id, store.seq]]])
+        return comment
+
+    def restore_comments(self, sheet_id: str, comments: List[list]) -> None:
+        # Re-add comments given as Comment field tuples (persistence); a
+        # comment with a known id replaces it. Clients asking for changes
+        # from before a restore have to reload.
+        store = self._store(sheet_id)
+        for comment in sorted((Comment(*fields) for fields in comments), key=lambda c: c.seq):
+            store.put(comment)
+        store.floor = store.seq
+
+    def remove_comments(self, sheet_id: str, deletes: List[list]) -> None:
+        # Replay [comment_id, seq] deletes (persistence)
+        store = self._store(sheet_id)
+        for comment_id, seq in deletes:
+            store.remove(comment_id, seq)
+        store.floor = store.seq
+
+    def dump_comments(self, sheet_id: str) -> List[tuple]:
+        store = self.comments.get(sheet_id)
+        return [astuple(c) for c in store.all()] if store is not None else []
+
+    def get_comment(self, sheet_id: str, comment_id: str) -> Optional[Comment]:
+        self._touch(sheet_id)
+        store = self.comments.get(sheet_id)
+        return store.get(comment_id) if store is not None else None
+
     def get_comments(self, sheet_id: str, cell_ref: str) -> List[Comment]:
-        return self.comments.get(sheet_id, {}).get(cell_ref, [])
+        self._touch(sheet_id)
+        store = self.comments.get(sheet_id)
+        if store is None or not validate_cell_ref(cell_ref):
+            return []
+        return store.for_cell(cell_ref)
+
+    def list_comments(self, sheet_id: str, cell_ref: Optional[str] = None, user_id: Optional[str] = None,
+                      since: Optional[float] = None, until: Optional[float] = None,
+                      cursor: Optional[str] = None,
+                      limit: int = COMMENT_PAGE_SIZE) -> Tuple[List[Comment], Optional[str]]:
+        # One page of the sheet's comments and the cursor of the next page;
+        # see CommentStore.page. Raises ValueError for a bad cell, cursor or
+        # limit.
+        if cell_ref is not None and not validate_cell_ref(cell_ref):
+            raise ValueError(f"Invalid cell reference: {cell_ref}")
+        if not 1 <= limit <= COMMENT_MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {COMMENT_MAX_PAGE_SIZE}")
+        self._touch(sheet_id)
+        store = self.comments.get(sheet_id)
+        if store is None:
+            return [], None
+        return store.page(cell_ref, user_id, since, until, cursor, limit)
+
+    def get_markers(self, sheet_id: str, area: Area) -> List[Tuple[str, int]]:
+        self._touch(sheet_id)
+        store = self.comments.get(sheet_id)
+        return store.markers(area) if store is not None else []
+
+    def changes_since(self, sheet_id: str, seq: int) -> Tuple[Optional[List[Tuple[int, str, Optional[Comment]]]], int]:
+        # (changes after seq or None when the client has to reload, current seq)
+        self._touch(sheet_id)
+        store = self.comments.get(sheet_id)
+        if store is None:
+            return ([] if seq == 0 else None), 0
+        return store.changes_since(seq), store.seq
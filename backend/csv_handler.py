@@ -1,50 +1,98 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException
+from fastapi import APIRouter, UploadFile, File, Depends, HTTPException, Query
+import asyncio
 import csv
-import io
+import os
+from typing import Awaitable, Callable, Dict, Optional
+from csv_stream import (IMPORT_CHUNK_BYTES, IMPORT_MAX_PENDING_BYTES,
+                        CsvImporter, CsvImportError, export_rows)
 from spreadsheet import SpreadsheetService
+from formula import parse_range
+from services import SheetLocks, get_sheet_locks, get_spreadsheet_service, require_sheet_owner
+from utils import column_index
 
 csv_router = APIRouter()
-spreadsheet_service = SpreadsheetService()
 
+CSV_IMPORT_MAX_BYTES = int(os.environ.get("CSV_IMPORT_MAX_BYTES", 0))
+CSV_IMPORT_MAX_PENDING_BYTES = int(os.environ.get("CSV_IMPORT_MAX_PENDING_BYTES", IMPORT_MAX_PENDING_BYTES))
 
-@csv_router.post("/import/{sheet_id}")
-async def import_csv(sheet_id: str, file: UploadFile = File(...)):
-    contents = await file.read()
-    decoded = contents.decode("utf-8")
-    reader = csv.reader(io.StringIO(decoded))
-    sheet = spreadsheet_service.get_or_create_sheet(sheet_id)
-    sheet.cells.clear()
-    row_num = 1
-    for row in reader:
-        col_num = 0
-        for cell_value in row:
-            col_char = chr(ord("A") + col_num)
-            if cell_value.strip():
-                spreadsheet_service.set_cell_value(
-                    sheet_id, f"{col_char}{row_num}", cell_value.strip())
-            col_num += 1
-        row_num += 1
-    return {"message": f"Imported CSV for sheet {sheet_id}"}
-
-
-@csv_router.get("/export/{sheet_id}")
-def export_csv(sheet_id: str):
-    import io
+# Progress of running and finished imports, by sheet
+import_progress: Dict[str, dict] = {}
+# on_sheet_replaced(sheet_id) after an import rewrote a sheet, even a failed
+# one; main.py points it at the WebSocket manager so clients reload
+on_sheet_replaced: Optional[Callable[[str], Awaitable[None]]] = None
+
+
+@csv_router.post("/import/{sheet_id}", dependencies=[Depends(require_sheet_owner)])
+async def import_csv(sheet_id: str, file: UploadFile = File(...),
+                     spreadsheet_service: SpreadsheetService = Depends(get_spreadsheet_service),
+                     sheet_locks: SheetLocks = Depends(get_sheet_locks)):
+    progress = import_progress[sheet_id] = {"status": "running", "bytes": 0, "rows": 0}
+    try:
+        # Edits to the sheet wait until the import is complete
+        async with sheet_locks(sheet_id):
+            importer = CsvImporter(spreadsheet_service, sheet_id, CSV_IMPORT_MAX_BYTES, CSV_IMPORT_MAX_PENDING_BYTES)
+            try:
+                while True:
+                    chunk = await file.read(IMPORT_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    progress["rows"] = importer.feed(chunk)
+                    progress["bytes"] = importer.bytes_read
+                    # Let other requests and websocket traffic run between chunks
+                    await asyncio.sleep(0)
+                progress["rows"] = importer.close()
+            finally:
+                if on_sheet_replaced is not None:
+                    await on_sheet_replaced(sheet_id)
+    except (CsvImportError, UnicodeDecodeError, csv.Error) as e:
+        progress["status"] = "failed"
+        progress["error"] = str(e)
+        status_code = 413 if isinstance(e, CsvImportError) else 400
+        raise HTTPException(status_code=status_code, detail=str(e))
+    progress["status"] = "done"
+    return {"message": f"Imported CSV for sheet {sheet_id}", **progress}
+
+
+@csv_router.get("/import/{sheet_id}/progress")
+def import_csv_progress(sheet_id: str):
+    if sheet_id not in import_progress:
+        raise HTTPException(status_code=404, detail="No import for this sheet")
+    return import_progress[sheet_id]
+
+
+@csv_router.get("/export/{sheet_id}", dependencies=[Depends(require_sheet_owner)])
+async def export_csv(sheet_id: str, cell_range: Optional[str] = Query(None, alias="range"),
+                     columns: Optional[str] = None,
+                     spreadsheet_service: SpreadsheetService = Depends(get_spreadsheet_service),
+                     sheet_locks: SheetLocks = Depends(get_sheet_locks)):
+    # range: an A1 area such as "A1:D500"; columns: letters such as "A,C,F".
+    # With both, the listed columns are exported over the range's rows.
     from fastapi.responses import StreamingResponse
 
     sheet = spreadsheet_service.get_or_create_sheet(sheet_id)
-    output = io.StringIO()
-    writer = csv.writer(output)
-
-    for row in range(1, sheet.rows + 1):
-        row_data = []
-        for col in range(sheet.columns):
-            cell_ref = f"{chr(ord('A') + col)}{row}"
-            cell = sheet.cells.get(cell_ref)
-            val = cell.value if cell else ""
-            row_data.append(str(val))
-        writer.writerow(row_data)
-
-    output.seek(0)
-    return StreamingResponse(iter([output.read()]), media_type="text/csv",
+    row_start, row_end = 0, sheet.rows - 1
+    cols = list(range(sheet.columns))
+    try:
+        if cell_range:
+            area = parse_range(cell_range)
+            row_start, row_end = area.row_start, area.row_end
+            cols = list(range(area.col_start, area.col_end + 1))
+        if columns:
+            cols = [column_index(letters.strip().upper()) for letters in columns.split(",")]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def locked_rows():
+        # Chunks are built on the event loop under the sheet lock, so none
+        # holds a half-applied import or batch edit. The lock is released
+        # between chunks so a slow download does not hold up editors.
+        rows = export_rows(sheet, row_start, row_end, cols)
+        while True:
+            async with sheet_locks(sheet_id):
+                chunk = next(rows, None)
+            if chunk is None:
+                break
+            yield chunk
+
+    return StreamingResponse(locked_rows(), media_type="text/csv",
                              headers={"Content-Disposition": f"attachment; filename={sheet_id}.csv"})
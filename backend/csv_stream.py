@@ -0,0 +1,154 @@
+import codecs
+import csv
+import io
+from typing import Iterator, List, Optional
+from models import Spreadsheet
+from spreadsheet import SpreadsheetService
+
+# Streaming CSV import and export. Uploads are fed in chunks and decoded
+# incrementally. Only complete records are parsed, and they are loaded into
+# sheet storage in batches, so the whole file is never held in memory as one
+# string. Exports are generated row by row in chunks of about
+# EXPORT_CHUNK_BYTES.
+#
+# A newline ends a record unless it is inside a quoted field. As in
+# csv.reader, a quote only opens a quoted field at the start of a field;
+# elsewhere (5") it is a literal character. The importer tracks that state
+# across chunks, and lines without any quote skip the character scan.
+
+IMPORT_CHUNK_BYTES = 256 * 1024
+IMPORT_MAX_PENDING_BYTES = 16 * 1024 * 1024
+IMPORT_BATCH_ROWS = 2048
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+# Record scanner states
+_FIELD_START = 0
+_UNQUOTED = 1
+_QUOTED = 2
+_QUOTE_IN_QUOTED = 3
+
+
+class CsvImportError(ValueError):
+    pass
+
+
+class CsvImporter:
+    def __init__(self, service: SpreadsheetService, sheet_id: str,
+                 max_bytes: int = 0, max_pending_bytes: int = IMPORT_MAX_PENDING_BYTES):
+        self.service = service
+        self.sheet_id = sheet_id
+        # max_bytes caps the whole upload (0 = no limit); max_pending_bytes caps
+        # the unparsed tail, i.e. the longest single record we will buffer
+        self.max_bytes = max_bytes
+        self.max_pending_bytes = max_pending_bytes
+        self.bytes_read = 0
+        self.rows_loaded = 0
+        self._decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self._pending = ""
+        # Scanner state at offset _scanned of the pending text
+        self._scanned = 0
+        self._state = _FIELD_START
+        self._batch: List[List[str]] = []
+        service.clear_sheet(sheet_id)
+
+    def feed(self, chunk: bytes) -> int:
+        self.bytes_read += len(chunk)
+        if self.max_bytes and self.bytes_read > self.max_bytes:
+            raise CsvImportError(f"CSV upload exceeds {self.max_bytes} bytes")
+        text = self._pending + self._decoder.decode(chunk)
+        cut = self._scan(text)
+        if cut:
+            self._parse(text[:cut])
+            text = text[cut:]
+        if len(text) > self.max_pending_bytes:
+            raise CsvImportError(f"CSV record exceeds {self.max_pending_bytes} bytes")
+        self._pending = text
+        return self.rows_loaded
+
+    def _scan(self, text: str) -> int:
+        # Offset just past the last complete record in text; scanning
+        # resumes where the previous call stopped
+        pos, state, cut = self._scanned, self._state, 0
+        if state == _FIELD_START and text.find('"', pos) < 0:
+            # No quotes ahead: every newline ends a record
+            cut = text.rfind("\n", pos) + 1
+            pos = max(pos, cut)
+        while True:
+            end = text.find("\n", pos)
+            if end < 0:
+                break
+            if state != _FIELD_START or text.find('"', pos, end) >= 0:
+                for char in text[pos:end]:
+                    if state == _QUOTED:
+                        if char == '"':
+                            state = _QUOTE_IN_QUOTED
+                    elif state == _UNQUOTED:
+                        if char == ",":
+                            state = _FIELD_START
+                    elif char == '"':
+                        # Opens a field, or is an escaped quote inside one
+                        state = _QUOTED
+                    elif char == ",":
+                        state = _FIELD_START
+                    else:
+                        state = _UNQUOTED
+            pos = end + 1
+            if state != _QUOTED:
+                state = _FIELD_START
+                cut = pos
+        self._scanned, self._state = pos - cut, state
+        return cut
+
+    def close(self) -> int:
+        text = self._pending + self._decoder.decode(b"", final=True)
+        self._pending = ""
+        if text:
+            self._parse(text)
+        self._flush()
+        return self.rows_loaded
+
+    def _parse(self, text: str) -> None:
+        for row in csv.reader(io.StringIO(text)):
+            self._batch.append(row)
+            if len(self._batch) >= IMPORT_BATCH_ROWS:
+                self._flush()
+
+    def _flush(self) -> None:
+        if self._batch:
+            self.service.load_rows(self.sheet_id, self.rows_loaded, self._batch)
+            self.rows_loaded += len(self._batch)
+            self._batch = []
+
+
+def export_rows(sheet: Spreadsheet, row_start: int = 0, row_end: Optional[int] = None,
+                columns: Optional[List[int]] = None) -> Iterator[bytes]:
+    # CSV bytes for rows row_start..row_end (inclusive, default: the whole
+    # sheet) projected onto the given column indexes (default: every column).
+    # Only populated rows are read. Empty rows between them are written as
+    # blank records so row positions survive a round trip, and trailing
+    # empty rows are dropped.
+    if row_end is None:
+        row_end = sheet.rows - 1
+    if columns is None:
+        columns = list(range(sheet.columns))
+    store = sheet.store
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([""] * len(columns))
+    empty_row = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+
+    next_row = row_start
+    for row in store.populated_rows(row_start, row_end, columns):
+        if row > next_row:
+            buffer.write(empty_row * (row - next_row))
+        values = [store.value(row, col) for col in columns]
+        writer.writerow(["" if value is None else str(value) for value in values])
+        next_row = row + 1
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
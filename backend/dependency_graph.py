@@ -0,0 +1,121 @@
+from typing import Dict, Iterable, List, Set, Tuple
+
+# Cells are addressed by zero-based (row, col) coordinates and ranges by
+# (row_start, col_start, row_end, col_end), both ends inclusive.
+Coord = Tuple[int, int]
+Area = Tuple[int, int, int, int]
+
+
+class CircularReferenceError(ValueError):
+    pass
+
+
+class DependencyGraph:
+    def __init__(self):
+        # formula cell -> single cells it reads
+        self.precedents: Dict[Coord, Set[Coord]] = {}
+        # cell -> formula cells reading it directly
+        self.dependents: Dict[Coord, Set[Coord]] = {}
+        # formula cell -> ranges it reads
+        self.areas: Dict[Coord, List[Area]] = {}
+        # column -> formula cell -> row spans of that column it reads.
+        # Ranges are kept as area listeners instead of being expanded into
+        # one edge per cell, so SUM(A1:A100000) costs one entry.
+        self.area_listeners: Dict[int, Dict[Coord, List[Tuple[int, int]]]] = {}
+
+    def set_formula(self, cell: Coord, refs: Iterable[Coord], areas: Iterable[Area]) -> None:
+        self.clear_formula(cell)
+        refs = set(refs)
+        areas = list(areas)
+        if refs:
+            self.precedents[cell] = refs
+            for ref in refs:
+                self.dependents.setdefault(ref, set()).add(cell)
+        if areas:
+            self.areas[cell] = areas
+            for row_start, col_start, row_end, col_end in areas:
+                for col in range(col_start, col_end + 1):
+                    listeners = self.area_listeners.setdefault(col, {})
+                    listeners.setdefault(cell, []).append((row_start, row_end))
+
+    def clear_formula(self, cell: Coord) -> None:
+        for ref in self.precedents.pop(cell, ()):
+            readers = self.dependents.get(ref)
+            if readers is not None:
+                readers.discard(cell)
+                if not readers:
+                    del self.dependents[ref]
+        for _, col_start, _, col_end in self.areas.pop(cell, ()):
+            for col in range(col_start, col_end + 1):
+                listeners = self.area_listeners.get(col)
+                if listeners is not None:
+                    listeners.pop(cell, None)
+                    if not listeners:
+                        del self.area_listeners[col]
+
+    def has_formula(self, cell: Coord) -> bool:
+        return cell in self.precedents or cell in self.areas
+
+    def direct_dependents(self, cell: Coord) -> Set[Coord]:
+        result = set(self.dependents.get(cell, ()))
+        row, col = cell
+        for formula_cell, spans in self.area_listeners.get(col, {}).items():
+            for row_start, row_end in spans:
+                if row_start <= row <= row_end:
+                    result.add(formula_cell)
+                    break
+        return result
+
+    def would_create_cycle(self, cell: Coord, refs: Iterable[Coord], areas: Iterable[Area]) -> bool:
+        # A new formula at `cell` closes a loop if it reads `cell` itself or
+        # any cell that (transitively) depends on `cell`.
+        reachable = {cell}
+        stack = [cell]
+        while stack:
+            for dependent in self.direct_dependents(stack.pop()):
+                if dependent not in reachable:
+                    reachable.add(dependent)
+                    stack.append(dependent)
+        if any(ref in reachable for ref in refs):
+            return True
+        for row_start, col_start, row_end, col_end in areas:
+            for row, col in reachable:
+                if row_start <= row <= row_end and col_start <= col <= col_end:
+                    return True
+        return False
+
+    def recalc_order(self, changed: Iterable[Coord], include_changed: bool = False) -> List[Coord]:
+        """Return the formula cells affected by `changed`, in topological order."""
+        roots = list(changed)
+        order: List[Coord] = []
+        done: Set[Coord] = set()
+        reached: Set[Coord] = set()
+        in_progress: Set[Coord] = set()
+        for root in roots:
+            # Iterative post-order DFS over dependents; reversing the
+            # finishing order gives a valid evaluation order.
+            stack = [(root, iter(self.direct_dependents(root)))]
+            in_progress.add(root)
+            while stack:
+                node, children = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    stack.pop()
+                    in_progress.discard(node)
+                    if node not in done:
+                        done.add(node)
+                        order.append(node)
+                    continue
+                if child in in_progress:
+                    raise CircularReferenceError(f"Circular reference at {child}")
+                reached.add(child)
+                if child not in done:
+                    in_progress.add(child)
+                    stack.append((child, iter(self.direct_dependents(child))))
+        order.reverse()
+        if include_changed:
+            return order
+        # Changed cells were written by the caller; they only need another
+        # pass when a different changed cell feeds into them.
+        roots = set(roots)
+        return [cell for cell in order if cell not in roots or cell in reached]
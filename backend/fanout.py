@@ -0,0 +1,197 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional
+from wire import JSON
+
+logger = logging.getLogger(__name__)
+
+# Broadcast fan-out. Every connection gets a bounded outbound queue drained by
+# its own writer task, so publishing never waits on a socket: a slow client
+# only delays itself. A message is serialized once per wire codec (see
+# wire.py) and the same frame is queued for every connection using it.
+#
+# Messages published with a key (e.g. ("cursor", user_id)) are transient: a
+# newer message with the same key makes the older one worthless, so they may
+# be coalesced or dropped under pressure, and they are only written once no
+# other message is waiting. Keyless messages (cell edits, comments) are never
+# dropped; when one does not fit, the client is disconnected and has to
+# resync.
+
+POLICY_COALESCE = "coalesce"
+POLICY_DROP_CURSOR = "drop_cursor"
+POLICY_DISCONNECT = "disconnect"
+OVERFLOW_POLICIES = (POLICY_COALESCE, POLICY_DROP_CURSOR, POLICY_DISCONNECT)
+
+DEFAULT_QUEUE_SIZE = 256
+DEFAULT_SEND_TIMEOUT = 10.0
+
+Send = Callable[[Any], Awaitable[None]]
+Close = Callable[[], Awaitable[None]]
+
+
+class ClientChannel:
+    def __init__(self, send: Send, close: Optional[Close] = None, max_queue: int = DEFAULT_QUEUE_SIZE,
+                 policy: str = POLICY_COALESCE, send_timeout: float = DEFAULT_SEND_TIMEOUT,
+                 on_close: Optional[Callable[["ClientChannel"], None]] = None, codec=JSON):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.send = send
+        self.close_socket = close
+        self.max_queue = max_queue
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.on_close = on_close
+        self.codec = codec
+        # Frames that must be delivered, and [key, frame] pairs of transient
+        # ones. The writer always empties `queue` first, so edits go out ahead
+        # of presence traffic.
+        self.queue: deque = deque()
+        self.transient: deque = deque()
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self._sending = False
+        self._ready = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._writer())
+
+    def put(self, frame: Any, key: Optional[Hashable] = None) -> bool:
+        # Queue a frame without blocking; False when it was not queued
+        if self.closed:
+            return False
+        if len(self.queue) + len(self.transient) >= self.max_queue and not self._make_room(frame, key):
+            return False
+        if key is None:
+            self.queue.append(frame)
+        else:
+            self.transient.append([key, frame])
+        self._ready.set()
+        return True
+
+    def _make_room(self, frame: Any, key: Optional[Hashable]) -> bool:
+        # Returns True when the new frame should still be appended
+        if self.policy == POLICY_DISCONNECT:
+            self.close("outbound queue full")
+            return False
+        if key is not None:
+            if self.policy == POLICY_DROP_CURSOR:
+                self.dropped += 1
+                return False
+            for entry in self.transient:
+                if entry[0] == key:
+                    entry[1] = frame
+                    self.dropped += 1
+                    return False
+        if self.transient:
+            self.transient.popleft()
+            self.dropped += 1
+            return True
+        self.close("outbound queue full")
+        return False
+
+    async def _writer(self) -> None:
+        try:
+            while True:
+                while not self.queue and not self.transient:
+                    self._ready.clear()
+                    await self._ready.wait()
+                frame = self.queue.popleft() if self.queue else self.transient.popleft()[1]
+                self._sending = True
+                await asyncio.wait_for(self.send(frame), self.send_timeout)
+                self._sending = False
+                self.sent += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.close(f"send failed: {e!r}")
+
+    def close(self, reason: str = "closed") -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        self.transient.clear()
+        if reason != "closed":
+            logger.info("Closing client channel: %s", reason)
+        if asyncio.current_task() is not self._task:
+            self._task.cancel()
+        if self.close_socket is not None:
+            asyncio.get_running_loop().create_task(self._close_socket())
+        if self.on_close is not None:
+            self.on_close(self)
+
+    async def _close_socket(self) -> None:
+        try:
+            await self.close_socket()
+        except Exception:
+            pass
+
+    async def drain(self) -> None:
+        # Wait until everything queued so far has been written (tests, shutdown)
+        while (self.queue or self.transient or self._sending) and not self.closed:
+            await asyncio.sleep(0)
+
+
+class FanOut:
+    def __init__(self, max_queue: int = DEFAULT_QUEUE_SIZE, policy: str = POLICY_COALESCE,
+                 send_timeout: float = DEFAULT_SEND_TIMEOUT,
+                 on_disconnect: Optional[Callable[[str, Hashable], None]] = None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.max_queue = max_queue
+        self.policy = policy
+        self.send_timeout = send_timeout
+        # Called with (sheet_id, client) when a channel closes itself
+        self.on_disconnect = on_disconnect
+        self.channels: Dict[str, Dict[Hashable, ClientChannel]] = {}
+
+    def add(self, sheet_id: str, client: Hashable, send: Send, close: Optional[Close] = None,
+            codec=JSON) -> ClientChannel:
+        def closed(channel: ClientChannel) -> None:
+            sheet_channels = self.channels.get(sheet_id, {})
+            if sheet_channels.get(client) is channel:
+                del sheet_channels[client]
+                if self.on_disconnect is not None:
+                    self.on_disconnect(sheet_id, client)
+
+        channel = ClientChannel(send, close, self.max_queue, self.policy, self.send_timeout, closed, codec)
+        self.channels.setdefault(sheet_id, {})[client] = channel
+        return channel
+
+    def remove(self, sheet_id: str, client: Hashable) -> None:
+        channel = self.channels.get(sheet_id, {}).pop(client, None)
+        if channel is not None:
+            # The socket is already gone; just stop the writer
+            channel.on_close = None
+            channel.close_socket = None
+            channel.close()
+
+    def publish(self, sheet_id: str, message: dict, key: Optional[Hashable] = None,
+                clients: Optional[Iterable[Hashable]] = None) -> int:
+        # Serialize once per codec and queue the frame for every connection on
+        # the sheet, or only for `clients`. Returns the number of connections
+        # it was queued for.
+        channels = self.channels.get(sheet_id)
+        if not channels:
+            return 0
+        if clients is None:
+            targets = list(channels.values())
+        else:
+            targets = [channels[client] for client in clients if client in channels]
+        frames = {}
+        queued = 0
+        for channel in targets:
+            codec = channel.codec
+            if codec.name not in frames:
+                frames[codec.name] = codec.encode(message)
+            queued += channel.put(frames[codec.name], key)
+        return queued
+
+    def send(self, sheet_id: str, client: Hashable, message: dict) -> bool:
+        # Queue a message for one connection, behind what is already queued
+        channel = self.channels.get(sheet_id, {}).get(client)
+        return channel is not None and channel.put(channel.codec.encode(message))
+
+    async def drain(self, sheet_id: str) -> None:
+        for channel in list(self.channels.get(sheet_id, {}).values()):
+            await channel.drain()
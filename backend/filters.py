@@ -0,0 +1,84 @@
+import base64
+import re
+from typing import List, NamedTuple, Union
+from models import Spreadsheet
+from utils import column_index
+
+# Server-side row filters. A query is a list of predicates on columns that a
+# row must all satisfy, e.g. C > 100 and D = "open". Each predicate is a match
+# mask cached on its column (see ColumnStore.match_mask) and kept current as
+# cells are written, so re-running a query while edits stream in only costs
+# the AND of the masks: one big-integer & per predicate. Results are either
+#   rows   - the matching one-based row numbers, up to `limit`
+#   bitmap - base64 of one bit per sheet row, row 1 in the lowest bit of the
+#            first byte
+# and always the total count. Text compares case-insensitively; a text
+# operand only matches text and a number operand only numbers, as in COUNTIF.
+
+FILTER_OPS = ("=", "<>", "<", "<=", ">", ">=")
+FILTER_FORMATS = ("rows", "bitmap")
+FILTER_MAX_PREDICATES = 16
+FILTER_ROW_LIMIT = 10000
+
+_NONZERO = re.compile(rb"[^\x00]")
+# 0/1 bytes to ASCII "0"/"1", for packing a mask into an integer
+_DIGITS = bytes.maketrans(b"\x00\x01", b"01")
+
+
+class Predicate(NamedTuple):
+    col: int
+    op: str
+    operand: Union[str, float]
+
+
+def parse_predicates(where) -> List[Predicate]:
+    # [{"column": "C", "op": ">", "value": 100}, ...]; raises ValueError
+    if not isinstance(where, list) or not 0 < len(where) <= FILTER_MAX_PREDICATES:
+        raise ValueError(f"A filter needs 1 to {FILTER_MAX_PREDICATES} conditions")
+    predicates = []
+    for condition in where:
+        if not isinstance(condition, dict) or not isinstance(condition.get("column"), str):
+            raise ValueError("Each condition needs a column")
+        op = condition.get("op", "=")
+        if op not in FILTER_OPS:
+            raise ValueError(f"Unknown operator: {op}")
+        value = condition.get("value")
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            raise ValueError("Condition values must be numbers or text")
+        predicates.append(Predicate(column_index(condition["column"]), op,
+                                    value if isinstance(value, str) else float(value)))
+    return predicates
+
+
+def filter_mask(sheet: Spreadsheet, predicates: List[Predicate]) -> bytes:
+    # One byte per sheet row, 1 where every predicate holds
+    rows = sheet.rows
+    combined = -1
+    for predicate in predicates:
+        mask = sheet.store.match_mask(predicate.col, predicate.op, predicate.operand, rows)
+        combined &= int.from_bytes(mask, "little")
+        if not combined:
+            break
+    return combined.to_bytes(rows, "little") if combined > 0 else bytes(rows)
+
+
+def run_filter(sheet: Spreadsheet, predicates: List[Predicate], fmt: str = "rows",
+               limit: int = FILTER_ROW_LIMIT) -> dict:
+    if fmt not in FILTER_FORMATS:
+        raise ValueError(f"Unknown filter format: {fmt}")
+    if limit <= 0:
+        raise ValueError("Invalid limit")
+    mask = filter_mask(sheet, predicates)
+    result = {"count": mask.count(1), "rowCount": len(mask), "revision": sheet.store.revision}
+    if fmt == "rows":
+        rows = []
+        for match in _NONZERO.finditer(mask):
+            if len(rows) == limit:
+                break
+            rows.append(match.start() + 1)
+        result["rows"] = rows
+        result["truncated"] = len(rows) < result["count"]
+    else:
+        bits = int(mask[::-1].translate(_DIGITS) or b"0", 2)
+        result["bitmap"] = base64.b64encode(bits.to_bytes((len(mask) + 7) // 8, "little")).decode()
+    return result
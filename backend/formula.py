@@ -0,0 +1,526 @@
+import math
+import re
+from functools import lru_cache
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+from utils import cell_ref_to_index, index_to_cell_ref
+
+# Formulas are parsed once into a tree of closures and cached by their text,
+# so evaluating a formula never re-tokenizes it or builds cell ref strings.
+#
+# A compiled formula is evaluated against a context object providing:
+#   value(row, col)            -> the cell value, or None when empty
+#   numbers(area)              -> iterable of the numeric values inside an area
+#   count(area)                -> number of non-empty cells inside an area
+#   sum(area)                  -> sum of the numeric values inside an area
+#   count_numbers(area)        -> number of numeric values inside an area
+#   count_if(area, op, value)  -> number of cells matching a COUNTIF criterion
+#   lookup(area, value)        -> offset of the first cell equal to value in a
+#                                 vector (text ignoring case), or None
+#   lookup_sorted(area, value, descending)
+#                              -> offset of the last cell <= value (>= when
+#                                 descending) in a sorted vector, or None
+# A vector is a one-column area or the first row of a wider one.
+
+
+class FormulaError(Exception):
+    pass
+
+
+class Area(NamedTuple):
+    # Zero-based and inclusive, always normalized so start <= end
+    row_start: int
+    col_start: int
+    row_end: int
+    col_end: int
+
+
+class _EvalError(Exception):
+    # Raised while evaluating; turned into an error value like "#VALUE!"
+    def __init__(self, code: str):
+        super().__init__(code)
+        self.code = code
+
+
+Value = Optional[Union[str, float]]
+Evaluator = Callable[[object], Value]
+
+_TOKEN = re.compile(r"""\s*(?:
+    (?P<number>\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+)
+  | (?P<string>"(?:[^"]|"")*")
+  | (?P<error>\#REF!)
+  | (?P<range>\$?[A-Za-z]+\$?\d+:\$?[A-Za-z]+\$?\d+)
+  | (?P<ref>\$?[A-Za-z]+\$?\d+)(?![A-Za-z0-9_(])
+  | (?P<name>[A-Za-z_][A-Za-z0-9_.]*)
+  | (?P<op>[-+*/^(),])
+)""", re.VERBOSE)
+
+
+def _tokenize(text: str) -> List[Tuple[str, str]]:
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = _TOKEN.match(text, pos)
+        if not m or m.end() == pos:
+            raise FormulaError(f"Unexpected character in formula at position {pos}: {text[pos:]}")
+        kind = m.lastgroup
+        tokens.append((kind, m.group(kind)))
+        pos = m.end()
+    return tokens
+
+
+def _to_number(value: Value) -> float:
+    if value is None:
+        return 0.0
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        raise _EvalError("#VALUE!")
+
+
+def _parse_ref(token: str) -> Tuple[int, int]:
+    try:
+        return cell_ref_to_index(token.replace("$", "").upper())
+    except ValueError as e:
+        raise FormulaError(str(e))
+
+
+def _parse_area(token: str) -> Area:
+    start, end = token.split(":")
+    row_a, col_a = _parse_ref(start)
+    row_b, col_b = _parse_ref(end)
+    return Area(min(row_a, row_b), min(col_a, col_b), max(row_a, row_b), max(col_a, col_b))
+
+
+def parse_range(text: str) -> Area:
+    # "A1:C10" or a single "B2"; raises ValueError for anything else
+    start, _, end = text.strip().partition(":")
+    try:
+        return _parse_area(f"{start}:{end or start}")
+    except FormulaError as e:
+        raise ValueError(str(e))
+
+
+# --- functions -------------------------------------------------------------
+# Each function receives the context and its arguments, where an argument is
+# either an Area or an evaluator closure for a scalar expression.
+
+def _numbers(ctx, args):
+    for arg in args:
+        if isinstance(arg, Area):
+            yield from ctx.numbers(arg)
+        else:
+            value = arg(ctx)
+            if value is not None:
+                yield _to_number(value)
+
+
+def _fn_sum(ctx, args):
+    total = 0.0
+    for arg in args:
+        if isinstance(arg, Area):
+            total += ctx.sum(arg)
+        else:
+            total += _to_number(arg(ctx))
+    return total
+
+
+def _fn_average(ctx, args):
+    total, count = 0.0, 0
+    for arg in args:
+        if isinstance(arg, Area):
+            total += ctx.sum(arg)
+            count += ctx.count_numbers(arg)
+        else:
+            value = arg(ctx)
+            if value is not None:
+                total += _to_number(value)
+                count += 1
+    return total / count if count else 0.0
+
+
+def _fn_count(ctx, args):
+    total = 0
+    for arg in args:
+        if isinstance(arg, Area):
+            total += ctx.count(arg)
+        elif arg(ctx) is not None:
+            total += 1
+    return total
+
+
+def _fn_min(ctx, args):
+    return min(_numbers(ctx, args), default=0.0)
+
+
+def _fn_max(ctx, args):
+    return max(_numbers(ctx, args), default=0.0)
+
+
+def _fn_stdev(ctx, args):
+    # Sample standard deviation, two-pass for numerical stability
+    values = list(_numbers(ctx, args))
+    if len(values) < 2:
+        raise _EvalError("#DIV/0!")
+    mean = math.fsum(values) / len(values)
+    squares = math.fsum(map(pow, map(mean.__rsub__, values), [2] * len(values)))
+    return math.sqrt(squares / (len(values) - 1))
+
+
+_CRITERIA_OPS = ("<=", ">=", "<>", "<", ">", "=")
+
+
+def parse_criteria(criteria: Value) -> Tuple[str, Union[str, float]]:
+    # "> 100" -> (">", 100.0), "open" -> ("=", "open"), 5 -> ("=", 5.0)
+    if isinstance(criteria, (int, float)):
+        return "=", float(criteria)
+    text = criteria or ""
+    op = "="
+    for candidate in _CRITERIA_OPS:
+        if text.startswith(candidate):
+            op, text = candidate, text[len(candidate):]
+            break
+    text = text.strip()
+    try:
+        return op, float(text)
+    except ValueError:
+        return op, text
+
+
+def _fn_countif(ctx, args):
+    if len(args) != 2 or not isinstance(args[0], Area) or isinstance(args[1], Area):
+        raise _EvalError("#VALUE!")
+    op, operand = parse_criteria(args[1](ctx))
+    return ctx.count_if(args[0], op, operand)
+
+
+def _vector_size(area: Area) -> int:
+    if area.col_start == area.col_end:
+        return area.row_end - area.row_start + 1
+    return area.col_end - area.col_start + 1
+
+
+def _vector_value(ctx, area: Area, offset: int) -> Value:
+    # The value at offset along a vector; a blank reads as 0 like in Excel
+    if area.col_start == area.col_end:
+        value = ctx.value(area.row_start + offset, area.col_start)
+    else:
+        value = ctx.value(area.row_start, area.col_start + offset)
+    return 0.0 if value is None else value
+
+
+def _match_offset(ctx, area: Area, value: Value, match_type: float) -> int:
+    # 0 exact, 1 last <= value in ascending data, -1 last >= value in
+    # descending data; raises #N/A when nothing matches
+    if match_type == 0:
+        offset = ctx.lookup(area, value)
+    else:
+        offset = ctx.lookup_sorted(area, value, match_type < 0)
+    if offset is None:
+        raise _EvalError("#N/A")
+    return offset
+
+
+def _fn_vlookup(ctx, args):
+    # VLOOKUP(value, table, column, [approximate=TRUE])
+    if not 3 <= len(args) <= 4 or not isinstance(args[1], Area) or any(
+            isinstance(arg, Area) for arg in args[:1] + args[2:]):
+        raise _EvalError("#VALUE!")
+    table = args[1]
+    column = int(_to_number(args[2](ctx)))
+    if column < 1:
+        raise _EvalError("#VALUE!")
+    if column > table.col_end - table.col_start + 1:
+        raise _EvalError("#REF!")
+    approximate = len(args) < 4 or _to_number(args[3](ctx)) != 0
+    keys = table._replace(col_end=table.col_start)
+    offset = _match_offset(ctx, keys, args[0](ctx), 1 if approximate else 0)
+    value = ctx.value(table.row_start + offset, table.col_start + column - 1)
+    return 0.0 if value is None else value
+
+
+def _fn_xlookup(ctx, args):
+    # XLOOKUP(value, lookup vector, return vector, [if not found]); exact match
+    if not 3 <= len(args) <= 4 or not isinstance(args[1], Area) or not isinstance(args[2], Area) or any(
+            isinstance(arg, Area) for arg in args[:1] + args[3:]):
+        raise _EvalError("#VALUE!")
+    offset = ctx.lookup(args[1], args[0](ctx))
+    if offset is None:
+        if len(args) == 4:
+            return args[3](ctx)
+        raise _EvalError("#N/A")
+    if offset >= _vector_size(args[2]):
+        raise _EvalError("#VALUE!")
+    return _vector_value(ctx, args[2], offset)
+
+
+def _fn_match(ctx, args):
+    # MATCH(value, vector, [match type=1]) -> one-based position
+    if not 2 <= len(args) <= 3 or not isinstance(args[1], Area) or any(
+            isinstance(arg, Area) for arg in args[:1] + args[2:]):
+        raise _EvalError("#VALUE!")
+    match_type = _to_number(args[2](ctx)) if len(args) == 3 else 1.0
+    return float(_match_offset(ctx, args[1], args[0](ctx), match_type) + 1)
+
+
+FUNCTIONS: Dict[str, Callable] = {
+    "SUM": _fn_sum,
+    "AVERAGE": _fn_average,
+    "COUNT": _fn_count,
+    "MIN": _fn_min,
+    "MAX": _fn_max,
+    "STDEV": _fn_stdev,
+    "COUNTIF": _fn_countif,
+    "VLOOKUP": _fn_vlookup,
+    "XLOOKUP": _fn_xlookup,
+    "MATCH": _fn_match,
+}
+
+# Names that are values rather than function calls
+_CONSTANTS = {"TRUE": 1.0, "FALSE": 0.0}
+
+
+class CompiledFormula:
+    __slots__ = ("text", "refs", "areas", "_evaluate")
+
+    def __init__(self, text: str, evaluate: Evaluator, refs: Tuple[Tuple[int, int], ...], areas: Tuple[Area, ...]):
+        self.text = text
+        self.refs = refs
+        self.areas = areas
+        self._evaluate = evaluate
+
+    def __call__(self, ctx) -> Value:
+        try:
+            result = self._evaluate(ctx)
+        except ZeroDivisionError:
+            return "#DIV/0!"
+        except (ArithmeticError, ValueError):
+            # 10^400, or int() of an infinite or NaN argument
+            return "#NUM!"
+        except TypeError:
+            # Mixed-type comparisons inside functions; recalculation of
+            # dependents must not raise
+            return "#VALUE!"
+        except _EvalError as e:
+            return e.code
+        # A negative number to a fractional power is complex in Python
+        if isinstance(result, complex) or (isinstance(result, float) and not math.isfinite(result)):
+            return "#NUM!"
+        return result
+
+
+class _Parser:
+    # expr   := term (("+" | "-") term)*
+    # term   := power (("*" | "/") power)*
+    # power  := unary ("^" unary)*
+    # unary  := "-" unary | "+" unary | atom
+    # atom   := number | string | ref | name "(" args ")" | "(" expr ")"
+
+    def __init__(self, tokens: List[Tuple[str, str]]):
+        self.tokens = tokens
+        self.pos = 0
+        self.refs: List[Tuple[int, int]] = []
+        self.areas: List[Area] = []
+
+    def peek(self) -> Tuple[Optional[str], Optional[str]]:
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None, None
+
+    def take(self, value: Optional[str] = None) -> Tuple[str, str]:
+        kind, text = self.peek()
+        if kind is None or (value is not None and text != value):
+            raise FormulaError(f"Expected {value or 'an expression'} in formula")
+        self.pos += 1
+        return kind, text
+
+    def parse(self) -> Evaluator:
+        fn = self.expr()
+        if self.pos != len(self.tokens):
+            raise FormulaError(f"Unexpected token in formula: {self.tokens[self.pos][1]}")
+        return fn
+
+    def expr(self) -> Evaluator:
+        fn = self.term()
+        while self.peek()[1] in ("+", "-"):
+            op = self.take()[1]
+            fn = self._binary(op, fn, self.term())
+        return fn
+
+    def term(self) -> Evaluator:
+        fn = self.power()
+        while self.peek()[1] in ("*", "/"):
+            op = self.take()[1]
+            fn = self._binary(op, fn, self.power())
+        return fn
+
+    def power(self) -> Evaluator:
+        fn = self.unary()
+        while self.peek()[1] == "^":
+            self.take()
+            fn = self._binary("^", fn, self.unary())
+        return fn
+
+    def unary(self) -> Evaluator:
+        if self.peek()[1] == "-":
+            self.take()
+            operand = self.unary()
+            return lambda ctx: -_to_number(operand(ctx))
+        if self.peek()[1] == "+":
+            self.take()
+            return self.unary()
+        return self.atom()
+
+    def atom(self) -> Evaluator:
+        kind, text = self.take()
+        if kind == "number":
+            number = float(text)
+            return lambda ctx: number
+        if kind == "string":
+            string = text[1:-1].replace('""', '"')
+            return lambda ctx: string
+        if kind == "error":
+            # A reference whose row or column was deleted
+            def broken_ref(ctx):
+                raise _EvalError("#REF!")
+            return broken_ref
+        if kind == "ref":
+            row, col = _parse_ref(text)
+            self.refs.append((row, col))
+            return lambda ctx: ctx.value(row, col)
+        if kind == "name":
+            name = text.upper()
+            if name in _CONSTANTS and self.peek()[1] != "(":
+                constant = _CONSTANTS[name]
+                return lambda ctx: constant
+            return self.call(name)
+        if text == "(":
+            fn = self.expr()
+            self.take(")")
+            return fn
+        if kind == "range":
+            raise FormulaError(f"Range {text} can only be used as a function argument")
+        raise FormulaError(f"Unexpected token in formula: {text}")
+
+    def call(self, name: str) -> Evaluator:
+        func = FUNCTIONS.get(name)
+        if func is None:
+            raise FormulaError(f"Unsupported function: {name}")
+        self.take("(")
+        args: List[Union[Area, Evaluator]] = []
+        if self.peek()[1] != ")":
+            while True:
+                kind, text = self.peek()
+                if kind == "range":
+                    self.take()
+                    area = _parse_area(text)
+                    self.areas.append(area)
+                    args.append(area)
+                else:
+                    args.append(self.expr())
+                if self.peek()[1] != ",":
+                    break
+                self.take(",")
+        self.take(")")
+        return lambda ctx: func(ctx, args)
+
+    @staticmethod
+    def _binary(op: str, left: Evaluator, right: Evaluator) -> Evaluator:
+        if op == "+":
+            return lambda ctx: _to_number(left(ctx)) + _to_number(right(ctx))
+        if op == "-":
+            return lambda ctx: _to_number(left(ctx)) - _to_number(right(ctx))
+        if op == "*":
+            return lambda ctx: _to_number(left(ctx)) * _to_number(right(ctx))
+        if op == "/":
+            return lambda ctx: _to_number(left(ctx)) / _to_number(right(ctx))
+        return lambda ctx: _to_number(left(ctx)) ** _to_number(right(ctx))
+
+
+@lru_cache(maxsize=4096)
+def compile_formula(formula: str) -> CompiledFormula:
+    text = formula.strip()
+    if text.startswith("="):
+        text = text[1:]
+    if not text:
+        raise FormulaError("Empty formula")
+    parser = _Parser(_tokenize(text))
+    evaluate = parser.parse()
+    return CompiledFormula(text, evaluate, tuple(dict.fromkeys(parser.refs)), tuple(parser.areas))
+
+
+# --- structural edits -------------------------------------------------------
+
+_REF_PARTS = re.compile(r"(\$?)([A-Za-z]+)(\$?)(\d+)")
+
+
+def _shift_index(index: int, at: int, count: int) -> Optional[int]:
+    # count > 0 inserts `count` lines before `at`, count < 0 deletes -count lines from `at`
+    if index < at:
+        return index
+    if count < 0 and index < at - count:
+        return None
+    return index + count
+
+
+def _shift_span(start: int, end: int, at: int, count: int) -> Optional[Tuple[int, int]]:
+    if count > 0:
+        return _shift_index(start, at, count), _shift_index(end, at, count)
+    stop = at - count
+    new_start = start if start < at else (at if start < stop else start + count)
+    new_end = end if end < at else (at - 1 if end < stop else end + count)
+    if new_end < new_start:
+        return None
+    return new_start, new_end
+
+
+def _format_ref(parts: Tuple[str, str, str, str], row: int, col: int) -> str:
+    col_marker, _, row_marker, _ = parts
+    ref = index_to_cell_ref(row, col)
+    letters = ref.rstrip("0123456789")
+    return f"{col_marker}{letters}{row_marker}{ref[len(letters):]}"
+
+
+def shift_references(formula: str, axis: int, at: int, count: int) -> str:
+    """Rewrite references after inserting (count > 0) or deleting (count < 0)
+    rows (axis 0) or columns (axis 1) at zero-based index `at`."""
+    pos = len(formula) - len(formula.lstrip())
+    if formula.startswith("=", pos):
+        pos += 1
+    pieces = [formula[:pos]]
+    while pos < len(formula):
+        m = _TOKEN.match(formula, pos)
+        if not m or m.end() == pos:
+            # Not a formula we can tokenize; leave it for compile to reject
+            pieces.append(formula[pos:])
+            break
+        kind = m.lastgroup
+        token_start = m.start(kind)
+        pieces.append(formula[pos:token_start])
+        token = m.group(kind)
+        if kind == "ref":
+            parts = _REF_PARTS.fullmatch(token).groups()
+            row, col = cell_ref_to_index(f"{parts[1].upper()}{parts[3]}")
+            coords = [row, col]
+            shifted = _shift_index(coords[axis], at, count)
+            if shifted is None:
+                token = "#REF!"
+            else:
+                coords[axis] = shifted
+                token = _format_ref(parts, *coords)
+        elif kind == "range":
+            start_parts, end_parts = (_REF_PARTS.fullmatch(part).groups() for part in token.split(":"))
+            area = _parse_area(token)
+            starts = [area.row_start, area.col_start]
+            ends = [area.row_end, area.col_end]
+            span = _shift_span(starts[axis], ends[axis], at, count)
+            if span is None:
+                token = "#REF!"
+            else:
+                starts[axis], ends[axis] = span
+                token = f"{_format_ref(start_parts, *starts)}:{_format_ref(end_parts, *ends)}"
+        pieces.append(token)
+        pos = m.end()
+    return "".join(pieces)
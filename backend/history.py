@@ -1,26 +1,107 @@
 import time
-from typing import Dict, List
+import uuid
+from dataclasses import astuple
+from itertools import groupby
+from typing import Callable, Dict, List, Optional, Sequence
+from history_store import ACTIONS, HISTORY_PAGE_SIZE, Change, HistoryStore
 from models import HistoryEntry
+from utils import validate_cell_ref
 
 class HistoryService:
     def __init__(self):
-        # Dict: sheet_id -> cell_ref -> List[HistoryEntry]
-        self.history_log: Dict[str, Dict[str, List[HistoryEntry]]] = {}
-
-    def log_edit(self, sheet_id: str, cell_ref: str, old_value, new_value, user_id: str):
-        if sheet_id not in self.history_log:
-            self.history_log[sheet_id] = {}
-        if cell_ref not in self.history_log[sheet_id]:
-            self.history_log[sheet_id][cell_ref] = []
-
-        entry = HistoryEntry(
-            cell_ref=cell_ref,
-            old_value=old_value,
-            new_value=new_value,
-            user_id=user_id,
-            timestamp=time.time(),
-        )
-        self.history_log[sheet_id][cell_ref].append(entry)
-
-    def get_history(self, sheet_id: str, cell_ref: str) -> List[HistoryEntry]:
-        return self.history_log.get(sheet_id, {}).get(cell_ref, [])
+        # Dict: sheet_id -> columnar edit log, see history_store.py
+        self.logs: Dict[str, HistoryStore] = {}
+        # journal(method, args) after every change; see SpreadsheetService
+        self.journal: Optional[Callable[[str, list], None]] = None
+        # on_access(sheet_id) before a sheet's data is used; see SpreadsheetService
+        self.on_access: Optional[Callable[[str], None]] = None
+
+    def _touch(self, sheet_id: str) -> None:
+        if self.on_access is not None:
+            self.on_access(sheet_id)
+
+    def _append(self, sheet_id: str, changes: List[Change], user_id: str,
+                batch_id: Optional[str] = None, action: str = "edit") -> None:
+        timestamp = time.time()
+        log = self.logs.get(sheet_id)
+        if log is None:
+            log = self.logs[sheet_id] = HistoryStore()
+        log.append(changes, user_id, timestamp, batch_id, ACTIONS.index(action))
+        if self.journal is not None:
+            self.journal("restore_entries", [sheet_id, [
+                astuple(HistoryEntry(cell_ref, old_value, new_value, user_id, timestamp,
+                                     batch_id, old_formula, new_formula, action))
+                for cell_ref, old_value, new_value, old_formula, new_formula in changes
+            ]])
+
+    def log_edit(self, sheet_id: str, cell_ref: str, old_value, new_value, user_id: str,
+                 old_formula: Optional[str] = None, new_formula: Optional[str] = None):
+        self._touch(sheet_id)
+        self._append(sheet_id, [(cell_ref, old_value, new_value, old_formula, new_formula)], user_id)
+
+    def log_batch(self, sheet_id: str, changes: List[Sequence], user_id: str, action: str = "edit") -> str:
+        # One grouped entry for a batch of (cell_ref, old_value, new_value)
+        # or (cell_ref, old_value, new_value, old_formula, new_formula)
+        # changes; each cell's history still shows its part of the batch.
+        # action "undo"/"redo" logs the changes made by an undo or redo.
+        self._touch(sheet_id)
+        batch_id = str(uuid.uuid4())
+        self._append(sheet_id, [tuple(change) + (None,) * (5 - len(change)) for change in changes],
+                     user_id, batch_id, action)
+        return batch_id
+
+    def restore_entries(self, sheet_id: str, entries: List[list]) -> None:
+        # Re-add entries given as HistoryEntry field tuples (persistence).
+        # Consecutive entries of one batch are appended together, so undo
+        # and redo stacks come back as they were.
+        log = self.logs.get(sheet_id)
+        if log is None:
+            log = self.logs[sheet_id] = HistoryStore()
+        parsed = [HistoryEntry(*fields) for fields in entries]
+        for _, group in groupby(parsed, key=lambda entry: entry.batch_id or id(entry)):
+            group = list(group)
+            first = group[0]
+            log.append([(e.cell_ref, e.old_value, e.new_value, e.old_formula, e.new_formula) for e in group],
+                       first.user_id, first.timestamp, first.batch_id, ACTIONS.index(first.action))
+
+    def restore_log(self, sheet_id: str, log: HistoryStore) -> None:
+        # Install a log loaded from storage
+        self.logs[sheet_id] = log
+
+    def dump_entries(self, sheet_id: str) -> List[tuple]:
+        log = self.logs.get(sheet_id)
+        return [astuple(entry) for entry in log.entries()] if log is not None else []
+
+    def get_batch(self, sheet_id: str, batch_id: str) -> List[HistoryEntry]:
+        self._touch(sheet_id)
+        log = self.logs.get(sheet_id)
+        return log.batch(batch_id) if log is not None else []
+
+    def get_history(self, sheet_id: str, cell_ref: str, limit: int = HISTORY_PAGE_SIZE) -> List[HistoryEntry]:
+        # The newest `limit` entries of one cell; nothing for a missing or
+        # invalid ref rather than the whole sheet's log
+        if not cell_ref or not validate_cell_ref(cell_ref):
+            return []
+        return self.query(sheet_id, cell_ref=cell_ref, limit=min(max(limit, 1), HISTORY_PAGE_SIZE))
+
+    def query(self, sheet_id: str, cell_ref: Optional[str] = None, user_id: Optional[str] = None,
+              since: Optional[float] = None, until: Optional[float] = None,
+              limit: Optional[int] = None) -> List[HistoryEntry]:
+        # Entries matching every given filter, oldest first; since/until are
+        # epoch seconds, a limit keeps the newest entries
+        self._touch(sheet_id)
+        log = self.logs.get(sheet_id)
+        if log is None:
+            return []
+        try:
+            return log.query(cell_ref, user_id, since, until, limit)
+        except ValueError:
+            # Not a cell reference
+            return []
+
+    def pending_undo(self, sheet_id: str, user_id: str, redo: bool = False) -> Optional[List[Change]]:
+        # What undoing (or redoing) the user's last action would change; see
+        # HistoryStore.pending. Log the applied part with log_batch(action=...).
+        self._touch(sheet_id)
+        log = self.logs.get(sheet_id)
+        return log.pending(user_id, redo) if log is not None else None
@@ -0,0 +1,339 @@
+import bisect
+import os
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from models import HistoryEntry
+from storage import StringTable
+from utils import MAX_COLUMNS, cell_ref_to_index, index_to_cell_ref
+
+# Append-only, column-oriented edit log of one sheet.
+#
+# Every edit is one position in parallel typed arrays instead of one object:
+#   cells        - row * MAX_COLUMNS + col of the edited cell
+#   users        - ids into the log's interned string table
+#   offsets      - milliseconds since the start of the entry's time block
+#   old_kinds,   - per side, one of the VALUE_* codes below, the value (a
+#   old_values,    number, or a string id stored as a float for text) and the
+#   old_formulas   formula's string id, -1 for none
+#   (and new_*)
+#   batches      - batch number, -1 for single edits
+#   actions      - ACTION_EDIT, ACTION_UNDO or ACTION_REDO
+# Timestamps are delta-encoded: entries are grouped into time blocks of at
+# most TIME_BLOCK_ENTRIES, each with one absolute start time, and times never
+# go backwards, so time windows are found by binary search.
+#
+# Entries are addressed by a sequence number that keeps growing; `base` is the
+# sequence number of the oldest retained entry. When the log grows past
+# `capacity` the oldest entries are compacted away in one pass: the arrays are
+# sliced, the string table is rebuilt with only the strings still in use and
+# the indexes are rebuilt. The cell and user indexes map to ascending arrays
+# of sequence numbers.
+#
+# Undo and redo use the same log: each user has a stack of actions (a single
+# edit or a batch) to undo and one to redo, held as (first seq, count).
+# Applying an undo is logged as a new ACTION_UNDO batch, which goes on the redo
+# stack; a redo is logged as ACTION_REDO and goes back on the undo stack; a
+# plain edit clears the user's redo stack.
+
+HISTORY_MAX_ENTRIES = int(os.environ.get("HISTORY_MAX_ENTRIES", 200000))
+# Most entries one history read returns
+HISTORY_PAGE_SIZE = 1000
+UNDO_DEPTH = 100
+TIME_BLOCK_ENTRIES = 1024
+_MAX_OFFSET_MS = 2 ** 32 - 1
+
+VALUE_NONE = 0
+VALUE_NUMBER = 1
+VALUE_TEXT = 2
+
+ACTION_EDIT = 0
+ACTION_UNDO = 1
+ACTION_REDO = 2
+ACTIONS = ("edit", "undo", "redo")
+
+Value = Optional[Union[str, float]]
+# (cell_ref, old_value, new_value, old_formula, new_formula)
+Change = Tuple[str, Value, Value, Optional[str], Optional[str]]
+
+
+class HistoryStore:
+    def __init__(self, capacity: int = HISTORY_MAX_ENTRIES):
+        self.capacity = capacity
+        self.base = 0
+        self.strings = StringTable()
+        self.cells = array("q")
+        self.users = array("i")
+        self.offsets = array("I")
+        self.old_kinds = bytearray()
+        self.old_values = array("d")
+        self.old_formulas = array("i")
+        self.new_kinds = bytearray()
+        self.new_values = array("d")
+        self.new_formulas = array("i")
+        self.batches = array("i")
+        self.actions = bytearray()
+        # Time blocks: first position (relative to base) and start time (ms)
+        self.block_starts = array("q")
+        self.block_times = array("d")
+        # Batch number -> (first seq, count); batch ids are interned strings
+        self.batch_ranges: Dict[int, Tuple[int, int]] = {}
+        self.by_cell: Dict[int, array] = {}
+        self.by_user: Dict[int, array] = {}
+        self.undo_stacks: Dict[int, List[Tuple[int, int]]] = {}
+        self.redo_stacks: Dict[int, List[Tuple[int, int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.cells)
+
+    @property
+    def next_seq(self) -> int:
+        return self.base + len(self.cells)
+
+    # Writing
+
+    def _encode(self, value: Value) -> Tuple[int, float]:
+        if value is None:
+            return VALUE_NONE, 0.0
+        if isinstance(value, (int, float)):
+            return VALUE_NUMBER, float(value)
+        return VALUE_TEXT, float(self.strings.intern(value))
+
+    def _time_offset(self, timestamp: float, position: int) -> int:
+        # Offset of the entry at `position` in the current time block, opening
+        # a new block when needed
+        ms = timestamp * 1000.0
+        if self.block_times:
+            # Never go back in time, so blocks and offsets stay sorted
+            start = self.block_times[-1]
+            ms = max(ms, start + self.offsets[-1])
+            offset = int(ms - start)
+            if position - self.block_starts[-1] < TIME_BLOCK_ENTRIES and offset <= _MAX_OFFSET_MS:
+                return offset
+        self.block_starts.append(position)
+        self.block_times.append(ms)
+        return 0
+
+    def append(self, changes: Iterable[Change], user_id: str, timestamp: float,
+               batch_id: Optional[str] = None, action: int = ACTION_EDIT) -> Tuple[int, int]:
+        # Log changes made together by one user; returns (first seq, count)
+        first = self.next_seq
+        user = self.strings.intern(user_id or "")
+        batch = -1 if batch_id is None else self.strings.intern(batch_id)
+        for cell_ref, old_value, new_value, old_formula, new_formula in changes:
+            row, col = cell_ref_to_index(cell_ref)
+            cell = row * MAX_COLUMNS + col
+            seq = self.next_seq
+            self.offsets.append(self._time_offset(timestamp, len(self.cells)))
+            self.cells.append(cell)
+            self.users.append(user)
+            kind, value = self._encode(old_value)
+            self.old_kinds.append(kind)
+            self.old_values.append(value)
+            self.old_formulas.append(-1 if old_formula is None else self.strings.intern(old_formula))
+            kind, value = self._encode(new_value)
+            self.new_kinds.append(kind)
+            self.new_values.append(value)
+            self.new_formulas.append(-1 if new_formula is None else self.strings.intern(new_formula))
+            self.batches.append(batch)
+            self.actions.append(action)
+            self.by_cell.setdefault(cell, array("q")).append(seq)
+            self.by_user.setdefault(user, array("q")).append(seq)
+        count = self.next_seq - first
+        if count and batch >= 0:
+            self.batch_ranges[batch] = (first, count)
+        self._push_action(user, action, (first, count))
+        if len(self.cells) > self.capacity:
+            self.compact(len(self.cells) - self.capacity // 2)
+        return first, count
+
+    def _push_action(self, user: int, action: int, span: Tuple[int, int]) -> None:
+        # An undo or redo takes the action it reverts off its stack; an empty
+        # span (every cell changed by someone else since) is not pushed
+        undo = self.undo_stacks.setdefault(user, [])
+        redo = self.redo_stacks.setdefault(user, [])
+        if action == ACTION_UNDO:
+            if undo:
+                undo.pop()
+            target = redo
+        else:
+            if action == ACTION_REDO:
+                if redo:
+                    redo.pop()
+            else:
+                redo.clear()
+            target = undo
+        if span[1]:
+            target.append(span)
+            if len(target) > UNDO_DEPTH:
+                del target[0]
+
+    def compact(self, drop: int) -> None:
+        # Forget the oldest `drop` entries in one pass
+        drop = min(drop, len(self.cells))
+        if drop <= 0:
+            return
+        times = [self._time_ms(i) for i in range(drop, len(self.cells))]
+        old_strings = self.strings.strings
+        strings = self.strings = StringTable()
+
+        def remap_ids(ids: array) -> array:
+            return array("i", (-1 if i < 0 else strings.intern(old_strings[i]) for i in ids))
+
+        def remap_values(kinds: bytearray, values: array) -> array:
+            return array("d", (float(strings.intern(old_strings[int(v)])) if k == VALUE_TEXT else v
+                               for k, v in zip(kinds, values)))
+
+        self.cells = self.cells[drop:]
+        self.users = remap_ids(self.users[drop:])
+        self.old_values = remap_values(self.old_kinds[drop:], self.old_values[drop:])
+        self.new_values = remap_values(self.new_kinds[drop:], self.new_values[drop:])
+        self.old_kinds = self.old_kinds[drop:]
+        self.new_kinds = self.new_kinds[drop:]
+        self.old_formulas = remap_ids(self.old_formulas[drop:])
+        self.new_formulas = remap_ids(self.new_formulas[drop:])
+        self.batches = remap_ids(self.batches[drop:])
+        self.actions = self.actions[drop:]
+        self.offsets = array("I")
+        self.block_starts = array("q")
+        self.block_times = array("d")
+        for position, ms in enumerate(times):
+            self.offsets.append(self._time_offset(ms / 1000.0, position))
+        self.base += drop
+        self._rebuild_indexes(old_strings)
+
+    def reindex(self) -> None:
+        # Rebuild the indexes after the arrays were loaded as a whole
+        # (persistence); the undo and redo stacks must already be set
+        self._rebuild_indexes(self.strings.strings)
+
+    def _rebuild_indexes(self, old_strings: List[str]) -> None:
+        base = self.base
+        self.by_cell = {}
+        self.by_user = {}
+        self.batch_ranges = {}
+        for i, (cell, user, batch) in enumerate(zip(self.cells, self.users, self.batches)):
+            self.by_cell.setdefault(cell, array("q")).append(base + i)
+            self.by_user.setdefault(user, array("q")).append(base + i)
+            if batch >= 0:
+                first, count = self.batch_ranges.get(batch, (base + i, 0))
+                self.batch_ranges[batch] = (first, count + 1)
+
+        def remap_stacks(stacks: Dict[int, List[Tuple[int, int]]]) -> Dict[int, List[Tuple[int, int]]]:
+            # Actions that lost entries to compaction can no longer be undone
+            kept = {}
+            for user, spans in stacks.items():
+                spans = [span for span in spans if span[0] >= base]
+                if spans:
+                    kept[self.strings.intern(old_strings[user])] = spans
+            return kept
+        self.undo_stacks = remap_stacks(self.undo_stacks)
+        self.redo_stacks = remap_stacks(self.redo_stacks)
+
+    # Reading
+
+    def _time_ms(self, position: int) -> float:
+        block = bisect.bisect_right(self.block_starts, position) - 1
+        return self.block_times[block] + self.offsets[position]
+
+    def _decode(self, kind: int, value: float) -> Value:
+        if kind == VALUE_NUMBER:
+            return value
+        if kind == VALUE_TEXT:
+            return self.strings.strings[int(value)]
+        return None
+
+    def _formula(self, string_id: int) -> Optional[str]:
+        return None if string_id < 0 else self.strings.strings[string_id]
+
+    def entry(self, seq: int) -> HistoryEntry:
+        i = seq - self.base
+        batch = self.batches[i]
+        row, col = divmod(self.cells[i], MAX_COLUMNS)
+        return HistoryEntry(
+            cell_ref=index_to_cell_ref(row, col),
+            old_value=self._decode(self.old_kinds[i], self.old_values[i]),
+            new_value=self._decode(self.new_kinds[i], self.new_values[i]),
+            user_id=self.strings.strings[self.users[i]],
+            timestamp=self._time_ms(i) / 1000.0,
+            batch_id=None if batch < 0 else self.strings.strings[batch],
+            old_formula=self._formula(self.old_formulas[i]),
+            new_formula=self._formula(self.new_formulas[i]),
+            action=ACTIONS[self.actions[i]],
+        )
+
+    def seqs(self, cell_ref: Optional[str] = None, user_id: Optional[str] = None,
+             since: Optional[float] = None, until: Optional[float] = None):
+        # Ascending seqs of the entries matching every given filter; the
+        # time window is [since, until) in seconds
+        user = self.strings.ids.get(user_id) if user_id is not None else None
+        if user_id is not None and user is None:
+            return []
+        if cell_ref is not None:
+            row, col = cell_ref_to_index(cell_ref)
+            candidates = self.by_cell.get(row * MAX_COLUMNS + col, ())
+        elif user is not None:
+            candidates = self.by_user.get(user, ())
+        else:
+            candidates = range(self.base, self.next_seq)
+        if since is not None or until is not None:
+            def time_of(seq):
+                return self._time_ms(seq - self.base)
+            lo = 0 if since is None else bisect.bisect_left(candidates, since * 1000.0, key=time_of)
+            hi = len(candidates) if until is None else bisect.bisect_left(candidates, until * 1000.0, key=time_of)
+            candidates = candidates[lo:hi]
+        if cell_ref is not None and user is not None:
+            candidates = [seq for seq in candidates if self.users[seq - self.base] == user]
+        return candidates
+
+    def query(self, cell_ref: Optional[str] = None, user_id: Optional[str] = None,
+              since: Optional[float] = None, until: Optional[float] = None,
+              limit: Optional[int] = None) -> List[HistoryEntry]:
+        # Matching entries, oldest first; with a limit, the newest `limit`
+        seqs = self.seqs(cell_ref, user_id, since, until)
+        if limit is not None:
+            seqs = seqs[max(len(seqs) - limit, 0):]
+        return [self.entry(seq) for seq in seqs]
+
+    def batch(self, batch_id: str) -> List[HistoryEntry]:
+        batch = self.strings.ids.get(batch_id)
+        if batch is None or batch not in self.batch_ranges:
+            return []
+        first, count = self.batch_ranges[batch]
+        return [self.entry(seq) for seq in range(first, first + count)]
+
+    def entries(self) -> Iterator[HistoryEntry]:
+        return (self.entry(seq) for seq in range(self.base, self.next_seq))
+
+    def pending(self, user_id: str, redo: bool = False) -> Optional[List[Change]]:
+        # The changes that undo (or redo) the user's last action, as
+        # (cell_ref, expected current value, value to write, expected current
+        # formula, formula to write), one per cell; None when there is nothing
+        # to undo. Logging them with action ACTION_UNDO / ACTION_REDO moves
+        # the action to the other stack, even when none were applied.
+        user = self.strings.ids.get(user_id or "")
+        stack = (self.redo_stacks if redo else self.undo_stacks).get(user)
+        if not stack:
+            return None
+        first, count = stack[-1]
+        changes: Dict[int, list] = {}
+        for seq in range(first, first + count):
+            i = seq - self.base
+            current = (self._decode(self.new_kinds[i], self.new_values[i]), self._formula(self.new_formulas[i]))
+            previous = (self._decode(self.old_kinds[i], self.old_values[i]), self._formula(self.old_formulas[i]))
+            cell = self.cells[i]
+            if cell in changes:
+                changes[cell][1] = current
+            else:
+                changes[cell] = [previous, current]
+        return [
+            (index_to_cell_ref(*divmod(cell, MAX_COLUMNS)), current[0], previous[0], current[1], previous[1])
+            for cell, (previous, current) in changes.items()
+        ]
+
+    def nbytes(self) -> int:
+        size = sum(len(values) * getattr(values, "itemsize", 1) for values in (
+            self.cells, self.users, self.offsets, self.old_kinds, self.old_values, self.old_formulas,
+            self.new_kinds, self.new_values, self.new_formulas, self.batches, self.actions))
+        size += 2 * self.strings.nbytes
+        # Index arrays, one seq per entry in each of the two indexes
+        return size + 16 * len(self.cells)
@@ -1,7 +1,11 @@
 from spreadsheet import SpreadsheetService
-from fastapi import FastAPI,WebSocket, WebSocketDisconnect, Request, Response
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI,WebSocket, WebSocketDisconnect, Request, Response, Body, Depends, HTTPException, Query
+from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from typing import Optional
+import asyncio
+import time
 import uvicorn
 import os
 import logging
@@ -11,8 +15,18 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from websocket_handler import ConnectionManager
+from filters import FILTER_ROW_LIMIT, parse_predicates, run_filter
+from formula import FormulaError, parse_range
+from snapshot import SNAPSHOT_PAGE_ROWS, build_snapshot, sheet_etag
 from comments import CommentService
+from comment_store import COMMENT_PAGE_SIZE
 from history import HistoryService
+from history_store import HISTORY_PAGE_SIZE
+from services import (cluster, comment_service, get_comment_service, get_history_service, get_spreadsheet_service,
+                      history_service, require_sheet_owner, sheet_locks, spreadsheet_service)
+from persistence import PersistenceEngine
+from residency import SHEET_IDLE_SECONDS, SHEET_MEMORY_BUDGET, SheetResidency
+import csv_handler
 from csv_handler import csv_router
 from auth import router as auth_router
 
@@ -54,6 +68,9 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
+# Compress larger responses (snapshots, exports) for clients that accept gzip
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # # Add OPTIONS handler for preflight requests
 # @app.options("/{full_path:path}")
 # async def options_handler(full_path: str):
@@ -62,19 +79,94 @@ app.add_middleware(
 app.include_router(csv_router, prefix="/api")
 app.include_router(auth_router, prefix="/api/auth")
 
-manager = ConnectionManager()
-comment_service = CommentService()
-history_service = HistoryService()
-spreadsheet_service = SpreadsheetService()
+# One set of services for every entry point; see services.py
+manager = ConnectionManager(spreadsheet_service, history_service, comment_service, sheet_locks, cluster)
+csv_handler.on_sheet_replaced = manager.sheet_replaced
+
+# Durable storage for the live sheets, history and comments; see persistence.py.
+# Opt-in: set DATA_DIR to a directory for the log and snapshots. Unset or
+# empty keeps everything in memory only, with no sheet eviction.
+DATA_DIR = os.environ.get("DATA_DIR", "")
+WAL_SYNC_INTERVAL = float(os.environ.get("WAL_SYNC_INTERVAL", "0.1"))
+CHECKPOINT_INTERVAL = float(os.environ.get("CHECKPOINT_INTERVAL", "300"))
+CHECKPOINT_WAL_BYTES = int(os.environ.get("CHECKPOINT_WAL_BYTES", str(64 * 1024 * 1024)))
+persistence = PersistenceEngine(DATA_DIR) if DATA_DIR else None
+# Sheets without clients are evicted to disk when over budget or idle; see
+# residency.py. Needs persistence.
+SHEET_MEMORY_BUDGET = int(os.environ.get("SHEET_MEMORY_BUDGET", SHEET_MEMORY_BUDGET))
+SHEET_IDLE_SECONDS = float(os.environ.get("SHEET_IDLE_SECONDS", SHEET_IDLE_SECONDS))
+RESIDENCY_INTERVAL = float(os.environ.get("RESIDENCY_INTERVAL", "5"))
+residency: Optional[SheetResidency] = None
+
+
+async def persistence_loop():
+    # fsync the log in batches, checkpoint when it is old or large and keep
+    # the resident sheets within budget
+    last_checkpoint = last_enforce = time.monotonic()
+    while True:
+        await asyncio.sleep(WAL_SYNC_INTERVAL)
+        persistence.sync()
+        if time.monotonic() - last_enforce >= RESIDENCY_INTERVAL:
+            evicted = residency.enforce()
+            last_enforce = time.monotonic()
+            if evicted:
+                logger.info(f"Evicted {len(evicted)} sheets to disk")
+        if persistence.dirty and (persistence.wal_bytes >= CHECKPOINT_WAL_BYTES
+                                  or time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL):
+            # Only capturing the sheets runs here; the snapshot files are
+            # written and fsynced in an executor
+            finish = persistence.start_checkpoint()
+            written = await asyncio.get_running_loop().run_in_executor(None, finish)
+            last_checkpoint = time.monotonic()
+            logger.info(f"Checkpoint wrote {written} sheet snapshots")
+
+
+@app.on_event("startup")
+async def start_cluster():
+    if cluster is not None:
+        await cluster.bus.start()
+        logger.info(f"Worker {cluster.worker_id} of {len(set(cluster.ring.owners))} joined the bus")
+
+
+@app.on_event("shutdown")
+async def stop_cluster():
+    if cluster is not None:
+        await cluster.bus.close()
+
+
+@app.on_event("startup")
+async def start_persistence():
+    global residency
+    if persistence is None:
+        return
+    persistence.attach(spreadsheet_service, history_service, comment_service)
+    started = time.monotonic()
+    # Sheets the log does not touch are loaded on first access
+    sheets, replayed = persistence.recover(load_all=False)
+    logger.info(f"Recovered {sheets} sheets and {replayed} log records "
+                f"in {time.monotonic() - started:.2f}s")
+    residency = SheetResidency(
+        persistence, SHEET_MEMORY_BUDGET, SHEET_IDLE_SECONDS,
+        pinned=lambda sheet_id: bool(manager.active_connections.get(sheet_id)),
+        on_evict=manager.collaboration_service.drop_sheet)
+    residency.attach()
+    app.state.persistence_task = asyncio.create_task(persistence_loop())
+
+
+@app.on_event("shutdown")
+async def stop_persistence():
+    if persistence is None:
+        return
+    app.state.persistence_task.cancel()
+    persistence.checkpoint()
+    persistence.close()
 
 
 @app.websocket("/ws/spreadsheet/{sheet_id}")
 async def websocket_endpoint(websocket: WebSocket, sheet_id: str):
     await manager.connect(websocket, sheet_id)
-    try:
-        await manager.receive(websocket, sheet_id)
-    except WebSocketDisconnect:
-        manager.disconnect(websocket, sheet_id)
+    # receive() disconnects the client however its loop ends
+    await manager.receive(websocket, sheet_id)
 
 @app.get("/")
 def root():
@@ -105,9 +197,17 @@ def simple_test():
     """Simplest possible test endpoint"""
     return {"status": "ok", "message": "Simple test endpoint working"}
 
-@app.get("/api/comments/{sheet_id}/{cell_ref}")
-async def get_comments(sheet_id: str, cell_ref: str):
-    comments = comment_service.get_comments(sheet_id, cell_ref)
+@app.get("/api/comments/{sheet_id}/{cell_ref}", dependencies=[Depends(require_sheet_owner)])
+async def get_comments(sheet_id: str, cell_ref: str, response: Response, cursor: Optional[str] = None,
+                       limit: int = COMMENT_PAGE_SIZE,
+                       comment_service: CommentService = Depends(get_comment_service)):
+    # One page of the cell's comments; the next page's cursor is in X-Next-Cursor
+    try:
+        comments, next_cursor = comment_service.list_comments(sheet_id, cell_ref, cursor=cursor, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
     return [
         {"comment_id": c.comment_id,
          "user_id": c.user_id,
@@ -117,14 +217,127 @@ async def get_comments(sheet_id: str, cell_ref: str):
         for c in comments
     ]
 
-@app.post("/api/comments/{sheet_id}/{cell_ref}/{user_id}")
-async def post_comment(sheet_id: str, cell_ref: str, user_id: str, text: str):
-    comment = comment_service.add_comment(sheet_id, cell_ref, user_id, text)
+@app.post("/api/comments/{sheet_id}/{cell_ref}/{user_id}", dependencies=[Depends(require_sheet_owner)])
+async def post_comment(sheet_id: str, cell_ref: str, user_id: str, text: str,
+                       comment_service: CommentService = Depends(get_comment_service)):
+    try:
+        comment = comment_service.add_comment(sheet_id, cell_ref, user_id, text)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {"comment_id": comment.comment_id, "text": comment.text}
 
 
-@app.get("/sheet/{sheet_id}/cell/{cell_ref}")
-def get_cell(sheet_id: str, cell_ref: str):
+def comment_json(comment) -> dict:
+    return {
+        "commentId": comment.comment_id,
+        "userId": comment.user_id,
+        "cellRef": comment.cell_ref,
+        "text": comment.text,
+        "timestamp": comment.timestamp,
+        "seq": comment.seq,
+    }
+
+
+@app.get("/api/sheet/{sheet_id}/comments", dependencies=[Depends(require_sheet_owner)])
+async def list_sheet_comments(sheet_id: str, cell: Optional[str] = None, user: Optional[str] = None,
+                              since: Optional[float] = None, until: Optional[float] = None,
+                              cursor: Optional[str] = None, limit: int = COMMENT_PAGE_SIZE,
+                              comment_service: CommentService = Depends(get_comment_service)):
+    # Sheet-wide comment listing, oldest first, filtered by cell, author and
+    # time window (epoch seconds); pass nextCursor back for the next page
+    try:
+        comments, next_cursor = comment_service.list_comments(sheet_id, cell, user, since, until, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"comments": [comment_json(c) for c in comments], "nextCursor": next_cursor}
+
+
+@app.get("/api/sheet/{sheet_id}/comments/markers", dependencies=[Depends(require_sheet_owner)])
+async def get_comment_markers(sheet_id: str, cell_range: str = Query(..., alias="range"),
+                              comment_service: CommentService = Depends(get_comment_service)):
+    # [cellRef, comment count] for the commented cells of a viewport
+    try:
+        area = parse_range(cell_range)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"markers": comment_service.get_markers(sheet_id, area)}
+
+
+@app.get("/api/sheet/{sheet_id}/comments/changes", dependencies=[Depends(require_sheet_owner)])
+async def get_comment_changes(sheet_id: str, since: int = 0,
+                              comment_service: CommentService = Depends(get_comment_service)):
+    # Comments added, edited or deleted after seq `since`; "reload" means the
+    # feed no longer goes back that far and the client should list them again
+    changes, seq = comment_service.changes_since(sheet_id, since)
+    if changes is None:
+        return {"seq": seq, "reload": True, "changes": []}
+    return {
+        "seq": seq,
+        "reload": False,
+        "changes": [comment_json(comment) if comment is not None
+                    else {"commentId": comment_id, "seq": change_seq, "deleted": True}
+                    for change_seq, comment_id, comment in changes],
+    }
+
+
+@app.get("/api/sheet/{sheet_id}/comments/{comment_id}", dependencies=[Depends(require_sheet_owner)])
+async def get_sheet_comment(sheet_id: str, comment_id: str,
+                            comment_service: CommentService = Depends(get_comment_service)):
+    comment = comment_service.get_comment(sheet_id, comment_id)
+    if comment is None:
+        raise HTTPException(status_code=404, detail="Comment not found")
+    return comment_json(comment)
+
+
+@app.patch("/api/sheet/{sheet_id}/comments/{comment_id}", dependencies=[Depends(require_sheet_owner)])
+async def edit_sheet_comment(sheet_id: str, comment_id: str, payload: dict = Body(...),
+                             comment_service: CommentService = Depends(get_comment_service)):
+    # {"text": ...}; connected clients get a comment_edited message
+    comment = comment_service.edit_comment(sheet_id, comment_id, payload.get("text", ""))
+    if comment is None:
+        raise HTTPException(status_code=404, detail="Comment not found")
+    await manager.publish_comment(sheet_id, "comment_edited", comment)
+    return comment_json(comment)
+
+
+@app.delete("/api/sheet/{sheet_id}/comments/{comment_id}", dependencies=[Depends(require_sheet_owner)])
+async def delete_sheet_comment(sheet_id: str, comment_id: str,
+                               comment_service: CommentService = Depends(get_comment_service)):
+    comment = comment_service.delete_comment(sheet_id, comment_id)
+    if comment is None:
+        raise HTTPException(status_code=404, detail="Comment not found")
+    await manager.publish_comment(sheet_id, "comment_deleted", comment)
+    return {"commentId": comment_id, "deleted": True}
+
+
+@app.get("/api/sheet/{sheet_id}/snapshot", dependencies=[Depends(require_sheet_owner)])
+async def get_snapshot(sheet_id: str, request: Request, cell_range: Optional[str] = Query(None, alias="range"),
+                       page: int = 0, page_rows: int = SNAPSHOT_PAGE_ROWS, fmt: str = Query("rows", alias="format"),
+                       spreadsheet_service: SpreadsheetService = Depends(get_spreadsheet_service)):
+    # Paged bulk read of a block of cells; see snapshot.py for the payload
+    sheet = spreadsheet_service.get_or_create_sheet(sheet_id)
+    etag = sheet_etag(sheet)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    try:
+        area = parse_range(cell_range) if cell_range else None
+        snapshot = build_snapshot(sheet, area, page, page_rows, fmt)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(snapshot, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+@app.get("/api/metrics/sheets")
+async def sheet_metrics():
+    # Memory use of the resident sheets and eviction counters
+    if residency is None:
+        raise HTTPException(status_code=404, detail="Sheet residency is disabled")
+    return residency.metrics()
+
+
+@app.get("/sheet/{sheet_id}/cell/{cell_ref}", dependencies=[Depends(require_sheet_owner)])
+async def get_cell(sheet_id: str, cell_ref: str,
+                   spreadsheet_service: SpreadsheetService = Depends(get_spreadsheet_service)):
     # Fetch a cell value for test purposes
     cell = spreadsheet_service.get_cell_value(sheet_id, cell_ref)
     return {
@@ -136,6 +349,78 @@ def get_cell(sheet_id: str, cell_ref: str):
     }
 
 
+@app.post("/api/sheet/{sheet_id}/cells", dependencies=[Depends(require_sheet_owner)])
+async def update_cells(sheet_id: str, payload: dict = Body(...)):
+    # Bulk edit: {"userId": ..., "edits": [{"cellRef", "value", "formula"}, ...]}
+    try:
+        return await manager.apply_cells_update(sheet_id, payload.get("edits", []), payload.get("userId"))
+    except (ValueError, FormulaError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/api/sheet/{sheet_id}/sort", dependencies=[Depends(require_sheet_owner)])
+async def sort_sheet(sheet_id: str, payload: dict = Body(...)):
+    # {"userId": ..., "keys": [{"column": "B", "ascending": false}, ...],
+    #  "startRow": 2, "endRow": 500}: reorder whole rows, first key first
+    try:
+        start_row = payload.get("startRow")
+        end_row = payload.get("endRow")
+        return await manager.sort_rows(sheet_id, payload.get("keys", []), payload.get("userId"),
+                                       None if start_row is None else int(start_row),
+                                       None if end_row is None else int(end_row))
+    except (TypeError, ValueError, FormulaError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/api/sheet/{sheet_id}/filter", dependencies=[Depends(require_sheet_owner)])
+async def filter_sheet(sheet_id: str, payload: dict = Body(...),
+                       spreadsheet_service: SpreadsheetService = Depends(get_spreadsheet_service)):
+    # {"where": [{"column": "C", "op": ">", "value": 100}, ...],
+    #  "format": "rows" | "bitmap", "limit": ...}; see filters.py. On the
+    # event loop, since building masks updates the column's mask cache.
+    try:
+        predicates = parse_predicates(payload.get("where"))
+        return run_filter(spreadsheet_service.get_or_create_sheet(sheet_id), predicates,
+                          payload.get("format", "rows"), int(payload.get("limit", FILTER_ROW_LIMIT)))
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/api/sheet/{sheet_id}/history", dependencies=[Depends(require_sheet_owner)])
+async def get_sheet_history(sheet_id: str, cell: Optional[str] = None, user: Optional[str] = None,
+                            since: Optional[float] = None, until: Optional[float] = None, limit: int = 1000,
+                            history_service: HistoryService = Depends(get_history_service)):
+    # Edit log filtered by cell, user and time window (epoch seconds), oldest first
+    if not 1 <= limit <= HISTORY_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {HISTORY_PAGE_SIZE}")
+    entries = history_service.query(sheet_id, cell, user, since, until, limit)
+    return [
+        {"cellRef": entry.cell_ref,
+         "oldValue": entry.old_value,
+         "newValue": entry.new_value,
+         "oldFormula": entry.old_formula,
+         "newFormula": entry.new_formula,
+         "userId": entry.user_id,
+         "timestamp": entry.timestamp,
+         "batchId": entry.batch_id,
+         "action": entry.action}
+        for entry in entries
+    ]
+
+
+@app.post("/api/sheet/{sheet_id}/undo", dependencies=[Depends(require_sheet_owner)])
+async def undo(sheet_id: str, payload: dict = Body(...)):
+    # {"userId": ..., "redo": false}: undo (or redo) the user's last edit
+    redo = bool(payload.get("redo"))
+    try:
+        applied = await manager.apply_undo(sheet_id, payload.get("userId"), redo)
+    except (ValueError, FormulaError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if applied is None:
+        raise HTTPException(status_code=409, detail=f"Nothing to {'redo' if redo else 'undo'}")
+    return applied
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
     host = os.environ.get("HOST", "0.0.0.0")
@@ -1,6 +1,10 @@
-from typing import Optional, Dict, List, Union
+from typing import Optional, Dict, Iterator, List, Union
+from collections.abc import MutableMapping
 from dataclasses import dataclass, field
 from enum import Enum
+from dependency_graph import DependencyGraph
+from storage import ColumnStore, KIND_TEXT, KIND_NUMBER, KIND_DATE, KIND_FORMULA
+from utils import cell_ref_to_index, index_to_cell_ref
 
 class CellType(str, Enum):
     TEXT = "text"
@@ -15,11 +19,71 @@ class Cell:
     cell_type: CellType = CellType.TEXT
     version: int = 0
 
+_KIND_BY_TYPE = {
+    CellType.TEXT: KIND_TEXT,
+    CellType.NUMBER: KIND_NUMBER,
+    CellType.DATE: KIND_DATE,
+    CellType.FORMULA: KIND_FORMULA,
+}
+_TYPE_BY_KIND = {kind: cell_type for cell_type, kind in _KIND_BY_TYPE.items()}
+
+
+class CellsView(MutableMapping):
+    # Dict-like view keyed by A1 refs over a ColumnStore. Cells are built on
+    # access, so changes to a returned Cell must be written back with
+    # `cells[ref] = cell`.
+
+    def __init__(self, store: ColumnStore):
+        self.store = store
+
+    def _coords(self, cell_ref):
+        try:
+            return cell_ref_to_index(cell_ref)
+        except (TypeError, ValueError):
+            raise KeyError(cell_ref)
+
+    def __getitem__(self, cell_ref: str) -> Cell:
+        entry = self.store.get(*self._coords(cell_ref))
+        if entry is None:
+            raise KeyError(cell_ref)
+        value, formula, kind, version = entry
+        return Cell(value=value, formula=formula, cell_type=_TYPE_BY_KIND[kind], version=version)
+
+    def __setitem__(self, cell_ref: str, cell: Cell) -> None:
+        row, col = cell_ref_to_index(cell_ref)
+        self.store.set(row, col, cell.value, cell.formula, _KIND_BY_TYPE[cell.cell_type], cell.version)
+
+    def __delitem__(self, cell_ref: str) -> None:
+        if not self.store.delete(*self._coords(cell_ref)):
+            raise KeyError(cell_ref)
+
+    def __contains__(self, cell_ref) -> bool:
+        try:
+            return self.store.get(*self._coords(cell_ref)) is not None
+        except KeyError:
+            return False
+
+    def __iter__(self) -> Iterator[str]:
+        for row, col in self.store.cells():
+            yield index_to_cell_ref(row, col)
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def clear(self) -> None:
+        self.store.clear()
+
+
 @dataclass
 class Spreadsheet:
-    cells: Dict[str, Cell] = field(default_factory=dict)
+    store: ColumnStore = field(default_factory=ColumnStore)
     rows: int = 100
     columns: int = 25  # Change from 26 to 25 to allow adding one more column
+    dependencies: DependencyGraph = field(default_factory=DependencyGraph)
+
+    @property
+    def cells(self) -> CellsView:
+        return CellsView(self.store)
 
 @dataclass
 class User:
@@ -34,6 +98,8 @@ class Comment:
     cell_ref: str
     text: str
     timestamp: float
+    # Change seq of the last add or edit; see comment_store.py
+    seq: int = 0
 
 @dataclass
 class HistoryEntry:
@@ -42,3 +108,10 @@ class HistoryEntry:
     new_value: Optional[Union[str, float]]
     user_id: str
     timestamp: float
+    # Set on every entry of a batch edit (paste, fill-down)
+    batch_id: Optional[str] = None
+    # Formulas before and after, for edits of formula cells
+    old_formula: Optional[str] = None
+    new_formula: Optional[str] = None
+    # "edit", or "undo"/"redo" for entries written by an undo or redo
+    action: str = "edit"
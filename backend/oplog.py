@@ -0,0 +1,83 @@
+import uuid
+from collections import deque
+from itertools import islice
+from typing import Deque, Dict, List, Optional
+
+# Per-sheet operation log. Every state-changing broadcast (cell edits, batch
+# edits, comments) is stamped with the sheet's next sequence number and kept
+# in a bounded in-memory ring. A client that reconnects sends the last seq it
+# applied and gets the ops it missed, or is told to reload from a snapshot
+# when they have already been dropped from the ring. Clients ignore ops with
+# a seq they have already applied, so a resync racing live broadcasts is
+# harmless.
+#
+# Seqs only mean something within one log: a restart or a dropped log (an
+# evicted sheet) starts counting from 1 again. So each sheet's log gets a
+# random epoch, stamped on every op next to the seq, and a resync has to name
+# the epoch its seq came from. An op that replaces the whole sheet (a CSV
+# import) is a barrier: clients from before it reload from a snapshot.
+
+OPLOG_CAPACITY = 10000
+
+
+class OperationLog:
+    def __init__(self, capacity: int = OPLOG_CAPACITY):
+        self.capacity = capacity
+        self.ops: Dict[str, Deque[dict]] = {}
+        self.last_seq: Dict[str, int] = {}
+        self.epochs: Dict[str, str] = {}
+        # Seq of the sheet's last sheet_replaced op
+        self.barriers: Dict[str, int] = {}
+
+    def epoch(self, sheet_id: str) -> str:
+        epoch = self.epochs.get(sheet_id)
+        if epoch is None:
+            epoch = self.epochs[sheet_id] = uuid.uuid4().hex[:12]
+        return epoch
+
+    def append(self, sheet_id: str, message: dict) -> int:
+        # Stamps message["seq"] and message["epoch"] and returns the seq
+        seq = self.last_seq.get(sheet_id, 0) + 1
+        self.last_seq[sheet_id] = seq
+        message["seq"] = seq
+        message["epoch"] = self.epoch(sheet_id)
+        ops = self.ops.get(sheet_id)
+        if ops is None:
+            ops = self.ops[sheet_id] = deque(maxlen=self.capacity)
+        ops.append(message)
+        return seq
+
+    def replace(self, sheet_id: str, message: dict) -> int:
+        # Append an op after which earlier seqs can no longer be replayed
+        seq = self.append(sheet_id, message)
+        self.barriers[sheet_id] = seq
+        return seq
+
+    def drop(self, sheet_id: str) -> None:
+        # Forget the sheet's log (an evicted sheet). Its next op starts a log
+        # with a new epoch, so clients of this one reload from a snapshot.
+        self.ops.pop(sheet_id, None)
+        self.last_seq.pop(sheet_id, None)
+        self.epochs.pop(sheet_id, None)
+        self.barriers.pop(sheet_id, None)
+
+    def current(self, sheet_id: str) -> int:
+        return self.last_seq.get(sheet_id, 0)
+
+    def since(self, sheet_id: str, seq: int, epoch: Optional[str] = None) -> Optional[List[dict]]:
+        # Ops after `seq` of log `epoch`, or None when they cannot all be
+        # replayed: some were dropped from the ring, `seq` is from another
+        # log (e.g. before a restart) or the sheet was replaced since. A
+        # client that has seen no op yet sends seq 0 and no epoch.
+        current = self.current(sheet_id)
+        if seq < 0 or seq > current or seq < self.barriers.get(sheet_id, 0):
+            return None
+        if seq and epoch != self.epoch(sheet_id):
+            return None
+        if seq == current:
+            return []
+        ops = self.ops.get(sheet_id)
+        if not ops or ops[0]["seq"] > seq + 1:
+            return None
+        # Seqs are contiguous, so the wanted ops are the last current - seq
+        return list(islice(ops, len(ops) - (current - seq), None))
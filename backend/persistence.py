@@ -0,0 +1,468 @@
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from itertools import accumulate, chain
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import quote, unquote
+from history_store import HistoryStore
+from models import Spreadsheet
+from storage import Column, ColumnStore, StringTable
+
+# Local durability for sheets, history and comments.
+#
+# Write-ahead log: every change the services make is reported through their
+# `journal` hook and appended to `wal.log` as one record
+#     u32 payload length | u32 crc32 of payload | JSON payload
+# where the payload is {"lsn": n, "s": service, "m": method, "a": args} and
+# replaying means calling service.m(*args). Appends go to a buffered file;
+# `sync()` flushes and fsyncs, so many edits share one fsync. A crash loses
+# at most the records written since the last sync, and a torn or corrupt
+# record ends replay.
+#
+# Snapshots: a checkpoint writes every sheet changed since the previous
+# checkpoint to `sheets/<sheet id>.snap` and then drops the log.
+#     magic | u64 lsn | u32 header length | header JSON | sections
+# The header holds the sheet's small state (sizes, formulas, undo stacks) and
+# the offset and length of every raw array section: the sheet's columns (kinds,
+# numbers, numeric mask, text ids, versions) and row map, the history log's
+# columns (see history_store.py) and the comments as one column per field.
+# String tables and string columns are two sections, u64 end offsets and the
+# UTF-8 text. Sections start on 8-byte boundaries, so the file can be mapped
+# and each array read straight out of the mapping. A snapshot is written to a
+# temporary file and renamed over the old one, so a crash mid-checkpoint
+# leaves the previous snapshot in place.
+#
+# A checkpoint is split so the slow part stays off the event loop:
+# `start_checkpoint()` copies the dirty sheets' arrays and moves the log to
+# `wal.old` (new records go to a fresh `wal.log`), and the job it returns
+# writes and fsyncs the snapshot files and then deletes `wal.old`; it touches
+# no service state and can run in an executor. `checkpoint()` runs both halves
+# on the calling thread.
+#
+# Recovery loads the snapshots (all of them, or only those of sheets the log
+# touches when sheets are loaded on demand, see residency.py), then replays
+# the records of `wal.old` and `wal.log` whose lsn is newer than the snapshot
+# of the sheet they touch.
+
+SNAPSHOT_MAGIC = b"SHSNAP02"
+_RECORD = struct.Struct("<II")
+_SNAPSHOT_PREFIX = struct.Struct("<8sQI")
+_COLUMN_ARRAYS = ("kinds", "numbers", "numeric", "text", "versions")
+_HISTORY_ARRAYS = ("cells", "users", "offsets", "old_kinds", "old_values", "old_formulas", "new_kinds",
+                   "new_values", "new_formulas", "batches", "actions", "block_starts", "block_times")
+_COMMENT_STRINGS = ("comment_id", "user_id", "cell_ref", "text")
+
+# (sheet id, lsn, file contents) of a snapshot captured but not yet written
+Capture = Tuple[str, int, List[bytes]]
+
+
+def _string_table(strings: List[str]) -> StringTable:
+    table = StringTable()
+    table.strings = strings
+    table.ids = {text: i for i, text in enumerate(strings)}
+    table.nbytes = sum(map(sys.getsizeof, strings))
+    return table
+
+
+class PersistenceError(Exception):
+    pass
+
+
+class PersistenceEngine:
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+        self.sheets_dir = os.path.join(data_dir, "sheets")
+        self.wal_path = os.path.join(data_dir, "wal.log")
+        self.old_wal_path = os.path.join(data_dir, "wal.old")
+        os.makedirs(self.sheets_dir, exist_ok=True)
+        self.services: Dict[str, object] = {}
+        self.lsn = 0
+        self.synced_lsn = 0
+        self.wal_bytes = 0
+        # Sheets changed since their last snapshot
+        self.dirty: Set[str] = set()
+        self._wal = None
+        # Held from start_checkpoint until its job is done
+        self._checkpoint_lock = threading.Lock()
+        # Held while a snapshot file is written, by the loop or an executor
+        self._write_lock = threading.Lock()
+
+    def attach(self, spreadsheets, history, comments) -> None:
+        self.services = {"sheets": spreadsheets, "history": history, "comments": comments}
+        for name, service in self.services.items():
+            service.journal = self._journal_for(name)
+
+    def detach(self) -> None:
+        for service in self.services.values():
+            service.journal = None
+
+    def _journal_for(self, name: str):
+        def journal(method: str, args: list) -> None:
+            self.append(name, method, args)
+        return journal
+
+    def _open_wal(self):
+        if self._wal is None:
+            self._wal = open(self.wal_path, "ab")
+            self.wal_bytes = self._wal.tell()
+        return self._wal
+
+    def append(self, service: str, method: str, args: list) -> int:
+        self.lsn += 1
+        payload = json.dumps({"lsn": self.lsn, "s": service, "m": method, "a": args},
+                             separators=(",", ":")).encode()
+        wal = self._open_wal()
+        wal.write(_RECORD.pack(len(payload), zlib.crc32(payload)))
+        wal.write(payload)
+        self.wal_bytes += _RECORD.size + len(payload)
+        self.dirty.add(args[0])
+        return self.lsn
+
+    def sync(self) -> None:
+        if self._wal is None or self.synced_lsn == self.lsn:
+            return
+        self._wal.flush()
+        os.fsync(self._wal.fileno())
+        self.synced_lsn = self.lsn
+
+    def close(self) -> None:
+        self.sync()
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+
+    # Snapshots
+
+    def start_checkpoint(self) -> Callable[[], int]:
+        # Capture the dirty sheets and start a new log, on the thread that
+        # owns the services. Returns the job that writes the snapshots and
+        # drops the old log, which returns the sheets written; it may run on
+        # another thread. Starting a checkpoint waits for the previous job.
+        self._checkpoint_lock.acquire()
+        try:
+            self.sync()
+            captured = [self._capture(sheet_id) for sheet_id in self.dirty]
+            self._rotate_wal()
+        except BaseException:
+            self._checkpoint_lock.release()
+            raise
+        dirty, self.dirty = self.dirty, set()
+
+        def finish() -> int:
+            try:
+                for capture in captured:
+                    self._write_file(*capture)
+                if os.path.exists(self.old_wal_path):
+                    os.remove(self.old_wal_path)
+                    self._fsync_dir(self.data_dir)
+            except BaseException:
+                # Snapshot them again next time; wal.old is kept until then
+                self.dirty.update(dirty)
+                raise
+            finally:
+                self._checkpoint_lock.release()
+            return len(captured)
+        return finish
+
+    def checkpoint(self) -> int:
+        # Snapshot the dirty sheets and start a new log; returns sheets written
+        return self.start_checkpoint()()
+
+    def _rotate_wal(self) -> None:
+        # Move the log's records to wal.old, where they stay until the
+        # checkpoint's snapshots are on disk, and start an empty log. A
+        # wal.old left by a checkpoint that failed is appended to instead.
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+        if os.path.exists(self.wal_path):
+            if os.path.exists(self.old_wal_path):
+                with open(self.wal_path, "rb") as src, open(self.old_wal_path, "ab") as dst:
+                    shutil.copyfileobj(src, dst)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+            else:
+                os.replace(self.wal_path, self.old_wal_path)
+        with open(self.wal_path, "wb") as wal:
+            os.fsync(wal.fileno())
+        self._fsync_dir(self.data_dir)
+        self.wal_bytes = 0
+
+    def _snapshot_path(self, sheet_id: str) -> str:
+        return os.path.join(self.sheets_dir, quote(sheet_id, safe="") + ".snap")
+
+    def write_snapshot(self, sheet_id: str) -> None:
+        self._write_file(*self._capture(sheet_id))
+
+    def _capture(self, sheet_id: str) -> Capture:
+        # The snapshot file's contents. Sections are copies, so later edits
+        # do not reach a snapshot that is still being written.
+        sheet = self.services["sheets"].spreadsheets.get(sheet_id)
+        log = self.services["history"].logs.get(sheet_id)
+        comment_store = self.services["comments"].comments.get(sheet_id)
+        header = {"byteorder": sys.byteorder, "sheet": None, "history": None, "comments": None}
+        sections: List[bytes] = []
+        offset = 0
+
+        def section(values) -> List[int]:
+            nonlocal offset
+            data = bytes(values)
+            padding = -len(data) % 8
+            sections.append(data + bytes(padding))
+            start = offset
+            offset += len(data) + padding
+            return [start, len(data)]
+
+        def string_section(strings) -> Dict[str, List[int]]:
+            encoded = [text.encode("utf-8", "surrogatepass") for text in strings]
+            return {"ends": section(array("q", accumulate(map(len, encoded)))), "data": section(b"".join(encoded))}
+
+        if sheet is not None:
+            store = sheet.store
+            header["sheet"] = {
+                "rows": sheet.rows,
+                "columns": sheet.columns,
+                "strings": string_section(store.strings.strings),
+                "formulas": [[row, col, formula] for (row, col), formula in store.formulas.items()],
+                "cell_count": store.cell_count,
+                "physical_rows": store.physical_rows,
+                "free_rows": store.free_rows,
+                "revision": store.revision,
+                "row_map": None if store.row_map is None else section(store.row_map),
+                "column_data": [
+                    None if column is None else {name: section(getattr(column, name)) for name in _COLUMN_ARRAYS}
+                    for column in store.columns
+                ],
+            }
+        if log is not None:
+            header["history"] = {
+                "base": log.base,
+                "strings": string_section(log.strings.strings),
+                "undo": [[user, spans] for user, spans in log.undo_stacks.items()],
+                "redo": [[user, spans] for user, spans in log.redo_stacks.items()],
+                "arrays": {name: section(getattr(log, name)) for name in _HISTORY_ARRAYS},
+            }
+        if comment_store is not None:
+            comments = list(comment_store.all())
+            header["comments"] = {
+                "fields": {name: string_section([getattr(c, name) for c in comments]) for name in _COMMENT_STRINGS},
+                "timestamps": section(array("d", (c.timestamp for c in comments))),
+                "seqs": section(array("q", (c.seq for c in comments))),
+            }
+
+        encoded = json.dumps(header, separators=(",", ":")).encode()
+        prefix = _SNAPSHOT_PREFIX.pack(SNAPSHOT_MAGIC, self.lsn, len(encoded))
+        head = prefix + encoded
+        head += bytes(-len(head) % 8)
+        return sheet_id, self.lsn, [head] + sections
+
+    def _write_file(self, sheet_id: str, lsn: int, chunks: List[bytes]) -> None:
+        # Write a captured snapshot; file I/O only, safe on any thread. A
+        # newer snapshot already on disk (an eviction while a checkpoint was
+        # writing) is kept.
+        path = self._snapshot_path(sheet_id)
+        with self._write_lock:
+            if os.path.exists(path) and self.snapshot_lsn(sheet_id) > lsn:
+                return
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                for data in chunks:
+                    f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+            self._fsync_dir(self.sheets_dir)
+
+    @staticmethod
+    def _fsync_dir(path: str) -> None:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def load_snapshot(self, path: str) -> Tuple[int, Optional[Spreadsheet], Optional[HistoryStore], List[tuple]]:
+        # Returns (lsn, sheet or None, history log or None, comments as
+        # Comment field tuples)
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            magic, lsn, header_length = _SNAPSHOT_PREFIX.unpack_from(mapped)
+            if magic != SNAPSHOT_MAGIC:
+                raise PersistenceError(f"Not a sheet snapshot: {path}")
+            start = _SNAPSHOT_PREFIX.size
+            header = json.loads(mapped[start:start + header_length])
+            base = start + header_length
+            base += -base % 8
+
+            view = memoryview(mapped)
+            swap = header["byteorder"] != sys.byteorder
+
+            def load(target, location):
+                offset, length = location
+                data = view[base + offset:base + offset + length]
+                if isinstance(target, bytearray):
+                    target.extend(data)
+                else:
+                    target.frombytes(data)
+                    if swap:
+                        target.byteswap()
+                data.release()
+                return target
+
+            def load_strings(location) -> List[str]:
+                ends = load(array("q"), location["ends"])
+                offset, length = location["data"]
+                data = mapped[base + offset:base + offset + length]
+                return [data[start:end].decode("utf-8", "surrogatepass") for start, end in zip(chain((0,), ends), ends)]
+
+            sheet = None
+            info = header["sheet"]
+            if info is not None:
+                store = ColumnStore()
+                store.strings = _string_table(load_strings(info["strings"]))
+                store.formulas = {(row, col): formula for row, col, formula in info["formulas"]}
+                store.cell_count = info["cell_count"]
+                store.physical_rows = info["physical_rows"]
+                store.free_rows = info["free_rows"]
+                store.revision = info["revision"]
+                if info["row_map"] is not None:
+                    store.row_map = load(array("q"), info["row_map"])
+                for locations in info["column_data"]:
+                    if locations is None:
+                        store.columns.append(None)
+                        continue
+                    column = Column()
+                    for name in _COLUMN_ARRAYS:
+                        load(getattr(column, name), locations[name])
+                    store.columns.append(column)
+                sheet = Spreadsheet(store=store, rows=info["rows"], columns=info["columns"])
+
+            log = None
+            info = header["history"]
+            if info is not None:
+                log = HistoryStore()
+                log.base = info["base"]
+                log.strings = _string_table(load_strings(info["strings"]))
+                for name in _HISTORY_ARRAYS:
+                    load(getattr(log, name), info["arrays"][name])
+                log.undo_stacks = {user: [tuple(span) for span in spans] for user, spans in info["undo"]}
+                log.redo_stacks = {user: [tuple(span) for span in spans] for user, spans in info["redo"]}
+                log.reindex()
+
+            comments: List[tuple] = []
+            info = header["comments"]
+            if info is not None:
+                fields = [load_strings(info["fields"][name]) for name in _COMMENT_STRINGS]
+                fields.append(load(array("d"), info["timestamps"]))
+                fields.append(load(array("q"), info["seqs"]))
+                comments = list(zip(*fields))
+            view.release()
+        return lsn, sheet, log, comments
+
+    # Recovery
+
+    def _records(self) -> Iterator[dict]:
+        # Valid log records in lsn order: those of wal.old (a checkpoint that
+        # did not finish) and then wal.log. Records seen already, copied into
+        # wal.old by a checkpoint that stopped before emptying wal.log, are
+        # skipped.
+        last = 0
+        for path in (self.old_wal_path, self.wal_path):
+            for record in self._read_log(path):
+                if record["lsn"] > last:
+                    last = record["lsn"]
+                    yield record
+
+    @staticmethod
+    def _read_log(path: str) -> Iterator[dict]:
+        # A torn or corrupt tail is cut off so new records are not appended
+        # after garbage.
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        position = 0
+        while position + _RECORD.size <= len(data):
+            length, crc = _RECORD.unpack_from(data, position)
+            payload = data[position + _RECORD.size:position + _RECORD.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            try:
+                record = json.loads(payload)
+            except ValueError:
+                break
+            yield record
+            position += _RECORD.size + length
+        if position < len(data):
+            with open(path, "r+b") as f:
+                f.truncate(position)
+
+    def snapshot_ids(self) -> List[str]:
+        return [unquote(name[:-len(".snap")]) for name in os.listdir(self.sheets_dir) if name.endswith(".snap")]
+
+    def has_snapshot(self, sheet_id: str) -> bool:
+        return os.path.exists(self._snapshot_path(sheet_id))
+
+    def snapshot_lsn(self, sheet_id: str) -> int:
+        with open(self._snapshot_path(sheet_id), "rb") as f:
+            return _SNAPSHOT_PREFIX.unpack(f.read(_SNAPSHOT_PREFIX.size))[1]
+
+    def load_sheet(self, sheet_id: str) -> Optional[int]:
+        # Restore a sheet, its history and its comments from the snapshot
+        # into the attached services; returns the snapshot lsn, or None when
+        # the sheet has no snapshot
+        path = self._snapshot_path(sheet_id)
+        if not os.path.exists(path):
+            return None
+        lsn, sheet, log, comments = self.load_snapshot(path)
+        if sheet is not None:
+            self.services["sheets"].restore_sheet(sheet_id, sheet)
+        if log is not None:
+            self.services["history"].restore_log(sheet_id, log)
+        if comments:
+            self.services["comments"].restore_comments(sheet_id, comments)
+        return lsn
+
+    def recover(self, load_all: bool = True) -> Tuple[int, int]:
+        # Load snapshots and replay the log into the attached services, which
+        # should be empty. With load_all False only the sheets the log touches
+        # are loaded; the rest stay on disk until load_sheet is called for
+        # them. Returns (sheets loaded, records replayed).
+        records = list(self._records())
+        logged = {record["a"][0] for record in records}
+        snapshot_lsn: Dict[str, int] = {}
+        loaded = 0
+        for sheet_id in self.snapshot_ids():
+            if load_all or sheet_id in logged:
+                snapshot_lsn[sheet_id] = self.load_sheet(sheet_id)
+                loaded += 1
+            else:
+                snapshot_lsn[sheet_id] = self.snapshot_lsn(sheet_id)
+        self.lsn = max(snapshot_lsn.values(), default=0)
+
+        replayed = 0
+        services = self.services
+        self.detach()
+        try:
+            for record in records:
+                self.lsn = max(self.lsn, record["lsn"])
+                sheet_id = record["a"][0]
+                if record["lsn"] <= snapshot_lsn.get(sheet_id, 0):
+                    continue
+                getattr(services[record["s"]], record["m"])(*record["a"])
+                self.dirty.add(sheet_id)
+                replayed += 1
+        finally:
+            self.attach(services["sheets"], services["history"], services["comments"])
+        self.synced_lsn = self.lsn
+        return loaded, replayed
@@ -0,0 +1,108 @@
+import asyncio
+import time
+from itertools import count
+from typing import Any, Callable, Dict, Hashable, List, Optional
+from models import User
+
+# Presence channel. Cursor moves and join/leave events are recorded as they
+# arrive and published on a fixed tick (PRESENCE_HZ per second) instead of
+# one broadcast per event:
+#   - one "cursor_batch" message per tick holding only the cursors that moved
+#     since the previous tick, latest position per user
+#   - at most one "user_presence" user list per tick, however many users
+#     joined or left in between
+# Both go out as transient fan-out messages, so they queue behind cell edits
+# and are the first thing dropped for a client that falls behind. A dropped
+# batch leaves that client with a stale cursor until the user moves again.
+
+PRESENCE_HZ = 20.0
+
+Publish = Callable[[str, dict, Optional[Hashable]], Any]
+
+
+class PresenceHub:
+    def __init__(self, publish: Publish, users: Callable[[str], List[User]], hz: float = PRESENCE_HZ):
+        self.publish = publish
+        self.users = users
+        self.interval = 1.0 / hz
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        self.sent: Dict[str, Dict[str, Any]] = {}
+        self.last_active: Dict[str, Dict[str, int]] = {}
+        self.members_dirty: set = set()
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._batch_ids = count()
+
+    def update_cursor(self, sheet_id: str, user_id: str, position: Any) -> None:
+        self.pending.setdefault(sheet_id, {})[user_id] = position
+        self._touch(sheet_id, user_id)
+        self._schedule(sheet_id)
+
+    def members_changed(self, sheet_id: str, user_id: Optional[str] = None) -> None:
+        if user_id is not None:
+            self._touch(sheet_id, user_id)
+        self.members_dirty.add(sheet_id)
+        self._schedule(sheet_id)
+
+    def remove_user(self, sheet_id: str, user_id: str) -> None:
+        for state in (self.pending, self.sent, self.last_active):
+            state.get(sheet_id, {}).pop(user_id, None)
+        self.members_changed(sheet_id)
+
+    def _touch(self, sheet_id: str, user_id: str) -> None:
+        self.last_active.setdefault(sheet_id, {})[user_id] = int(time.time() * 1000)
+
+    def users_message(self, sheet_id: str) -> dict:
+        last_active = self.last_active.get(sheet_id, {})
+        return {
+            "type": "user_presence",
+            "users": [
+                {
+                    "userId": u.user_id,
+                    "username": u.username,
+                    "color": u.color,
+                    "status": "online",
+                    "lastActive": last_active.get(u.user_id, 0),
+                } for u in self.users(sheet_id)
+            ],
+        }
+
+    def tick(self, sheet_id: str) -> int:
+        # Publish what changed since the last tick; returns the number of
+        # messages sent, 0 when the sheet was idle
+        published = 0
+        if sheet_id in self.members_dirty:
+            self.members_dirty.discard(sheet_id)
+            self.publish(sheet_id, self.users_message(sheet_id), ("presence", "users"))
+            published += 1
+        pending = self.pending.pop(sheet_id, None)
+        if pending:
+            sent = self.sent.setdefault(sheet_id, {})
+            cursors = []
+            for user_id, position in pending.items():
+                if sent.get(user_id) != position:
+                    sent[user_id] = position
+                    cursors.append({"userId": user_id, "position": position})
+            if cursors:
+                self.publish(sheet_id, {"type": "cursor_batch", "cursors": cursors},
+                             ("cursors", next(self._batch_ids)))
+                published += 1
+        return published
+
+    def _schedule(self, sheet_id: str) -> None:
+        task = self._tasks.get(sheet_id)
+        if task is not None and not task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (scripts, tests): the caller drives tick() itself
+            return
+        self._tasks[sheet_id] = loop.create_task(self._run(sheet_id))
+
+    async def _run(self, sheet_id: str) -> None:
+        # Ticks while there is something to send and stops after an idle tick;
+        # the next event starts it again
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self.tick(sheet_id):
+                break
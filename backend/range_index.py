@@ -0,0 +1,151 @@
+import bisect
+import operator
+from array import array
+from itertools import accumulate, islice
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+
+class FenwickTree:
+    # Binary indexed tree over a fixed number of positions: point updates and
+    # prefix sums in O(log n). Positions are zero-based.
+
+    def __init__(self, values: Iterable[float], typecode: str = "d"):
+        # Node i covers positions (i & (i - 1), i], so it is a difference of
+        # two prefix sums; building it that way keeps the loop in C.
+        prefix = list(accumulate(values, initial=0))
+        size = len(prefix) - 1
+        starts = map(prefix.__getitem__, map(operator.and_, range(1, size + 1), range(size)))
+        self.tree = array(typecode, [0])
+        self.tree.extend(map(operator.sub, islice(prefix, 1, None), starts))
+        self.size = size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, position: int, delta) -> None:
+        tree = self.tree
+        i = position + 1
+        while i <= self.size:
+            tree[i] += delta
+            i += i & -i
+
+    def prefix(self, stop: int):
+        # Sum of positions [0, stop)
+        tree = self.tree
+        total = 0
+        i = min(stop, self.size)
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def range_sum(self, start: int, stop: int):
+        # Sum of positions [start, stop)
+        if stop <= start:
+            return 0
+        return self.prefix(stop) - self.prefix(start)
+
+
+class ColumnAggregateIndex:
+    # Running sums and numeric counts for one column, kept in step with every
+    # write so SUM/COUNT/AVERAGE over any row range cost O(log n) instead of a
+    # pass over the range. Float sums come from differences of prefix totals,
+    # so results carry the usual floating point rounding of running sums.
+
+    def __init__(self, numbers: array, numeric: bytearray):
+        self.sums = FenwickTree(numbers, "d")
+        self.counts = FenwickTree(numeric, "q")
+
+    def __len__(self) -> int:
+        return len(self.sums)
+
+    def update(self, row: int, number_delta: float, count_delta: int) -> None:
+        if number_delta:
+            self.sums.add(row, number_delta)
+        if count_delta:
+            self.counts.add(row, count_delta)
+
+    def sum(self, start: int, stop: int) -> float:
+        return self.sums.range_sum(start, stop)
+
+    def count(self, start: int, stop: int) -> int:
+        return self.counts.range_sum(start, stop)
+
+
+class ColumnLookupIndex:
+    # Exact-match and order index for one column, over logical rows, kept in
+    # step with every write like ColumnAggregateIndex:
+    #   rows    - cell key -> ascending rows holding it; a key is the number,
+    #             or the lower-cased text (lookups ignore case)
+    #   numbers - the column's numbers in ascending order, and number_rows
+    #             the ascending rows holding them, so a comparison over a
+    #             range covering every number is two bisects
+    # Lookups of the first match and "=" counts in any row range cost a dict
+    # probe and a bisect instead of a pass over the range.
+
+    def __init__(self, cells: Iterable[Tuple[int, Union[str, float]]]):
+        self.rows: Dict[Union[str, float], List[int]] = {}
+        numbers = []
+        for row, value in cells:
+            key = value.lower() if isinstance(value, str) else value
+            self.rows.setdefault(key, []).append(row)
+            if not isinstance(value, str):
+                numbers.append((value, row))
+        numbers.sort()
+        self.numbers = [value for value, _ in numbers]
+        self.number_rows = sorted(row for _, row in numbers)
+
+    def add(self, row: int, value: Union[str, float]) -> None:
+        if isinstance(value, str):
+            bisect.insort(self.rows.setdefault(value.lower(), []), row)
+            return
+        bisect.insort(self.rows.setdefault(value, []), row)
+        bisect.insort(self.numbers, value)
+        bisect.insort(self.number_rows, row)
+
+    def remove(self, row: int, value: Union[str, float]) -> None:
+        key = value.lower() if isinstance(value, str) else value
+        rows = self.rows.get(key)
+        if rows is None:
+            return
+        _discard(rows, row)
+        if not rows:
+            del self.rows[key]
+        if not isinstance(value, str):
+            _discard(self.numbers, value)
+            _discard(self.number_rows, row)
+
+    def first(self, value: Union[str, float], start: int, stop: int) -> Optional[int]:
+        # First row in [start, stop) holding value, or None
+        rows = self.rows.get(value.lower() if isinstance(value, str) else value)
+        if not rows:
+            return None
+        at = bisect.bisect_left(rows, start)
+        return rows[at] if at < len(rows) and rows[at] < stop else None
+
+    def count(self, value: Union[str, float], start: int, stop: int) -> int:
+        rows = self.rows.get(value.lower() if isinstance(value, str) else value)
+        if not rows:
+            return 0
+        return bisect.bisect_left(rows, stop) - bisect.bisect_left(rows, start)
+
+    def count_compare(self, op: str, number: float, start: int, stop: int) -> Optional[int]:
+        # Numbers in [start, stop) that are op (<, <=, >, >=) number, or None
+        # when the range leaves some of the column's numbers out
+        rows = self.number_rows
+        if rows and (rows[0] < start or rows[-1] >= stop):
+            return None
+        numbers = self.numbers
+        if op == "<":
+            return bisect.bisect_left(numbers, number)
+        if op == "<=":
+            return bisect.bisect_right(numbers, number)
+        if op == ">":
+            return len(numbers) - bisect.bisect_right(numbers, number)
+        return len(numbers) - bisect.bisect_left(numbers, number)
+
+
+def _discard(values: list, value) -> None:
+    at = bisect.bisect_left(values, value)
+    if at < len(values) and values[at] == value:
+        del values[at]
@@ -0,0 +1,131 @@
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from persistence import PersistenceEngine
+
+# Bounds the memory held by sheets. Every access to a sheet's cells, history
+# or comments goes through the services' `on_access` hook, which keeps an LRU
+# order and loads sheets back from their snapshot when they were evicted.
+# `enforce()` then evicts, least recently used first, sheets without
+# connected clients while the resident sheets are over the memory budget,
+# plus any such sheet idle for longer than `idle_seconds`. An evicted sheet is
+# written to its snapshot (when it changed since the last one) and dropped
+# from all three services.
+#
+# Sheet sizes are estimates: exact for the column and history arrays,
+# approximate for strings, formulas and comments.
+
+SHEET_MEMORY_BUDGET = 512 * 1024 * 1024
+SHEET_IDLE_SECONDS = 1800.0
+COMMENT_BYTES = 300
+
+
+class SheetResidency:
+    def __init__(self, persistence: PersistenceEngine, budget_bytes: int = SHEET_MEMORY_BUDGET,
+                 idle_seconds: float = SHEET_IDLE_SECONDS, pinned: Optional[Callable[[str], bool]] = None,
+                 on_evict: Optional[Callable[[str], None]] = None, clock: Callable[[], float] = time.monotonic):
+        self.persistence = persistence
+        self.spreadsheets = persistence.services["sheets"]
+        self.history = persistence.services["history"]
+        self.comments = persistence.services["comments"]
+        self.budget_bytes = budget_bytes
+        self.idle_seconds = idle_seconds
+        # pinned(sheet_id) is true while clients are connected to the sheet
+        self.pinned = pinned or (lambda sheet_id: False)
+        self.on_evict = on_evict
+        self.clock = clock
+        # Resident sheets, least recently used first: sheet_id -> last access
+        self.last_access: "OrderedDict[str, float]" = OrderedDict()
+        now = clock()
+        for sheet_id in self._resident_ids():
+            self.last_access[sheet_id] = now
+        # Sheets whose data is only on disk
+        self.evicted: Set[str] = set(persistence.snapshot_ids()) - set(self.last_access)
+        # sheet_id -> ((sheet identity, store revision), store bytes)
+        self._store_sizes: Dict[str, Tuple[tuple, int]] = {}
+        self.evictions = 0
+        self.reloads = 0
+
+    def attach(self) -> None:
+        for service in (self.spreadsheets, self.history, self.comments):
+            service.on_access = self.touch
+
+    def _resident_ids(self) -> Set[str]:
+        return set(self.spreadsheets.spreadsheets) | set(self.history.logs) | set(self.comments.comments)
+
+    def touch(self, sheet_id: str) -> None:
+        if sheet_id in self.evicted:
+            self.evicted.discard(sheet_id)
+            self.persistence.load_sheet(sheet_id)
+            self.reloads += 1
+        self.last_access[sheet_id] = self.clock()
+        self.last_access.move_to_end(sheet_id)
+
+    def sheet_bytes(self, sheet_id: str) -> int:
+        size = 0
+        sheet = self.spreadsheets.spreadsheets.get(sheet_id)
+        if sheet is not None:
+            key = (id(sheet), sheet.store.revision)
+            cached = self._store_sizes.get(sheet_id)
+            if cached is None or cached[0] != key:
+                cached = self._store_sizes[sheet_id] = (key, sheet.store.nbytes())
+            size += cached[1]
+        log = self.history.logs.get(sheet_id)
+        if log is not None:
+            size += log.nbytes()
+        size += COMMENT_BYTES * len(self.comments.comments.get(sheet_id, ()))
+        return size
+
+    def enforce(self) -> List[str]:
+        # Evict what the budget and idle timeout call for; returns the sheets
+        now = self.clock()
+        sizes = {sheet_id: self.sheet_bytes(sheet_id) for sheet_id in self.last_access}
+        total = sum(sizes.values())
+        evicted = []
+        for sheet_id, last in list(self.last_access.items()):
+            if total <= self.budget_bytes and now - last < self.idle_seconds:
+                continue
+            if self.pinned(sheet_id):
+                continue
+            self.evict(sheet_id)
+            total -= sizes[sheet_id]
+            evicted.append(sheet_id)
+        return evicted
+
+    def evict(self, sheet_id: str) -> None:
+        persistence = self.persistence
+        has_data = (sheet_id in self.spreadsheets.spreadsheets or sheet_id in self.history.logs
+                    or sheet_id in self.comments.comments)
+        if has_data and (sheet_id in persistence.dirty or not persistence.has_snapshot(sheet_id)):
+            persistence.sync()
+            persistence.write_snapshot(sheet_id)
+        persistence.dirty.discard(sheet_id)
+
+        self.spreadsheets.spreadsheets.pop(sheet_id, None)
+        self.history.logs.pop(sheet_id, None)
+        self.comments.comments.pop(sheet_id, None)
+        self.last_access.pop(sheet_id, None)
+        self._store_sizes.pop(sheet_id, None)
+        if has_data:
+            self.evicted.add(sheet_id)
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(sheet_id)
+
+    def metrics(self) -> dict:
+        now = self.clock()
+        sheets = [
+            {"sheetId": sheet_id, "bytes": self.sheet_bytes(sheet_id),
+             "idleSeconds": round(now - last, 1), "pinned": self.pinned(sheet_id)}
+            for sheet_id, last in self.last_access.items()
+        ]
+        sheets.sort(key=lambda sheet: sheet["bytes"], reverse=True)
+        return {
+            "budgetBytes": self.budget_bytes,
+            "residentBytes": sum(sheet["bytes"] for sheet in sheets),
+            "residentSheets": len(sheets),
+            "evictedSheets": len(self.evicted),
+            "evictions": self.evictions,
+            "reloads": self.reloads,
+            "sheets": sheets,
+        }
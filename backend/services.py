@@ -0,0 +1,65 @@
+import asyncio
+from typing import Optional
+from weakref import WeakValueDictionary
+from cluster import Cluster, cluster_from_env
+from comments import CommentService
+from history import HistoryService
+from spreadsheet import SpreadsheetService
+
+# The one instance of each stateful service. The REST routes, the CSV router
+# and the WebSocket manager all use these (routes through the get_* FastAPI
+# dependencies), so every entry point sees the same sheets.
+#
+# Concurrency: service methods are synchronous and run on the event loop, so
+# each call is atomic. That only holds if they are never called from another
+# thread: every route that touches a service is an `async def` (FastAPI runs
+# plain `def` routes in a threadpool), and any work moved off the loop must
+# not touch live service state. Work on a sheet that awaits between calls (a CSV
+# import reading its upload, an export streaming its rows, an edit that reads
+# old values, applies and logs history) holds the sheet's lock from
+# `sheet_locks` for its duration, so it never sees or leaves a half-applied
+# change.
+
+
+class SheetLocks:
+    def __init__(self):
+        # A lock lives as long as someone holds or waits for it
+        self.locks: "WeakValueDictionary[str, asyncio.Lock]" = WeakValueDictionary()
+
+    def __call__(self, sheet_id: str) -> asyncio.Lock:
+        lock = self.locks.get(sheet_id)
+        if lock is None:
+            lock = self.locks[sheet_id] = asyncio.Lock()
+        return lock
+
+
+spreadsheet_service = SpreadsheetService()
+history_service = HistoryService()
+comment_service = CommentService()
+sheet_locks = SheetLocks()
+# Set in multi-worker mode; see cluster.py
+cluster: Optional[Cluster] = cluster_from_env()
+
+
+def get_spreadsheet_service() -> SpreadsheetService:
+    return spreadsheet_service
+
+
+def get_history_service() -> HistoryService:
+    return history_service
+
+
+def get_comment_service() -> CommentService:
+    return comment_service
+
+
+def get_sheet_locks() -> SheetLocks:
+    return sheet_locks
+
+
+def require_sheet_owner(sheet_id: str) -> None:
+    # Route dependency: in multi-worker mode only the sheet's owner has its data
+    if cluster is not None and not cluster.owns(sheet_id):
+        from fastapi import HTTPException
+        raise HTTPException(status_code=421, detail="Sheet is served by another worker",
+                            headers={"X-Sheet-Owner": cluster.owner(sheet_id)})
@@ -0,0 +1,68 @@
+from typing import Optional
+from formula import Area
+from models import Spreadsheet
+from utils import column_letters, index_to_cell_ref
+
+# Bulk range reads for cold loads. A snapshot page covers up to `page_rows`
+# rows of the requested area and comes in one of two layouts:
+#   rows    - [[row, [value, ...]], ...] for populated rows only (zero-based
+#             row, one value per column of the area, null when empty)
+#   columns - {"A": [value, ...], ...} for populated columns only, one value
+#             per row of the page
+# Formulas are listed separately as {cellRef: formula}. The ETag is derived
+# from the store revision and the sheet size, so an unchanged sheet answers
+# If-None-Match with 304 without building anything.
+
+SNAPSHOT_PAGE_ROWS = 1000
+SNAPSHOT_MAX_PAGE_ROWS = 10000
+FORMATS = ("rows", "columns")
+
+
+def sheet_etag(sheet: Spreadsheet) -> str:
+    # Weak, since gzip and identity encodings of a page share it
+    return f'W/"{sheet.store.revision}-{sheet.rows}x{sheet.columns}"'
+
+
+def build_snapshot(sheet: Spreadsheet, area: Optional[Area] = None, page: int = 0,
+                   page_rows: int = SNAPSHOT_PAGE_ROWS, fmt: str = "rows") -> dict:
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown snapshot format: {fmt}")
+    if page < 0 or not 0 < page_rows <= SNAPSHOT_MAX_PAGE_ROWS:
+        raise ValueError("Invalid page")
+    if area is None:
+        area = Area(0, 0, max(sheet.rows, 1) - 1, max(sheet.columns, 1) - 1)
+    store = sheet.store
+    cols = range(area.col_start, area.col_end + 1)
+    start = area.row_start + page * page_rows
+    end = min(start + page_rows, area.row_end + 1) - 1
+
+    rows = store.populated_rows(start, end, cols) if start <= end else []
+    if fmt == "rows":
+        data = [[row, [store.value(row, col) for col in cols]] for row in rows]
+    else:
+        data = {}
+        for col in cols:
+            values = [store.value(row, col) for row in range(start, end + 1)] if rows else []
+            if any(value is not None for value in values):
+                data[column_letters(col)] = values
+    formulas = {
+        index_to_cell_ref(row, col): formula
+        for (row, col), formula in store.formulas.items()
+        if start <= row <= end and area.col_start <= col <= area.col_end
+    }
+
+    last = end >= area.row_end
+    return {
+        "range": f"{index_to_cell_ref(area.row_start, area.col_start)}:"
+                 f"{index_to_cell_ref(area.row_end, area.col_end)}",
+        "revision": store.revision,
+        "rows": sheet.rows,
+        "columns": sheet.columns,
+        "format": fmt,
+        "page": page,
+        "pageRows": page_rows,
+        "firstRow": start,
+        "data": data,
+        "formulas": formulas,
+        "nextPage": None if last else page + 1,
+    }
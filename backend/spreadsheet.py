@@ -1,17 +1,29 @@
-import re
-from typing import Optional, List, Dict
+from typing import Callable, Optional, List, Dict, Iterable, Tuple
 from models import Spreadsheet, Cell, CellType
-
-
-class FormulaError(Exception):
-    pass
+from dependency_graph import Coord, CircularReferenceError, DependencyGraph
+from formula import FormulaError, compile_formula, shift_references
+from storage import KIND_FORMULA, KIND_NUMBER, KIND_TEXT
+from utils import (MAX_COLUMNS, MAX_ROWS, cell_ref_to_index, column_index,
+                   index_to_cell_ref, validate_cell_ref)
 
 
 class SpreadsheetService:
     def __init__(self):
         self.spreadsheets: Dict[str, Spreadsheet] = {}
+        # Called as journal(method, args) after every successful change, so
+        # the persistence layer can log it and replay it after a restart
+        self.journal: Optional[Callable[[str, list], None]] = None
+        # Called as on_access(sheet_id) before a sheet is used, so an evicted
+        # sheet can be loaded back; see residency.py
+        self.on_access: Optional[Callable[[str], None]] = None
+
+    def _record(self, method: str, *args) -> None:
+        if self.journal is not None:
+            self.journal(method, list(args))
 
     def get_or_create_sheet(self, sheet_id: str) -> Spreadsheet:
+        if self.on_access is not None:
+            self.on_access(sheet_id)
         if sheet_id not in self.spreadsheets:
             self.spreadsheets[sheet_id] = Spreadsheet()
         # Return a copy to avoid direct reference issues
@@ -19,20 +31,34 @@ class SpreadsheetService:
         return self.spreadsheets[sheet_id]
 
     def validate_cell_ref(self, cell_ref: str) -> bool:
-        return re.match(r"^[A-Z]{1}[1-9][0-9]{0,1}$", cell_ref) is not None
+        return validate_cell_ref(cell_ref)
 
     def set_cell_value(self, sheet_id: str, cell_ref: str, value: str, formula: Optional[str] = None) -> Cell:
+        return self.set_cell(sheet_id, cell_ref, value, formula)[0]
+
+    def set_cell(self, sheet_id: str, cell_ref: str, value: str,
+                 formula: Optional[str] = None) -> Tuple[Cell, List[str]]:
+        # Returns the edited cell and the refs of the formula cells that were
+        # recalculated because of it, in evaluation order
         sheet = self.get_or_create_sheet(sheet_id)
         if not self.validate_cell_ref(cell_ref):
             raise ValueError(f"Invalid cell reference: {cell_ref}")
 
+        coord = cell_ref_to_index(cell_ref)
         cell = sheet.cells.get(cell_ref, Cell())
-        cell.version += 1
         if formula:
+            compiled = compile_formula(formula)
+            if sheet.dependencies.would_create_cycle(coord, compiled.refs, compiled.areas):
+                raise FormulaError(f"Circular reference in {cell_ref}")
+            # Evaluate before touching the cell so a bad formula leaves it as it was
+            result = compiled(sheet.store)
+            cell.version += 1
             cell.cell_type = CellType.FORMULA
             cell.formula = formula
-            cell.value = self.evaluate_formula(sheet, formula)
+            cell.value = result
+            sheet.dependencies.set_formula(coord, compiled.refs, compiled.areas)
         else:
+            cell.version += 1
             try:
                 num_val = float(value)
                 cell.cell_type = CellType.NUMBER
@@ -42,133 +68,256 @@ class SpreadsheetService:
                 cell.cell_type = CellType.TEXT
                 cell.value = value
                 cell.formula = None
+            sheet.dependencies.clear_formula(coord)
 
         sheet.cells[cell_ref] = cell
-        return cell
+        # Journal the write before the dependents are recalculated: replay
+        # recalculates them anyway, and the write is in the store already
+        self._record("set_cell_value", sheet_id, cell_ref, value, formula)
+        recalculated = self._recalculate(sheet, [coord])
+        return cell, recalculated
+
+    def clear_sheet(self, sheet_id: str) -> None:
+        sheet = self.get_or_create_sheet(sheet_id)
+        sheet.store.clear()
+        sheet.dependencies = DependencyGraph()
+        self._record("clear_sheet", sheet_id)
+
+    def load_rows(self, sheet_id: str, start_row: int, rows: List[List[str]]) -> int:
+        # Bulk load of plain values (CSV import): same typing as set_cell_value,
+        # but no per-cell version bump, graph update or recalculation. Returns
+        # the number of cells written.
+        sheet = self.get_or_create_sheet(sheet_id)
+        store = sheet.store
+        written = 0
+        width = 0
+        for row_num, row in enumerate(rows, start_row):
+            if row_num >= MAX_ROWS:
+                break
+            for col_num, raw in enumerate(row[:MAX_COLUMNS]):
+                value = raw.strip()
+                if not value:
+                    continue
+                try:
+                    store.set(row_num, col_num, float(value), None, KIND_NUMBER, 1)
+                except ValueError:
+                    store.set(row_num, col_num, value, None, KIND_TEXT, 1)
+                written += 1
+            width = max(width, len(row))
+        if rows:
+            sheet.rows = max(sheet.rows, min(start_row + len(rows), MAX_ROWS))
+            sheet.columns = max(sheet.columns, min(width, MAX_COLUMNS))
+        self._record("load_rows", sheet_id, start_row, rows)
+        return written
+
+    def set_cells(self, sheet_id: str,
+                  edits: List[Tuple[str, str, Optional[str]]]) -> Tuple[Dict[str, Cell], List[str]]:
+        # Apply many (cell_ref, value, formula) edits at once, e.g. a paste.
+        # Everything is validated before anything is written, so a bad edit
+        # rejects the whole batch. Dependent formulas are recalculated once
+        # for the batch. Returns the edited cells and the refs of the other
+        # formula cells that were recalculated.
+        sheet = self.get_or_create_sheet(sheet_id)
+        parsed = []
+        for cell_ref, value, formula in edits:
+            if not self.validate_cell_ref(cell_ref):
+                raise ValueError(f"Invalid cell reference: {cell_ref}")
+            parsed.append((cell_ref, cell_ref_to_index(cell_ref), value, formula,
+                           compile_formula(formula) if formula else None))
+
+        graph = sheet.dependencies
+        previous = {}
+        for _, coord, _, _, compiled in parsed:
+            if coord not in previous:
+                previous[coord] = (set(graph.precedents.get(coord, ())), list(graph.areas.get(coord, ())))
+            if compiled is not None:
+                graph.set_formula(coord, compiled.refs, compiled.areas)
+            else:
+                graph.clear_formula(coord)
+        try:
+            order = graph.recalc_order(previous, include_changed=True)
+        except CircularReferenceError as e:
+            for coord, (refs, areas) in previous.items():
+                graph.set_formula(coord, refs, areas)
+            raise FormulaError(str(e))
+
+        store = sheet.store
+        for _, (row, col), value, formula, compiled in parsed:
+            entry = store.get(row, col)
+            version = entry[3] if entry is not None else 0
+            if compiled is not None:
+                # Evaluated below in dependency order, which bumps the version
+                store.set(row, col, None, formula, KIND_FORMULA, version)
+                continue
+            try:
+                store.set(row, col, float(value), None, KIND_NUMBER, version + 1)
+            except (TypeError, ValueError):
+                store.set(row, col, value, None, KIND_TEXT, version + 1)
+        # The order starts from every edited cell; only formulas need evaluating.
+        # An edited formula without references (=1+2) is not in the graph.
+        edited_formulas = {coord for _, coord, _, _, compiled in parsed if compiled is not None}
+        self._record("set_cells", sheet_id, edits)
+        updated = self._evaluate(sheet, [coord for coord in order
+                                         if coord in edited_formulas or graph.has_formula(coord)])
+
+        cells = {cell_ref: sheet.cells[cell_ref] for cell_ref, *_ in parsed}
+        return cells, [ref for ref in updated if ref not in cells]
+
+    def get_dependents(self, sheet_id: str, cell_ref: str) -> List[str]:
+        # Formula cells that read cell_ref, directly or not, in evaluation order
+        sheet = self.get_or_create_sheet(sheet_id)
+        order = sheet.dependencies.recalc_order([cell_ref_to_index(cell_ref)])
+        return [index_to_cell_ref(row, col) for row, col in order]
+
+    def _recalculate(self, sheet: Spreadsheet, changed: Iterable[Coord], include_changed: bool = False) -> List[str]:
+        try:
+            order = sheet.dependencies.recalc_order(changed, include_changed)
+        except CircularReferenceError as e:
+            raise FormulaError(str(e))
+        return self._evaluate(sheet, order)
+
+    def _evaluate(self, sheet: Spreadsheet, order: List[Coord]) -> List[str]:
+        # Re-evaluate formula cells in the given (topological) order
+        store = sheet.store
+        updated = []
+        for row, col in order:
+            entry = store.get(row, col)
+            if entry is None or not entry[1]:
+                # The formula was removed behind the graph's back (e.g. a cleared sheet)
+                sheet.dependencies.clear_formula((row, col))
+                continue
+            _, formula, _, version = entry
+            store.set(row, col, compile_formula(formula)(store), formula, KIND_FORMULA, version + 1)
+            updated.append(index_to_cell_ref(row, col))
+        return updated
 
     def get_cell_value(self, sheet_id: str, cell_ref: str) -> Cell:
         sheet = self.get_or_create_sheet(sheet_id)
         return sheet.cells.get(cell_ref, Cell())
 
-    def evaluate_formula(self, sheet: Spreadsheet, formula: str) -> float:
-        formula = formula.strip().upper()
-        if formula.startswith("SUM(") and formula.endswith(")"):
-            range_ref = formula[4:-1]
-            return self._sum_range(sheet, range_ref)
-        elif formula.startswith("AVERAGE(") and formula.endswith(")"):
-            range_ref = formula[8:-1]
-            return self._average_range(sheet, range_ref)
-        elif formula.startswith("COUNT(") and formula.endswith(")"):
-            range_ref = formula[6:-1]
-            return self._count_range(sheet, range_ref)
-        else:
-            raise FormulaError(f"Unsupported formula: {formula}")
-
-    def _parse_range(self, range_ref: str) -> List[str]:
-        m = re.match(r"([A-Z])([1-9][0-9]?):([A-Z])([1-9][0-9]?)", range_ref)
-        if not m:
-            raise FormulaError(f"Invalid range: {range_ref}")
-        col_start, row_start, col_end, row_end = m.groups()
-        if col_start != col_end:
-            raise FormulaError("Only single column ranges supported")
-
-        start, end = int(row_start), int(row_end)
-        if start > end:
-            start, end = end, start
-
-        return [f"{col_start}{i}" for i in range(start, end + 1)]
-
-    def _sum_range(self, sheet: Spreadsheet, range_ref: str) -> float:
-        cells = self._parse_range(range_ref)
-        total = 0.0
-        for ref in cells:
-            cell = sheet.cells.get(ref)
-            if cell and cell.cell_type == CellType.NUMBER and cell.value is not None:
-                total += cell.value
-        return total
-
-    def _average_range(self, sheet: Spreadsheet, range_ref: str) -> float:
-        cells = self._parse_range(range_ref)
-        values = [
-            sheet.cells[ref].value
-            for ref in cells
-            if ref in sheet.cells and sheet.cells[ref].cell_type == CellType.NUMBER and sheet.cells[ref].value is not None
-        ]
-        return sum(values) / len(values) if values else 0.0
-
-    def _count_range(self, sheet: Spreadsheet, range_ref: str) -> int:
-        cells = self._parse_range(range_ref)
-        count = 0
-        for ref in cells:
-            if ref in sheet.cells and sheet.cells[ref].value is not None:
-                count += 1
-        return count
+    def evaluate_formula(self, sheet: Spreadsheet, formula: str):
+        return compile_formula(formula)(sheet.store)
 
     def add_row(self, sheet_id: str) -> None:
         sheet = self.get_or_create_sheet(sheet_id)
-        if sheet.rows < 1000:
+        if sheet.rows < MAX_ROWS:
             sheet.rows += 1
+        self._record("add_row", sheet_id)
+
+    def insert_row(self, sheet_id: str, row_num: int) -> None:
+        # Insert an empty row before row_num, moving the rows below it down
+        sheet = self.get_or_create_sheet(sheet_id)
+        if 1 <= row_num <= sheet.rows + 1 and sheet.rows < MAX_ROWS:
+            sheet.store.insert_rows(row_num - 1, 1)
+            sheet.rows += 1
+            self._shift_formulas(sheet, 0, row_num - 1, 1)
+        self._record("insert_row", sheet_id, row_num)
 
     def delete_row(self, sheet_id: str, row_num: int) -> None:
         sheet = self.get_or_create_sheet(sheet_id)
         if 1 <= row_num <= sheet.rows:
-            for col in range(sheet.columns):
-                cell_ref = f"{chr(ord('A') + col)}{row_num}"
-                if cell_ref in sheet.cells:
-                    del sheet.cells[cell_ref]
+            sheet.store.delete_rows(row_num - 1, 1)
             sheet.rows -= 1
+            self._shift_formulas(sheet, 0, row_num - 1, -1)
+        self._record("delete_row", sheet_id, row_num)
 
     def add_column(self, sheet_id: str) -> None:
         sheet = self.get_or_create_sheet(sheet_id)
         # Make sure we're not at the limit
-        if sheet.columns < 26:
+        if sheet.columns < MAX_COLUMNS:
             # Directly modify the sheet object
             sheet.columns += 1
             # Make sure to update the original reference in the dictionary
             self.spreadsheets[sheet_id].columns = sheet.columns
+        self._record("add_column", sheet_id)
+
+    def insert_column(self, sheet_id: str, col_char: str) -> None:
+        # Insert an empty column before col_char, moving later columns right
+        sheet = self.get_or_create_sheet(sheet_id)
+        col = column_index(col_char)
+        if col <= sheet.columns and sheet.columns < MAX_COLUMNS:
+            sheet.store.insert_columns(col, 1)
+            sheet.columns += 1
+            self._shift_formulas(sheet, 1, col, 1)
+        self._record("insert_column", sheet_id, col_char)
 
     def delete_column(self, sheet_id: str, col_char: str) -> None:
         sheet = self.get_or_create_sheet(sheet_id)
-        if "A" <= col_char <= chr(ord("A") + sheet.columns - 1):
-            for row in range(1, sheet.rows+1):
-                cell_ref = f"{col_char}{row}"
-                if cell_ref in sheet.cells:
-                    del sheet.cells[cell_ref]
+        col = column_index(col_char)
+        if col < sheet.columns:
+            sheet.store.delete_columns(col, 1)
             sheet.columns -= 1
+            self._shift_formulas(sheet, 1, col, -1)
+        self._record("delete_column", sheet_id, col_char)
 
-    def sort_column(self, sheet_id: str, col_char: str, ascending: bool = True) -> None:
+    def restore_sheet(self, sheet_id: str, sheet: Spreadsheet) -> None:
+        # Install a sheet loaded from storage; the graph is not persisted
+        graph = sheet.dependencies = DependencyGraph()
+        for coord, formula in sheet.store.formulas.items():
+            try:
+                compiled = compile_formula(formula)
+            except FormulaError:
+                continue
+            graph.set_formula(coord, compiled.refs, compiled.areas)
+        self.spreadsheets[sheet_id] = sheet
+
+    def _shift_formulas(self, sheet: Spreadsheet, axis: int, at: int, count: int) -> None:
+        # The store has already moved the cells. Rewrite the references inside
+        # formulas and rebuild the graph, which costs O(formulas) rather than
+        # O(cells); only formulas whose references changed are re-evaluated.
+        store = sheet.store
+        graph = sheet.dependencies = DependencyGraph()
+        changed = []
+        for coord, formula in list(store.formulas.items()):
+            shifted = shift_references(formula, axis, at, count)
+            if shifted != formula:
+                store.formulas[coord] = shifted
+                changed.append(coord)
+            try:
+                compiled = compile_formula(shifted)
+            except FormulaError:
+                continue
+            graph.set_formula(coord, compiled.refs, compiled.areas)
+        self._recalculate(sheet, changed, include_changed=True)
+
+    def sort_column(self, sheet_id: str, col_char: str, ascending: bool = True) -> List[str]:
+        # Sort the sheet's rows by one column
+        return self.sort_rows(sheet_id, [(column_index(col_char), ascending)])
+
+    def sort_rows(self, sheet_id: str, keys: List[Tuple[int, bool]], row_start: int = 0,
+                  row_end: Optional[int] = None) -> List[str]:
+        # Reorder whole rows in [row_start, row_end] (zero-based, default all
+        # rows) by (col, ascending) keys, first key first; see
+        # ColumnStore.sort_order. Cells keep their versions and formulas keep
+        # their text, as when the rows are moved by hand. Returns the refs of
+        # the formula cells recalculated because the rows under them moved.
         sheet = self.get_or_create_sheet(sheet_id)
-        rows = list(range(1, sheet.rows + 1))
-        values = []
-        for row in rows:
-            cell_ref = f"{col_char}{row}"
-            cell = sheet.cells.get(cell_ref)
-            val = cell.value if cell else None
-            values.append((row, val))
-        
-        # Custom sorting key function that can handle mixed types
-        def sort_key(item):
-            val = item[1]
-            # First sort by None values (always at the end)
-            if val is None:
-                return (1, 0)
-                
-            # Then sort by type (numbers before strings)
-            if isinstance(val, (int, float)):
-                return (0, val)
-            else:
-                # String values - place them after numbers
-                return (0.5, str(val))
-
-        values_sorted = sorted(values, key=sort_key, reverse=not ascending)
-        
-        for i, (orig_row, val) in enumerate(values_sorted):
-            target_ref = f"{col_char}{rows[i]}"
-            if val is None:
-                sheet.cells.pop(target_ref, None)
-            else:
-                cell = sheet.cells.get(target_ref, Cell())
-                cell.value = val
-                cell.cell_type = CellType.NUMBER if isinstance(
-                    val, (int, float)) else CellType.TEXT
-                sheet.cells[target_ref] = cell
+        if row_end is None:
+            row_end = sheet.rows - 1
+        if not keys or not all(0 <= col < MAX_COLUMNS for col, _ in keys):
+            raise ValueError("Sort keys must be valid columns")
+        if not 0 <= row_start <= row_end < MAX_ROWS:
+            raise ValueError(f"Invalid sort rows: {row_start}-{row_end}")
+        store = sheet.store
+        order = store.sort_order(row_start, row_end + 1, keys)
+        if order != list(range(len(order))):
+            store.permute_rows(row_start, order)
+            # Formulas moved, so rebuild the graph, then re-evaluate every
+            # formula reading the sorted rows, in dependency order
+            graph = sheet.dependencies = DependencyGraph()
+            for coord, formula in store.formulas.items():
+                try:
+                    compiled = compile_formula(formula)
+                except FormulaError:
+                    continue
+                graph.set_formula(coord, compiled.refs, compiled.areas)
+            readers = [
+                coord for coord in store.formulas
+                if any(row_start <= row <= row_end for row, _ in graph.precedents.get(coord, ()))
+                or any(start <= row_end and row_start <= end for start, _, end, _ in graph.areas.get(coord, ()))
+            ]
+            updated = self._recalculate(sheet, readers, include_changed=True)
+        else:
+            updated = []
+        self._record("sort_rows", sheet_id, [list(key) for key in keys], row_start, row_end)
+        return updated
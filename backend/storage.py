@@ -0,0 +1,730 @@
+import operator
+import re
+import sys
+from array import array
+from itertools import compress, repeat
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from range_index import ColumnAggregateIndex, ColumnLookupIndex
+
+# Column-oriented cell storage addressed by zero-based (row, col).
+#
+# Every column keeps parallel typed arrays instead of one object per cell:
+#   kinds    - bytearray, one of the KIND_* codes below (KIND_EMPTY for no cell)
+#   numbers  - float64 values; only meaningful where `numeric` is set
+#   numeric  - bytearray null mask, 1 where `numbers` holds the cell's value
+#   text     - ids into the sheet's interned string table, -1 for none
+#   versions - per-cell edit version
+# Formulas are rare compared to plain values, so they live in a side map.
+#
+# Non-numeric slots of `numbers` always hold 0.0, so the float64 arrays double
+# as the numeric shadow of each column: range aggregates reduce array slices
+# with C-level builtins (sum, bytearray.count, compress) instead of looking at
+# cells one by one. Long ranges go through a per-column Fenwick tree index,
+# built once a column is aggregated over at least AGGREGATE_INDEX_MIN_ROWS
+# rows and then updated in O(log n) on every write.
+#
+# Rows and columns are addressed logically. Logical columns are positions in
+# the `columns` list. Logical rows map to physical slots in the column arrays
+# through `row_map`, which stays None (identity) until the first row insert or
+# delete. Inserting or deleting rows then only edits the map, so no cell data
+# moves; freed slots are cleared and reused by later inserts.
+#
+# Sorting uses the same indirection. `sort_order` computes the new row order
+# once from the typed arrays, one stable sort pass per key from the last key
+# to the first, with C-level key lookups (array.__getitem__) instead of a
+# Python key function. `permute_rows` then rewrites one slice of the row map,
+# so whole rows move with their values, versions and formulas.
+#
+# Filters go through `match_mask`: a bytearray over logical rows with 1 where
+# the column's cell satisfies a comparison (COUNTIF semantics). Masks are
+# computed column-wide with C-level maps over the typed arrays, cached on the
+# column (up to FILTER_CACHE_SIZE per column, least recently used dropped) and
+# kept current by every write to the column, like the aggregate index. Row
+# inserts, deletes and sorts drop them.
+#
+# Lookups (VLOOKUP, XLOOKUP, MATCH) and COUNTIF over at least
+# LOOKUP_INDEX_MIN_ROWS rows of a column go through a ColumnLookupIndex (hash
+# of cell keys to rows plus the sorted numbers), built on the first such call
+# and maintained by writes, so each one costs O(1)/O(log n) instead of a pass
+# over the range. Approximate matches binary search the cells directly.
+
+KIND_EMPTY = 0
+KIND_TEXT = 1
+KIND_NUMBER = 2
+KIND_DATE = 3
+KIND_FORMULA = 4
+
+AGGREGATE_INDEX_MIN_ROWS = 1024
+FILTER_CACHE_SIZE = 16
+LOOKUP_INDEX_MIN_ROWS = 64
+
+Value = Optional[Union[str, float]]
+
+
+class StringTable:
+    def __init__(self):
+        self.strings: List[str] = []
+        self.ids: Dict[str, int] = {}
+        # Approximate memory held by the strings, for memory accounting
+        self.nbytes = 0
+
+    def intern(self, text: str) -> int:
+        string_id = self.ids.get(text)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings.append(text)
+            self.ids[text] = string_id
+            self.nbytes += sys.getsizeof(text)
+        return string_id
+
+
+class Column:
+    __slots__ = ("kinds", "numbers", "numeric", "text", "versions", "index", "index_requested", "masks",
+                 "lookup")
+
+    def __init__(self):
+        self.kinds = bytearray()
+        self.numbers = array("d")
+        self.numeric = bytearray()
+        self.text = array("i")
+        self.versions = array("i")
+        # Aggregate index over logical rows, see ColumnStore._aggregate_index
+        self.index: Optional[ColumnAggregateIndex] = None
+        self.index_requested = False
+        # Cached filter masks over logical rows, see ColumnStore.match_mask
+        self.masks: Optional[Dict[Tuple[str, Union[str, float]], bytearray]] = None
+        # Lookup index over logical rows, see ColumnStore._lookup_index
+        self.lookup: Optional[ColumnLookupIndex] = None
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def nbytes(self) -> int:
+        size = sum(len(values) * getattr(values, "itemsize", 1)
+                   for values in (self.kinds, self.numbers, self.numeric, self.text, self.versions))
+        if self.index is not None:
+            size += sum(len(tree.tree) * tree.tree.itemsize for tree in (self.index.sums, self.index.counts))
+        if self.masks:
+            size += sum(map(len, self.masks.values()))
+        return size
+
+    def grow(self, size: int) -> None:
+        # Over-allocate so appending rows one at a time stays amortized O(1)
+        current = len(self.kinds)
+        if size <= current:
+            return
+        extra = max(size, current * 2, 64) - current
+        self.kinds.extend(bytes(extra))
+        self.numbers.frombytes(bytes(extra * self.numbers.itemsize))
+        self.numeric.extend(bytes(extra))
+        self.text.extend(array("i", [-1]) * extra)
+        self.versions.frombytes(bytes(extra * self.versions.itemsize))
+
+    def clear_slot(self, slot: int) -> bool:
+        if slot >= len(self.kinds) or not self.kinds[slot]:
+            return False
+        self.kinds[slot] = KIND_EMPTY
+        self.numbers[slot] = 0.0
+        self.numeric[slot] = 0
+        self.text[slot] = -1
+        self.versions[slot] = 0
+        return True
+
+
+_NONZERO = re.compile(rb"[^\x00]")
+# bytes.translate table turning a 0/1 mask into its complement
+_FLIP = bytes([1]) + bytes(255)
+
+
+def _take(values, rows):
+    # Slice for the identity layout, gather through the row map otherwise
+    if isinstance(rows, slice):
+        return values[rows]
+    gathered = map(values.__getitem__, rows)
+    if isinstance(values, bytearray):
+        return bytearray(gathered)
+    return array(values.typecode, gathered)
+
+
+class ColumnStore:
+    def __init__(self):
+        self.columns: List[Optional[Column]] = []
+        self.strings = StringTable()
+        self.formulas: Dict[Tuple[int, int], str] = {}
+        self.cell_count = 0
+        # Logical row -> physical slot; None while rows have never moved
+        self.row_map: Optional[array] = None
+        self.physical_rows = 0
+        self.free_rows: List[int] = []
+        # Bumped by every change, for cheap "has anything changed" checks
+        self.revision = 0
+
+    def __len__(self) -> int:
+        return self.cell_count
+
+    def nbytes(self) -> int:
+        # Approximate memory held by the store: array buffers are exact, the
+        # string table and formulas are estimates (dict overhead included)
+        size = sum(column.nbytes() for column in self.columns if column is not None)
+        size += 2 * self.strings.nbytes
+        size += sum(sys.getsizeof(formula) + 100 for formula in self.formulas.values())
+        if self.row_map is not None:
+            size += len(self.row_map) * self.row_map.itemsize
+        return size
+
+    def _column(self, col: int, create: bool = False) -> Optional[Column]:
+        if col < len(self.columns):
+            column = self.columns[col]
+            if column is not None or not create:
+                return column
+        elif not create:
+            return None
+        else:
+            self.columns.extend([None] * (col + 1 - len(self.columns)))
+        column = self.columns[col] = Column()
+        return column
+
+    # --- row indirection ----------------------------------------------------
+
+    def _slot(self, row: int) -> int:
+        # Physical slot of a logical row, or -1 when the row holds no data
+        row_map = self.row_map
+        if row_map is None:
+            return row
+        return row_map[row] if row < len(row_map) else -1
+
+    def _slot_for_write(self, row: int) -> int:
+        row_map = self.row_map
+        if row_map is None:
+            return row
+        if row >= len(row_map):
+            row_map.extend(self._allocate_slots(row + 1 - len(row_map)))
+        return row_map[row]
+
+    def _allocate_slots(self, count: int) -> List[int]:
+        # Freed slots were cleared on delete, fresh ones are past every column
+        reused = self.free_rows[len(self.free_rows) - min(count, len(self.free_rows)):]
+        del self.free_rows[len(self.free_rows) - len(reused):]
+        fresh = range(self.physical_rows, self.physical_rows + count - len(reused))
+        self.physical_rows += len(fresh)
+        return reused[::-1] + list(fresh)
+
+    def _ensure_row_map(self) -> array:
+        if self.row_map is None:
+            capacity = max((len(column) for column in self.columns if column is not None), default=0)
+            self.row_map = array("q", range(capacity))
+            self.physical_rows = capacity
+        return self.row_map
+
+    def _drop_row_indexes(self) -> None:
+        for column in self.columns:
+            if column is not None:
+                column.index = None
+                column.index_requested = False
+                column.masks = None
+                column.lookup = None
+
+    def insert_rows(self, at: int, count: int) -> None:
+        self.revision += 1
+        row_map = self._ensure_row_map()
+        if at < len(row_map):
+            row_map[at:at] = array("q", self._allocate_slots(count))
+        self.formulas = {
+            (row + count if row >= at else row, col): formula
+            for (row, col), formula in self.formulas.items()
+        }
+        self._drop_row_indexes()
+
+    def delete_rows(self, at: int, count: int) -> None:
+        self.revision += 1
+        row_map = self._ensure_row_map()
+        removed = row_map[at:at + count]
+        del row_map[at:at + count]
+        for column in self.columns:
+            if column is None:
+                continue
+            for slot in removed:
+                if column.clear_slot(slot):
+                    self.cell_count -= 1
+        self.free_rows.extend(removed)
+        self.formulas = {
+            (row - count if row >= at + count else row, col): formula
+            for (row, col), formula in self.formulas.items()
+            if not at <= row < at + count
+        }
+        self._drop_row_indexes()
+
+    def insert_columns(self, at: int, count: int) -> None:
+        self.revision += 1
+        if at < len(self.columns):
+            self.columns[at:at] = [None] * count
+        self.formulas = {
+            (row, col + count if col >= at else col): formula
+            for (row, col), formula in self.formulas.items()
+        }
+
+    def delete_columns(self, at: int, count: int) -> None:
+        self.revision += 1
+        for column in self.columns[at:at + count]:
+            if column is not None:
+                self.cell_count -= len(column.kinds) - column.kinds.count(KIND_EMPTY)
+        del self.columns[at:at + count]
+        self.formulas = {
+            (row, col - count if col >= at + count else col): formula
+            for (row, col), formula in self.formulas.items()
+            if not at <= col < at + count
+        }
+
+    # --- cell access -------------------------------------------------------
+
+    def get(self, row: int, col: int) -> Optional[Tuple[Value, Optional[str], int, int]]:
+        # (value, formula, kind, version), or None for an empty cell
+        column = self._column(col)
+        slot = self._slot(row)
+        if column is None or not 0 <= slot < len(column) or not column.kinds[slot]:
+            return None
+        return self._read(column, slot), self.formulas.get((row, col)), column.kinds[slot], column.versions[slot]
+
+    def value(self, row: int, col: int) -> Value:
+        column = self._column(col)
+        slot = self._slot(row)
+        if column is None or not 0 <= slot < len(column) or not column.kinds[slot]:
+            return None
+        return self._read(column, slot)
+
+    def _read(self, column: Column, slot: int) -> Value:
+        if column.numeric[slot]:
+            return column.numbers[slot]
+        string_id = column.text[slot]
+        return self.strings.strings[string_id] if string_id >= 0 else None
+
+    def _write_number(self, column: Column, slot: int, row: int, number: Optional[float]) -> None:
+        new_value = 0.0 if number is None else number
+        new_flag = 0 if number is None else 1
+        index = column.index
+        if index is not None:
+            if row < len(index):
+                index.update(row, new_value - column.numbers[slot], new_flag - column.numeric[slot])
+            else:
+                column.index = None
+        column.numbers[slot] = new_value
+        column.numeric[slot] = new_flag
+
+    def set(self, row: int, col: int, value: Value, formula: Optional[str], kind: int, version: int) -> None:
+        self.revision += 1
+        column = self._column(col, create=True)
+        slot = self._slot_for_write(row)
+        column.grow(slot + 1)
+        if not column.kinds[slot]:
+            self.cell_count += 1
+        elif column.lookup is not None:
+            old = self._read(column, slot)
+            if old is not None:
+                column.lookup.remove(row, old)
+        column.kinds[slot] = kind
+        column.versions[slot] = version
+        if isinstance(value, (int, float)):
+            self._write_number(column, slot, row, value)
+            column.text[slot] = -1
+        else:
+            self._write_number(column, slot, row, None)
+            column.text[slot] = -1 if value is None else self.strings.intern(value)
+        if formula:
+            self.formulas[(row, col)] = formula
+        else:
+            self.formulas.pop((row, col), None)
+        if column.masks or column.lookup is not None:
+            value = self._read(column, slot)
+            if column.masks:
+                self._update_masks(column, row, value)
+            if column.lookup is not None and value is not None:
+                column.lookup.add(row, value)
+
+    def delete(self, row: int, col: int) -> bool:
+        column = self._column(col)
+        slot = self._slot(row)
+        if column is None or not 0 <= slot < len(column) or not column.kinds[slot]:
+            return False
+        if column.lookup is not None:
+            old = self._read(column, slot)
+            if old is not None:
+                column.lookup.remove(row, old)
+        self._write_number(column, slot, row, None)
+        column.clear_slot(slot)
+        self.formulas.pop((row, col), None)
+        self.cell_count -= 1
+        self.revision += 1
+        if column.masks:
+            self._update_masks(column, row, None)
+        return True
+
+    def clear(self) -> None:
+        revision = self.revision
+        self.__init__()
+        self.revision = revision + 1
+
+    def cells(self) -> Iterator[Tuple[int, int]]:
+        # Populated (row, col) pairs, column by column
+        for col, column in enumerate(self.columns):
+            if column is None:
+                continue
+            kinds = column.kinds
+            if self.row_map is None:
+                for row, kind in enumerate(kinds):
+                    if kind:
+                        yield row, col
+                continue
+            for row, slot in enumerate(self.row_map):
+                if slot < len(kinds) and kinds[slot]:
+                    yield row, col
+
+    def populated_rows(self, row_start: int, row_end: int, cols: Iterable[int]) -> List[int]:
+        # Logical rows in [row_start, row_end] holding a cell in any of cols,
+        # ascending. The kinds of all columns are OR-ed together as one big
+        # integer and scanned with a regex, so empty rows cost nothing in Python.
+        stop = row_end + 1
+        if self.row_map is not None:
+            stop = min(stop, len(self.row_map))
+        occupied = 0
+        width = 0
+        for col in cols:
+            column = self._column(col)
+            if column is None or row_start >= stop:
+                continue
+            if self.row_map is None:
+                kinds = column.kinds[row_start:stop]
+            else:
+                column.grow(self.physical_rows)
+                kinds = _take(column.kinds, self.row_map[row_start:stop])
+            occupied |= int.from_bytes(kinds, "little")
+            width = max(width, len(kinds))
+        if not occupied:
+            return []
+        mask = occupied.to_bytes(width, "little")
+        return [row_start + match.start() for match in _NONZERO.finditer(mask)]
+
+    def _logical_slots(self, start: int, stop: int) -> Tuple[Union[slice, array], int]:
+        # Physical slots of logical rows [start, stop) for _take, and the
+        # column length they need (grow columns to it before taking)
+        if self.row_map is None:
+            return slice(start, stop), stop
+        rows = self.row_map[start:min(stop, len(self.row_map))]
+        # Rows past the map hold no data; point them at a slot past every row
+        rows.extend(repeat(self.physical_rows, stop - start - len(rows)))
+        return rows, self.physical_rows + 1
+
+    # --- sorting -------------------------------------------------------------
+
+    def sort_order(self, start: int, stop: int, keys: List[Tuple[int, bool]]) -> List[int]:
+        # New order of logical rows [start, stop) as offsets from start, for
+        # (col, ascending) keys, first key first. Numbers sort before text and
+        # text compares case-insensitively (reversed when descending); blanks
+        # always go last. Equal rows keep their order.
+        size = stop - start
+        order = list(range(size))
+        identity = True
+        rows, capacity = self._logical_slots(start, stop)
+        for col, ascending in reversed(keys):
+            column = self._column(col)
+            if column is None:
+                continue
+            column.grow(capacity)
+            numeric = _take(column.numeric, rows)
+            text = _take(column.text, rows)
+            has_text = bytearray(map((-1).__lt__, text))
+            number_count, text_count = numeric.count(1), has_text.count(1)
+            if not number_count and not text_count:
+                continue
+
+            def pick(mask):
+                return list(compress(order, mask if identity else map(mask.__getitem__, order)))
+
+            # Split into numbers, text and blanks (stable), unless the column is all one of them
+            if number_count == size:
+                numbers, texts, blanks = order, [], []
+            elif text_count == size:
+                numbers, texts, blanks = [], order, []
+            else:
+                numbers = pick(numeric) if number_count else []
+                texts = pick(has_text) if text_count else []
+                blanks = pick(bytes(map(operator.or_, numeric, has_text)).translate(_FLIP))
+            if numbers:
+                values = _take(column.numbers, rows)
+                numbers.sort(key=values.__getitem__, reverse=not ascending)
+            if texts:
+                ranks = self._text_ranks(set(compress(text, has_text)))
+                text_keys = array("i", map(ranks.__getitem__, text))
+                texts.sort(key=text_keys.__getitem__, reverse=not ascending)
+            order = numbers + texts + blanks if ascending else texts + numbers + blanks
+            identity = False
+        return order
+
+    def _text_ranks(self, string_ids: Iterable[int]) -> Dict[int, int]:
+        # string id -> rank in case-insensitive order; -1 (no text) -> -1
+        strings = self.strings.strings
+        ranks = {-1: -1}
+        rank, previous = -1, None
+        for string_id in sorted(string_ids, key=lambda i: strings[i].lower()):
+            folded = strings[string_id].lower()
+            if folded != previous:
+                rank, previous = rank + 1, folded
+            ranks[string_id] = rank
+        return ranks
+
+    def permute_rows(self, start: int, order: List[int]) -> None:
+        # Row start + i takes the cells of row start + order[i]; only the row
+        # map slice and the keys of the moved formulas change
+        self.revision += 1
+        row_map = self._ensure_row_map()
+        stop = start + len(order)
+        if stop > len(row_map):
+            row_map.extend(self._allocate_slots(stop - len(row_map)))
+        moved = row_map[start:stop]
+        row_map[start:stop] = array("q", map(moved.__getitem__, order))
+        if any(start <= row < stop for row, _ in self.formulas):
+            new_rows = [0] * len(order)
+            for new, old in enumerate(order):
+                new_rows[old] = start + new
+            self.formulas = {
+                (new_rows[row - start] if start <= row < stop else row, col): formula
+                for (row, col), formula in self.formulas.items()
+            }
+        self._drop_row_indexes()
+
+    # --- filters -------------------------------------------------------------
+
+    def match_mask(self, col: int, op: str, operand: Union[str, float], stop: int) -> bytes:
+        # 1 for each logical row in [0, stop) whose cell in col satisfies
+        # `cell op operand`, with the operators and text rules of count_if
+        key = (op, operand.lower() if isinstance(operand, str) else float(operand))
+        column = self._column(col)
+        if column is None:
+            return bytes([_matches(key, None)]) * stop
+        masks = column.masks
+        mask = masks.pop(key, None) if masks else None
+        if mask is None:
+            mask = self._evaluate_mask(column, key, stop)
+            if masks is None:
+                masks = column.masks = {}
+            elif len(masks) >= FILTER_CACHE_SIZE:
+                del masks[next(iter(masks))]
+        elif len(mask) < stop:
+            mask.extend(bytes([_matches(key, None)]) * (stop - len(mask)))
+        # Most recently used last
+        masks[key] = mask
+        return bytes(mask[:stop])
+
+    def _evaluate_mask(self, column: Column, key: Tuple[str, Union[str, float]], stop: int) -> bytearray:
+        op, operand = key
+        rows, capacity = self._logical_slots(0, stop)
+        column.grow(capacity)
+        compare = _COMPARISONS["=" if op == "<>" else op]
+        if isinstance(operand, str):
+            matching = {string_id for string_id, text in enumerate(self.strings.strings)
+                        if compare(text.lower(), operand)}
+            mask = bytearray(map(matching.__contains__, _take(column.text, rows)))
+        else:
+            hits = bytearray(map(compare, _take(column.numbers, rows), repeat(operand)))
+            mask = bytearray(map(operator.and_, hits, _take(column.numeric, rows)))
+        return mask.translate(_FLIP) if op == "<>" else mask
+
+    def _update_masks(self, column: Column, row: int, value: Value) -> None:
+        for key, mask in column.masks.items():
+            if row >= len(mask):
+                mask.extend(bytes([_matches(key, None)]) * (row + 1 - len(mask)))
+            mask[row] = _matches(key, value)
+
+    # --- formula evaluation context ------------------------------------------
+
+    def _slices(self, area) -> Iterator[Tuple[Column, Union[slice, array], int, int]]:
+        # (column, physical rows, logical start, logical stop) for each column
+        start, stop = area.row_start, area.row_end + 1
+        row_map = self.row_map
+        if row_map is not None:
+            stop = min(stop, len(row_map))
+            if start >= stop:
+                return
+        for col in range(area.col_start, min(area.col_end + 1, len(self.columns))):
+            column = self.columns[col]
+            if column is None:
+                continue
+            if row_map is None:
+                if start < len(column):
+                    yield column, slice(start, stop), start, stop
+            else:
+                column.grow(self.physical_rows)
+                yield column, row_map[start:stop], start, stop
+
+    def _aggregate_index(self, column: Column) -> Optional[ColumnAggregateIndex]:
+        # Built on the second long aggregate since the last structural edit, so
+        # a one-off query after inserting a row does not pay for the build.
+        if column.index is None:
+            if not column.index_requested:
+                column.index_requested = True
+                return None
+            rows = slice(None) if self.row_map is None else self.row_map
+            column.index = ColumnAggregateIndex(_take(column.numbers, rows), _take(column.numeric, rows))
+        return column.index
+
+    def numbers(self, area) -> Iterator[float]:
+        for column, rows, _, _ in self._slices(area):
+            yield from compress(_take(column.numbers, rows), _take(column.numeric, rows))
+
+    def count(self, area) -> int:
+        total = 0
+        for column, rows, _, _ in self._slices(area):
+            kinds = _take(column.kinds, rows)
+            total += len(kinds) - kinds.count(KIND_EMPTY)
+        return total
+
+    def sum(self, area) -> float:
+        total = 0.0
+        for column, rows, start, stop in self._slices(area):
+            index = self._aggregate_index(column) if stop - start >= AGGREGATE_INDEX_MIN_ROWS else None
+            if index is not None:
+                total += index.sum(start, stop)
+            else:
+                total += sum(_take(column.numbers, rows))
+        return total
+
+    def count_numbers(self, area) -> int:
+        total = 0
+        for column, rows, start, stop in self._slices(area):
+            index = self._aggregate_index(column) if stop - start >= AGGREGATE_INDEX_MIN_ROWS else None
+            if index is not None:
+                total += index.count(start, stop)
+            else:
+                total += _take(column.numeric, rows).count(1)
+        return total
+
+    def count_if(self, area, op: str, operand: Union[str, float]) -> int:
+        # op is one of =, <>, <, <=, >, >=; text compares case-insensitively
+        if op == "<>":
+            size = (area.row_end - area.row_start + 1) * (area.col_end - area.col_start + 1)
+            return size - self.count_if(area, "=", operand)
+        if area.row_end - area.row_start + 1 < LOOKUP_INDEX_MIN_ROWS:
+            return self._scan_count_if(area, op, operand)
+        total = 0
+        start, stop = area.row_start, area.row_end + 1
+        for col in range(area.col_start, area.col_end + 1):
+            column = self._column(col)
+            if column is None:
+                continue
+            index = self._lookup_index(column)
+            if op == "=":
+                total += index.count(operand, start, stop)
+                continue
+            counted = None if isinstance(operand, str) else index.count_compare(op, operand, start, stop)
+            if counted is None:
+                counted = self._scan_count_if(area._replace(col_start=col, col_end=col), op, operand)
+            total += counted
+        return total
+
+    def _scan_count_if(self, area, op: str, operand: Union[str, float]) -> int:
+        compare = _COMPARISONS[op]
+        total = 0
+        if isinstance(operand, str):
+            target = operand.lower()
+            matching = {string_id for string_id, text in enumerate(self.strings.strings)
+                        if compare(text.lower(), target)}
+            if not matching:
+                return 0
+            for column, rows, _, _ in self._slices(area):
+                total += sum(map(matching.__contains__, _take(column.text, rows)))
+            return total
+        for column, rows, _, _ in self._slices(area):
+            values = compress(_take(column.numbers, rows), _take(column.numeric, rows))
+            total += sum(map(compare, values, repeat(operand)))
+        return total
+
+    # --- lookups -------------------------------------------------------------
+
+    def _lookup_index(self, column: Column) -> ColumnLookupIndex:
+        if column.lookup is None:
+            stop = len(column) if self.row_map is None else len(self.row_map)
+            rows, capacity = self._logical_slots(0, stop)
+            column.grow(capacity)
+            numbers = _take(column.numbers, rows)
+            text = _take(column.text, rows)
+            strings = self.strings.strings
+            cells = [(row, numbers[row]) for row in compress(range(stop), _take(column.numeric, rows))]
+            cells += [(row, strings[text[row]]) for row in compress(range(stop), map((-1).__lt__, text))]
+            column.lookup = ColumnLookupIndex(cells)
+        return column.lookup
+
+    def lookup(self, area, value: Value) -> Optional[int]:
+        # Offset of the first cell equal to value (text ignoring case) in a
+        # one-column area, or along the first row of a wider one; None when
+        # there is none
+        if value is None:
+            return None
+        if area.col_start == area.col_end and area.row_end - area.row_start + 1 >= LOOKUP_INDEX_MIN_ROWS:
+            column = self._column(area.col_start)
+            row = None if column is None else self._lookup_index(column).first(
+                value, area.row_start, area.row_end + 1)
+            return None if row is None else row - area.row_start
+        key = _lookup_key(value)
+        size, cell_at = self._vector(area)
+        for offset in range(size):
+            cell = cell_at(offset)
+            if cell is not None and _lookup_key(cell) == key:
+                return offset
+        return None
+
+    def lookup_sorted(self, area, value: Value, descending: bool = False) -> Optional[int]:
+        # Approximate match in a vector sorted ascending (the last cell <=
+        # value) or descending (the last cell >= value), by binary search;
+        # numbers come before text and blanks count as past the end
+        if value is None:
+            return None
+        size, cell_at = self._vector(area)
+        target = _order_key(value, descending)
+        lo, hi = 0, size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key = _order_key(cell_at(mid), descending)
+            if (key >= target) if descending else (key <= target):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo - 1 if lo else None
+
+    def _vector(self, area) -> Tuple[int, Callable[[int], Value]]:
+        # Length and value-at-offset of a one-column area, or of the first
+        # row of any other area
+        row, col = area.row_start, area.col_start
+        if col == area.col_end:
+            return area.row_end - row + 1, lambda offset: self.value(row + offset, col)
+        return area.col_end - col + 1, lambda offset: self.value(row, col + offset)
+
+
+def _lookup_key(value: Union[str, float]) -> Union[str, float]:
+    return value.lower() if isinstance(value, str) else value
+
+
+def _order_key(value: Value, descending: bool) -> Tuple[int, Union[str, float]]:
+    if value is None:
+        return (-1, 0.0) if descending else (2, 0.0)
+    if isinstance(value, str):
+        return 1, value.lower()
+    return 0, value
+
+
+_COMPARISONS = {
+    "=": operator.eq,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def _matches(key: Tuple[str, Union[str, float]], value: Value) -> int:
+    # One cell against a match_mask key; text keys are already lower case
+    op, operand = key
+    if op == "<>":
+        return 1 - _matches(("=", operand), value)
+    compare = _COMPARISONS[op]
+    if isinstance(operand, str):
+        return int(isinstance(value, str) and compare(value.lower(), operand))
+    return int(isinstance(value, (int, float)) and compare(value, operand))
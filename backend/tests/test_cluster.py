@@ -0,0 +1,88 @@
+import asyncio
+import pytest
+from collections import Counter
+from bus import BusBroker, InProcessBus, UnixSocketBus
+from cluster import Cluster, HashRing, cluster_from_env
+
+
+def test_hash_ring_spreads_and_moves_few_keys():
+    ring = HashRing(["w0", "w1", "w2"])
+    keys = [f"sheet-{i}" for i in range(3000)]
+    before = {key: ring.owner(key) for key in keys}
+    counts = Counter(before.values())
+    assert set(counts) == {"w0", "w1", "w2"}
+    assert min(counts.values()) > 600
+
+    # Only the keys of the removed worker move
+    ring.remove("w2")
+    after = {key: ring.owner(key) for key in keys}
+    assert all(after[key] == before[key] for key in keys if before[key] != "w2")
+    assert set(after.values()) == {"w0", "w1"}
+
+    # Owners agree across instances (processes)
+    assert HashRing(["w2", "w1", "w0"]).owner("sheet-7") == before["sheet-7"]
+
+
+def test_cluster_ownership():
+    clusters = [Cluster(worker, ["w0", "w1"], InProcessBus()) for worker in ("w0", "w1")]
+    for sheet_id in ("a", "b", "c", "d"):
+        assert sum(cluster.owns(sheet_id) for cluster in clusters) == 1
+
+
+def test_cluster_from_env_needs_a_shared_bus(monkeypatch):
+    monkeypatch.delenv("BUS_SOCKET", raising=False)
+    monkeypatch.setenv("CLUSTER_WORKERS", "w0,w1")
+    monkeypatch.setenv("WORKER_ID", "w1")
+    with pytest.raises(ValueError):
+        cluster_from_env()
+    monkeypatch.setenv("CLUSTER_WORKERS", "w1")
+    assert isinstance(cluster_from_env().bus, InProcessBus)
+    monkeypatch.setenv("CLUSTER_WORKERS", "w0,w1")
+    monkeypatch.setenv("BUS_SOCKET", "/tmp/bus.sock")
+    assert isinstance(cluster_from_env().bus, UnixSocketBus)
+
+
+def test_in_process_bus_delivers_in_order():
+    received = []
+
+    async def main():
+        bus = InProcessBus()
+        await bus.start()
+        bus.subscribe("sheet:1", received.append)
+        bus.publish("sheet:1", {"n": 1})
+        bus.publish("sheet:2", {"n": 2})
+        bus.publish("sheet:1", {"n": 3})
+        await bus.drain()
+        await bus.close()
+
+    asyncio.run(main())
+    assert received == [{"n": 1}, {"n": 3}]
+
+
+def test_unix_socket_bus_through_broker(tmp_path):
+    path = str(tmp_path / "bus.sock")
+    received = {"a": [], "b": []}
+
+    async def main():
+        broker = BusBroker(path)
+        await broker.start()
+        a, b = UnixSocketBus(path), UnixSocketBus(path)
+        a.subscribe("worker:a", received["a"].append)
+        await a.start()
+        await b.start()
+        b.subscribe("sheet:1", received["b"].append)
+        await asyncio.sleep(0.05)
+
+        b.publish("worker:a", {"kind": "command", "n": 1})
+        a.publish("sheet:1", {"kind": "cells", "n": 2})
+        a.publish("sheet:2", {"kind": "cells", "n": 3})
+        for _ in range(100):
+            if received["a"] and received["b"]:
+                break
+            await asyncio.sleep(0.01)
+        await a.close()
+        await b.close()
+        await broker.close()
+
+    asyncio.run(main())
+    assert received == {"a": [{"kind": "command", "n": 1}], "b": [{"kind": "cells", "n": 2}]}
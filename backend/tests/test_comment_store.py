@@ -0,0 +1,81 @@
+import pytest
+from comment_store import COMMENT_MAX_PAGE_SIZE, CommentStore
+from comments import CommentService
+from formula import parse_range
+from models import Comment
+
+
+def _store():
+    store = CommentStore()
+    for i, (cell_ref, user_id) in enumerate([("B2", "ann"), ("A1", "bob"), ("B2", "bob"), ("D9", "ann"),
+                                             ("Z2", "ann")]):
+        store.put(Comment(f"c{i}", user_id, cell_ref, f"text {i}", 100.0 + i))
+    return store
+
+
+def test_pages_by_time_user_and_cell():
+    store = _store()
+    page, cursor = store.page(limit=2)
+    assert [c.comment_id for c in page] == ["c0", "c1"]
+    page, cursor = store.page(cursor=cursor, limit=2)
+    assert [c.comment_id for c in page] == ["c2", "c3"]
+    page, cursor = store.page(cursor=cursor, limit=2)
+    assert [c.comment_id for c in page] == ["c4"] and cursor is None
+
+    assert [c.comment_id for c in store.page(user_id="ann")[0]] == ["c0", "c3", "c4"]
+    assert [c.comment_id for c in store.page(cell_ref="B2", user_id="bob")[0]] == ["c2"]
+    assert [c.comment_id for c in store.page(since=101.0, until=103.0)[0]] == ["c1", "c2"]
+    assert store.get("c3").cell_ref == "D9"
+
+
+def test_markers_for_viewport():
+    store = _store()
+    assert store.markers(parse_range("A1:D10")) == [("A1", 1), ("B2", 2), ("D9", 1)]
+    assert store.markers(parse_range("B2:C3")) == [("B2", 2)]
+    assert store.markers(parse_range("E1:Y5")) == []
+
+
+def test_changes_feed_with_edits_and_deletes():
+    service = CommentService()
+    a = service.add_comment("s1", "A1", "ann", "first")
+    b = service.add_comment("s1", "B1", "bob", "second")
+    changes, seq = service.changes_since("s1", 0)
+    assert [comment_id for _, comment_id, _ in changes] == [a.comment_id, b.comment_id] and seq == 2
+
+    service.edit_comment("s1", a.comment_id, "edited")
+    service.delete_comment("s1", b.comment_id)
+    changes, seq = service.changes_since("s1", 2)
+    assert [(comment_id, comment and comment.text) for _, comment_id, comment in changes] == [
+        (a.comment_id, "edited"), (b.comment_id, None)]
+    assert service.get_comments("s1", "B1") == []
+    assert service.changes_since("s1", seq) == ([], 4)
+    assert service.changes_since("s1", 99)[0] is None
+
+
+def test_restore_round_trip_and_journal():
+    source = CommentService()
+    journal = []
+    source.journal = lambda method, args: journal.append((method, args))
+    kept = source.add_comment("s1", "C3", "ann", "keep")
+    gone = source.add_comment("s1", "C3", "bob", "drop")
+    source.delete_comment("s1", gone.comment_id)
+
+    replayed = CommentService()
+    for method, args in journal:
+        getattr(replayed, method)(*args)
+    assert replayed.dump_comments("s1") == source.dump_comments("s1")
+
+    restored = CommentService()
+    restored.restore_comments("s1", source.dump_comments("s1"))
+    assert restored.get_comment("s1", kept.comment_id).text == "keep"
+    # Changes from before the restore are gone; the client reloads
+    assert restored.changes_since("s1", 0)[0] is None
+
+
+def test_list_comments_rejects_bad_limits():
+    service = CommentService()
+    service.add_comment("s1", "A1", "ann", "first")
+    for limit in (0, -1, COMMENT_MAX_PAGE_SIZE + 1):
+        with pytest.raises(ValueError):
+            service.list_comments("s1", limit=limit)
+    assert len(service.list_comments("s1", limit=1)[0]) == 1
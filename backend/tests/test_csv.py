@@ -48,4 +48,93 @@ def test_csv_import_export(simulate_csv_import_export, spreadsheet_service):
         writer.writerow(row_data)
     csv_exported = output.getvalue()
     assert "Alice" in csv_exported
-    assert "Bob" in csv_exported
\ No newline at end of file
+    assert "Bob" in csv_exported
+
+def feed_in_chunks(importer, data, size):
+    for i in range(0, len(data), size):
+        importer.feed(data[i:i + size])
+    return importer.close()
+
+
+def test_streaming_import_loads_rows(spreadsheet_service):
+    from csv_stream import CsvImporter
+    data = "Name,Age\nAlice,30\nBob,25\n".encode("utf-8")
+    importer = CsvImporter(spreadsheet_service, "stream")
+    assert feed_in_chunks(importer, data, 3) == 3
+    assert spreadsheet_service.get_cell_value("stream", "A1").value == "Name"
+    assert spreadsheet_service.get_cell_value("stream", "B2").value == 30.0
+    assert spreadsheet_service.get_cell_value("stream", "A3").value == "Bob"
+    assert importer.bytes_read == len(data)
+
+
+def test_streaming_import_handles_split_quotes_and_utf8(spreadsheet_service):
+    from csv_stream import CsvImporter
+    data = '\ufeff"multi\nline, quoted",café\nlast,"a ""b"""'.encode("utf-8")
+    importer = CsvImporter(spreadsheet_service, "quoted")
+    # One byte at a time splits both the quoted newline and the multibyte é
+    assert feed_in_chunks(importer, data, 1) == 2
+    assert spreadsheet_service.get_cell_value("quoted", "A1").value == "multi\nline, quoted"
+    assert spreadsheet_service.get_cell_value("quoted", "B1").value == "café"
+    assert spreadsheet_service.get_cell_value("quoted", "B2").value == 'a "b"'
+
+
+def test_streaming_import_literal_quote_inside_field(spreadsheet_service):
+    from csv_stream import CsvImporter
+    # 5" is a literal quote to csv.reader; it must not hold the rest back
+    data = ('size,note\n5",screen\n' + "x,y\n" * 50 + '"a ""q"" b",z\n').encode()
+    importer = CsvImporter(spreadsheet_service, "literal", max_pending_bytes=32)
+    assert feed_in_chunks(importer, data, 7) == 53
+    assert spreadsheet_service.get_cell_value("literal", "A2").value == '5"'
+    assert spreadsheet_service.get_cell_value("literal", "B2").value == "screen"
+    assert spreadsheet_service.get_cell_value("literal", "A53").value == 'a "q" b'
+
+
+def test_streaming_import_replaces_sheet_and_grows_it(spreadsheet_service):
+    from csv_stream import CsvImporter
+    spreadsheet_service.set_cell_value("grow", "A1", "1")
+    spreadsheet_service.set_cell_value("grow", "B1", "", formula="=A1*2")
+    row = ",".join(str(i) for i in range(30))
+    importer = CsvImporter(spreadsheet_service, "grow")
+    feed_in_chunks(importer, ("\n".join([row] * 150) + "\n").encode(), 64)
+    sheet = spreadsheet_service.get_or_create_sheet("grow")
+    assert (sheet.rows, sheet.columns) == (150, 30)
+    assert spreadsheet_service.get_cell_value("grow", "B1").formula is None
+    assert spreadsheet_service.get_cell_value("grow", "AD150").value == 29.0
+
+
+def test_streaming_import_limits(spreadsheet_service):
+    from csv_stream import CsvImporter, CsvImportError
+    importer = CsvImporter(spreadsheet_service, "limits", max_bytes=10)
+    with pytest.raises(CsvImportError):
+        feed_in_chunks(importer, b"a,b\n" * 5, 4)
+    importer = CsvImporter(spreadsheet_service, "limits", max_pending_bytes=8)
+    with pytest.raises(CsvImportError):
+        feed_in_chunks(importer, b'"never closed\nstill open\n', 4)
+
+
+def test_streaming_export_skips_empty_rows_and_projects(spreadsheet_service):
+    from csv_stream import export_rows
+    spreadsheet_service.set_cell_value("out", "A1", "Name")
+    spreadsheet_service.set_cell_value("out", "C1", "Age")
+    spreadsheet_service.set_cell_value("out", "A4", "Alice")
+    spreadsheet_service.set_cell_value("out", "C4", "30")
+    sheet = spreadsheet_service.get_or_create_sheet("out")
+    sheet.columns = 3
+
+    text = b"".join(export_rows(sheet)).decode("utf-8")
+    # Gap rows are kept as blank records, trailing empty rows are dropped
+    assert text == "Name,,Age\r\n,,\r\n,,\r\nAlice,,30.0\r\n"
+
+    projected = b"".join(export_rows(sheet, 3, 3, [2, 0])).decode("utf-8")
+    assert projected == "30.0,Alice\r\n"
+
+
+def test_streaming_export_yields_chunks(spreadsheet_service, monkeypatch):
+    import csv_stream
+    monkeypatch.setattr(csv_stream, "EXPORT_CHUNK_BYTES", 100)
+    spreadsheet_service.load_rows("big", 0, [[f"row{i}", str(i)] for i in range(200)])
+    sheet = spreadsheet_service.get_or_create_sheet("big")
+    chunks = list(csv_stream.export_rows(sheet, columns=[0, 1]))
+    assert len(chunks) > 1
+    rows = list(csv.reader(io.StringIO(b"".join(chunks).decode("utf-8"))))
+    assert rows[0] == ["row0", "0.0"] and rows[199] == ["row199", "199.0"]
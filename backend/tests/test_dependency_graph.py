@@ -0,0 +1,36 @@
+import pytest
+from dependency_graph import DependencyGraph, CircularReferenceError
+
+@pytest.fixture
+def graph():
+    return DependencyGraph()
+
+def test_area_dependents(graph):
+    # B1 = SUM(A1:A10)
+    graph.set_formula((0, 1), [], [(0, 0, 9, 0)])
+    assert graph.direct_dependents((4, 0)) == {(0, 1)}
+    assert graph.direct_dependents((10, 0)) == set()
+
+    graph.clear_formula((0, 1))
+    assert graph.direct_dependents((4, 0)) == set()
+    assert graph.area_listeners == {}
+
+def test_recalc_order_is_topological(graph):
+    # B1 reads A1, C1 reads A1 and B1, D1 reads C1
+    graph.set_formula((0, 1), [(0, 0)], [])
+    graph.set_formula((0, 2), [(0, 0), (0, 1)], [])
+    graph.set_formula((0, 3), [], [(0, 2, 0, 2)])
+
+    order = graph.recalc_order([(0, 0)])
+    assert order == [(0, 1), (0, 2), (0, 3)]
+
+def test_cycle_detection(graph):
+    graph.set_formula((0, 1), [(0, 0)], [])
+    assert graph.would_create_cycle((0, 0), [(0, 1)], [])
+    assert graph.would_create_cycle((0, 0), [], [(0, 0, 5, 1)])
+    assert not graph.would_create_cycle((0, 2), [(0, 1)], [])
+
+    # Force a loop past the guard to check recalc_order still refuses it
+    graph.set_formula((0, 0), [(0, 1)], [])
+    with pytest.raises(CircularReferenceError):
+        graph.recalc_order([(0, 0)])
@@ -0,0 +1,118 @@
+import asyncio
+import json
+import pytest
+from fanout import FanOut, POLICY_COALESCE, POLICY_DISCONNECT, POLICY_DROP_CURSOR
+
+
+class FakeSocket:
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.frames = []
+        self.closed = False
+
+    async def send(self, frame):
+        if self.fail:
+            raise ConnectionError("socket gone")
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.frames.append(json.loads(frame))
+
+    async def close(self):
+        self.closed = True
+
+
+def test_publish_does_not_wait_for_slow_clients():
+    async def run():
+        fanout = FanOut()
+        fast, slow = FakeSocket(), FakeSocket(delay=0.5)
+        fanout.add("s", "fast", fast.send)
+        fanout.add("s", "slow", slow.send)
+        assert fanout.publish("s", {"type": "cell_update", "cellRef": "A1"}) == 2
+        await fanout.channels["s"]["fast"].drain()
+        assert fast.frames == [{"type": "cell_update", "cellRef": "A1"}]
+        assert slow.frames == []
+        fanout.remove("s", "slow")
+
+    asyncio.run(run())
+
+
+def test_dead_socket_is_dropped_without_affecting_others():
+    async def run():
+        gone = []
+        fanout = FanOut(on_disconnect=lambda sheet_id, client: gone.append(client))
+        ok, dead = FakeSocket(), FakeSocket(fail=True)
+        fanout.add("s", "ok", ok.send)
+        fanout.add("s", "dead", dead.send, dead.close)
+        fanout.publish("s", {"n": 1})
+        await fanout.drain("s")
+        await asyncio.sleep(0)
+        fanout.publish("s", {"n": 2})
+        await fanout.drain("s")
+        assert ok.frames == [{"n": 1}, {"n": 2}]
+        assert gone == ["dead"] and dead.closed
+        assert list(fanout.channels["s"]) == ["ok"]
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("policy", [POLICY_COALESCE, POLICY_DROP_CURSOR, POLICY_DISCONNECT])
+def test_overflow_policies(policy):
+    async def run():
+        fanout = FanOut(max_queue=2, policy=policy)
+        socket = FakeSocket()
+        channel = fanout.add("s", "c", socket.send)
+        # Nothing is written until the writer task gets to run
+        fanout.publish("s", {"x": 1}, key=("cursor", "u1"))
+        fanout.publish("s", {"edit": 1})
+        fanout.publish("s", {"x": 2}, key=("cursor", "u1"))
+        fanout.publish("s", {"edit": 2})
+        await channel.drain()
+        return socket.frames, channel.closed
+
+    frames, closed = asyncio.run(run())
+    if policy == POLICY_COALESCE:
+        # The newer cursor replaced the queued one, then made room for the edit
+        assert frames == [{"edit": 1}, {"edit": 2}] and not closed
+    elif policy == POLICY_DROP_CURSOR:
+        assert frames == [{"edit": 1}, {"edit": 2}] and not closed
+    else:
+        assert frames == [] and closed
+
+
+def test_overflow_of_undroppable_messages_disconnects():
+    async def run():
+        fanout = FanOut(max_queue=2, policy=POLICY_COALESCE)
+        channel = fanout.add("s", "c", FakeSocket().send)
+        for n in range(3):
+            fanout.publish("s", {"edit": n})
+        return channel.closed, "c" in fanout.channels["s"]
+
+    assert asyncio.run(run()) == (True, False)
+
+
+def test_edits_are_written_before_transient_messages():
+    async def run():
+        fanout = FanOut()
+        socket = FakeSocket()
+        fanout.add("s", "c", socket.send)
+        fanout.publish("s", {"cursors": 1}, key=("cursors", 1))
+        fanout.publish("s", {"edit": 1})
+        fanout.publish("s", {"edit": 2})
+        await fanout.drain("s")
+        return socket.frames
+
+    assert asyncio.run(run()) == [{"edit": 1}, {"edit": 2}, {"cursors": 1}]
+
+
+def test_publish_to_selected_clients():
+    async def run():
+        fanout = FanOut()
+        sockets = {name: FakeSocket() for name in "abc"}
+        for name, socket in sockets.items():
+            fanout.add("s", name, socket.send)
+        assert fanout.publish("s", {"n": 1}, clients=["a", "c", "gone"]) == 2
+        await fanout.drain("s")
+        return {name: socket.frames for name, socket in sockets.items()}
+
+    assert asyncio.run(run()) == {"a": [{"n": 1}], "b": [], "c": [{"n": 1}]}
@@ -0,0 +1,58 @@
+import base64
+import pytest
+from filters import parse_predicates, run_filter
+from spreadsheet import SpreadsheetService
+
+
+@pytest.fixture
+def sheet_service():
+    service = SpreadsheetService()
+    rows = [("150", "open"), ("90", "Open"), ("300", "closed"), ("", "open"), ("120", "OPEN"), ("x", "open")]
+    for row, (amount, status) in enumerate(rows, start=1):
+        if amount:
+            service.set_cell_value("s1", f"C{row}", amount)
+        service.set_cell_value("s1", f"D{row}", status)
+    return service
+
+
+def _rows(service, where, **kwargs):
+    sheet = service.get_or_create_sheet("s1")
+    return run_filter(sheet, parse_predicates(where), **kwargs)
+
+
+def test_filter_rows_and_bitmap(sheet_service):
+    where = [{"column": "C", "op": ">", "value": 100}, {"column": "D", "op": "=", "value": "open"}]
+    result = _rows(sheet_service, where)
+    assert (result["rows"], result["count"], result["truncated"]) == ([1, 5], 2, False)
+    assert _rows(sheet_service, where, limit=1)["truncated"]
+
+    bitmap = base64.b64decode(_rows(sheet_service, where, fmt="bitmap")["bitmap"])
+    assert bitmap[0] == 0b10001
+    # "<>" also matches blanks and other types, as in COUNTIF
+    assert _rows(sheet_service, [{"column": "C", "op": "<>", "value": 150}])["rows"][:4] == [2, 3, 4, 5]
+    assert _rows(sheet_service, [{"column": "C", "op": "=", "value": "X"}])["rows"] == [6]
+
+
+def test_cached_masks_follow_edits(sheet_service):
+    where = [{"column": "C", "op": ">=", "value": 120}, {"column": "D", "op": "=", "value": "open"}]
+    assert _rows(sheet_service, where)["rows"] == [1, 5]
+    column = sheet_service.get_or_create_sheet("s1").store.columns[2]
+    assert len(column.masks) == 1
+
+    sheet_service.set_cell_value("s1", "C2", "500")
+    sheet_service.set_cell_value("s1", "C1", "1")
+    sheet_service.set_cell_value("s1", "C90", "999")
+    sheet_service.set_cell_value("s1", "D90", "open")
+    assert _rows(sheet_service, where)["rows"] == [2, 5, 90]
+
+    # Row moves drop the masks; the next query rebuilds them
+    sheet_service.delete_row("s1", 2)
+    assert column.masks is None
+    assert _rows(sheet_service, where)["rows"] == [4, 89]
+
+
+def test_parse_predicates_rejects_bad_conditions():
+    for where in ([], [{"column": "C", "op": "~", "value": 1}], [{"op": "=", "value": 1}],
+                  [{"column": "C", "value": [1]}], "C>1"):
+        with pytest.raises(ValueError):
+            parse_predicates(where)
@@ -0,0 +1,74 @@
+import pytest
+from formula import Area, FormulaError, compile_formula
+
+class DictContext:
+    def __init__(self, values):
+        self.values = values
+
+    def value(self, row, col):
+        return self.values.get((row, col))
+
+    def _in_area(self, area):
+        for (row, col), value in self.values.items():
+            if area.row_start <= row <= area.row_end and area.col_start <= col <= area.col_end:
+                yield value
+
+    def numbers(self, area):
+        return [v for v in self._in_area(area) if isinstance(v, float)]
+
+    def count(self, area):
+        return sum(1 for v in self._in_area(area) if v is not None)
+
+    def sum(self, area):
+        return sum(self.numbers(area))
+
+    def count_numbers(self, area):
+        return len(self.numbers(area))
+
+@pytest.fixture
+def ctx():
+    # A1..A3 = 1, 2, 3 and B1..B3 = 10, 20, "x"
+    return DictContext({
+        (0, 0): 1.0, (1, 0): 2.0, (2, 0): 3.0,
+        (0, 1): 10.0, (1, 1): 20.0, (2, 1): "x",
+    })
+
+def test_arithmetic_and_precedence(ctx):
+    assert compile_formula("=1 + 2 * 3")(ctx) == 7
+    assert compile_formula("=(1 + 2) * 3")(ctx) == 9
+    assert compile_formula("=-A2 ^ 2")(ctx) == 4
+    assert compile_formula("=B2 / A2 - A1")(ctx) == 9
+
+def test_nested_functions_and_rectangular_ranges(ctx):
+    assert compile_formula("=SUM(A1:B3)")(ctx) == 36
+    assert compile_formula("=sum(a1:a3, 4) * 2")(ctx) == 20
+    assert compile_formula("=AVERAGE(A1:A3) + COUNT(B1:B3)")(ctx) == 5
+    assert compile_formula("=SUM(A1, SUM(B1:B2))")(ctx) == 31
+
+def test_references_are_collected():
+    compiled = compile_formula("=A1 + SUM(B3:C1) + A1")
+    assert compiled.refs == ((0, 0),)
+    assert compiled.areas == (Area(0, 1, 2, 2),)
+
+def test_compiled_formulas_are_cached():
+    assert compile_formula("=SUM(A1:A3)") is compile_formula("=SUM(A1:A3)")
+
+def test_errors(ctx):
+    assert compile_formula("=A1 / 0")(ctx) == "#DIV/0!"
+    assert compile_formula("=B3 + 1")(ctx) == "#VALUE!"
+    with pytest.raises(FormulaError):
+        compile_formula("=NOPE(A1:A3)")
+    with pytest.raises(FormulaError):
+        compile_formula("=SUM(A1:A3")
+    with pytest.raises(FormulaError):
+        compile_formula("=A1:A3")
+
+
+def test_numeric_errors():
+    ctx = DictContext({(0, 0): -8.0})
+    assert compile_formula("=10^400")(ctx) == "#NUM!"
+    assert compile_formula("=(-8)^(1/3)")(ctx) == "#NUM!"
+    assert compile_formula("=A1^0.5")(ctx) == "#NUM!"
+    assert compile_formula("=1E308*10")(ctx) == "#NUM!"
+    assert compile_formula("=VLOOKUP(1, A1:B3, 1E308*10)")(ctx) == "#NUM!"
+    assert compile_formula("=A1^2")(ctx) == 64.0
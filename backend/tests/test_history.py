@@ -21,4 +21,17 @@ def test_log_and_get_history(history_service):
 
 def test_get_empty_history(history_service):
     hist = history_service.get_history("sheet_empty", "A1")
-    assert hist == []
\ No newline at end of file
+    assert hist == []
+def test_log_batch_groups_entries(history_service):
+    batch_id = history_service.log_batch("sheet_batch", [("A1", None, 1.0), ("A2", "x", 2.0)], "user_abc")
+    batch = history_service.get_batch("sheet_batch", batch_id)
+    assert [entry.cell_ref for entry in batch] == ["A1", "A2"]
+    assert history_service.get_history("sheet_batch", "A2")[0].batch_id == batch_id
+
+def test_get_history_needs_a_cell_and_is_capped(history_service):
+    for i in range(5):
+        history_service.log_edit("sheet_cap", "A1", i, i + 1, "user_abc")
+    history_service.log_edit("sheet_cap", "B1", None, 1, "user_abc")
+    assert history_service.get_history("sheet_cap", None) == []
+    assert history_service.get_history("sheet_cap", "not a ref") == []
+    assert [e.new_value for e in history_service.get_history("sheet_cap", "A1", limit=2)] == [4, 5]
@@ -0,0 +1,64 @@
+from history import HistoryService
+from history_store import ACTION_EDIT, ACTION_REDO, ACTION_UNDO, HistoryStore
+
+
+def test_query_by_cell_user_and_time():
+    log = HistoryStore()
+    log.append([("A1", None, 1.0, None, None)], "ann", 1000.0)
+    log.append([("A1", 1.0, "two", None, None), ("B2", None, 3.0, None, "=1+2")], "bob", 1010.5, "b1")
+    log.append([("A1", "two", 4.0, None, None)], "ann", 1020.25)
+
+    assert [e.new_value for e in log.query("A1")] == [1.0, "two", 4.0]
+    assert [e.cell_ref for e in log.query(user_id="bob")] == ["A1", "B2"]
+    assert [e.new_value for e in log.query("A1", "ann", since=1005.0)] == [4.0]
+    assert [e.new_value for e in log.query(since=1010.5, until=1020.25)] == ["two", 3.0]
+    assert [e.new_value for e in log.query("A1", limit=2)] == ["two", 4.0]
+
+    entry = log.batch("b1")[1]
+    assert (entry.new_formula, entry.batch_id, entry.timestamp) == ("=1+2", "b1", 1010.5)
+
+
+def test_compaction_keeps_newest_entries():
+    log = HistoryStore(capacity=100)
+    for i in range(250):
+        log.append([(f"A{i % 7 + 1}", float(i), float(i + 1), None, None)], f"user{i % 3}", 1000.0 + i)
+    entries = list(log.entries())
+    assert len(entries) <= 100
+    assert entries[-1].new_value == 250.0
+    assert [e.new_value for e in entries] == sorted(e.new_value for e in entries)
+    assert [e.new_value for e in log.query("A1")] == [e.new_value for e in entries if e.cell_ref == "A1"]
+    assert all(e.user_id == "user1" for e in log.query(user_id="user1"))
+
+
+def test_undo_redo_stacks():
+    log = HistoryStore()
+    log.append([("A1", None, 1.0, None, None)], "ann", 1.0)
+    log.append([("A1", 1.0, 2.0, None, None), ("A2", None, 5.0, None, "=2+3")], "ann", 2.0, "b1")
+    log.append([("C1", None, "x", None, None)], "bob", 3.0)
+
+    # Ann's last action is the batch; it reverts to the earlier values
+    pending = log.pending("ann")
+    assert pending == [("A1", 2.0, 1.0, None, None), ("A2", 5.0, None, "=2+3", None)]
+    log.append([(ref, current, target, formula, old) for ref, current, target, formula, old in pending],
+               "ann", 4.0, "u1", ACTION_UNDO)
+    assert log.pending("ann", redo=True) == [("A1", 1.0, 2.0, None, None), ("A2", None, 5.0, None, "=2+3")]
+
+    log.append([("A1", 1.0, 2.0, None, None)], "ann", 5.0, "r1", ACTION_REDO)
+    assert log.pending("ann", redo=True) is None
+    # A new edit clears the redo stack
+    log.append([("B1", None, 1.0, None, None)], "ann", 6.0, None, ACTION_EDIT)
+    assert log.pending("ann", redo=True) is None
+    assert log.pending("bob") == [("C1", "x", None, None, None)]
+    assert log.pending("carol") is None
+
+
+def test_restore_entries_round_trip():
+    source = HistoryService()
+    source.log_edit("s1", "A1", None, 1.0, "ann")
+    source.log_batch("s1", [("A1", 1.0, 2.0), ("B1", None, 3.0, None, "=1+2")], "ann")
+    dumped = source.dump_entries("s1")
+
+    restored = HistoryService()
+    restored.restore_entries("s1", dumped)
+    assert restored.dump_entries("s1") == dumped
+    assert restored.pending_undo("s1", "ann") == source.pending_undo("s1", "ann")
@@ -0,0 +1,62 @@
+import pytest
+from oplog import OperationLog
+
+
+@pytest.fixture
+def oplog():
+    return OperationLog(capacity=3)
+
+
+def test_append_stamps_increasing_seq(oplog):
+    first, second = {"type": "cell_update"}, {"type": "cells_update"}
+    assert oplog.append("s", first) == 1
+    assert oplog.append("s", second) == 2
+    assert second["seq"] == 2 and oplog.current("s") == 2
+    assert oplog.append("other", {}) == 1
+
+
+def test_since_returns_missing_ops(oplog):
+    for n in range(3):
+        oplog.append("s", {"n": n})
+    epoch = oplog.epoch("s")
+    assert [op["n"] for op in oplog.since("s", 1, epoch)] == [1, 2]
+    assert oplog.since("s", 3, epoch) == []
+    assert [op["n"] for op in oplog.since("s", 0)] == [0, 1, 2]
+
+
+def test_since_requires_snapshot_when_too_far_behind(oplog):
+    for n in range(5):
+        oplog.append("s", {"n": n})
+    epoch = oplog.epoch("s")
+    assert [op["seq"] for op in oplog.since("s", 2, epoch)] == [3, 4, 5]
+    assert oplog.since("s", 1, epoch) is None
+    # A seq from before a restart, ahead of or behind the new log
+    assert oplog.since("s", 99, epoch) is None
+    assert oplog.since("s", 4, "old-epoch") is None
+    assert oplog.since("s", 4) is None
+
+
+def test_log_epochs_and_replace_barrier(oplog):
+    message = {"type": "cell_update"}
+    oplog.append("s", message)
+    assert message["epoch"] == oplog.epoch("s") != OperationLog().epoch("s")
+    epoch = oplog.epoch("s")
+
+    oplog.replace("s", {"type": "sheet_replaced"})
+    oplog.append("s", {"type": "cell_update"})
+    # Clients from before the import reload; later ones replay as usual
+    assert oplog.since("s", 1, epoch) is None
+    assert oplog.since("s", 0) is None
+    assert [op["type"] for op in oplog.since("s", 2, epoch)] == ["cell_update"]
+
+
+def test_dropped_log_starts_a_new_epoch(oplog):
+    for n in range(2):
+        oplog.append("s", {"n": n})
+    epoch = oplog.epoch("s")
+    oplog.drop("s")
+    assert "s" not in oplog.ops and oplog.current("s") == 0
+    oplog.append("s", {"n": 0})
+    oplog.append("s", {"n": 1})
+    assert oplog.epoch("s") != epoch
+    assert oplog.since("s", 1, epoch) is None
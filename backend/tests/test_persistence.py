@@ -0,0 +1,144 @@
+import os
+import pytest
+from comments import CommentService
+from history import HistoryService
+from persistence import PersistenceEngine
+from spreadsheet import SpreadsheetService
+
+
+def open_engine(path):
+    services = SpreadsheetService(), HistoryService(), CommentService()
+    engine = PersistenceEngine(str(path))
+    engine.attach(*services)
+    return engine, services
+
+
+def populate(services):
+    sheets, history, comments = services
+    sheets.set_cell_value("s1", "A1", "10")
+    sheets.set_cell_value("s1", "A2", "hello")
+    sheets.set_cells("s1", [("B1", None, "=A1*2"), ("C3", "4.5", None)])
+    sheets.insert_row("s1", 1)
+    history.log_edit("s1", "A1", None, 10.0, "u1")
+    history.log_batch("s1", [("B1", None, 20.0), ("C3", None, 4.5)], "u1")
+    comments.add_comment("s1", "A2", "u2", "check this")
+
+
+def assert_restored(services):
+    sheets, history, comments = services
+    assert sheets.get_cell_value("s1", "A2").value == 10.0
+    assert sheets.get_cell_value("s1", "A3").value == "hello"
+    assert sheets.get_cell_value("s1", "B2").formula == "=A2*2"
+    assert sheets.get_cell_value("s1", "C4").value == 4.5
+    # The dependency graph is rebuilt, so edits still propagate
+    sheets.set_cell_value("s1", "A2", "7")
+    assert sheets.get_cell_value("s1", "B2").value == 14.0
+    assert [e.new_value for e in history.get_history("s1", "A1")] == [10.0]
+    batch_id = history.get_history("s1", "B1")[0].batch_id
+    assert len(history.get_batch("s1", batch_id)) == 2
+    assert [c.text for c in comments.get_comments("s1", "A2")] == ["check this"]
+
+
+def test_recover_from_log(tmp_path):
+    engine, services = open_engine(tmp_path)
+    populate(services)
+    engine.close()
+
+    engine, services = open_engine(tmp_path)
+    assert engine.recover() == (0, 7)
+    assert_restored(services)
+
+
+def test_recover_from_snapshot_and_log_tail(tmp_path):
+    engine, services = open_engine(tmp_path)
+    populate(services)
+    assert engine.checkpoint() == 1
+    assert os.path.getsize(engine.wal_path) == 0
+    services[0].set_cell_value("s1", "D1", "tail")
+    engine.close()
+
+    engine, services = open_engine(tmp_path)
+    assert engine.recover() == (1, 1)
+    assert services[0].get_cell_value("s1", "D1").value == "tail"
+    assert_restored(services)
+
+
+def test_torn_tail_is_ignored(tmp_path):
+    engine, services = open_engine(tmp_path)
+    services[0].set_cell_value("s1", "A1", "1")
+    services[0].set_cell_value("s1", "A2", "2")
+    engine.close()
+    with open(engine.wal_path, "r+b") as wal:
+        wal.truncate(os.path.getsize(engine.wal_path) - 3)
+
+    engine, services = open_engine(tmp_path)
+    assert engine.recover() == (0, 1)
+    assert services[0].get_cell_value("s1", "A2").value is None
+    # New records go after the last good one
+    services[0].set_cell_value("s1", "A3", "3")
+    engine.close()
+    engine, services = open_engine(tmp_path)
+    assert engine.recover() == (0, 2)
+    assert services[0].get_cell_value("s1", "A3").value == 3.0
+
+
+def test_replay_skips_records_older_than_snapshot(tmp_path):
+    engine, services = open_engine(tmp_path)
+    services[0].set_cell_value("s1", "A1", "1")
+    engine.sync()
+    # Simulate a crash after the snapshot was written but before the log
+    # was truncated
+    engine.write_snapshot("s1")
+    engine.close()
+
+    engine, services = open_engine(tmp_path)
+    assert engine.recover() == (1, 0)
+    assert services[0].get_cell_value("s1", "A1").version == 1
+
+
+def test_snapshot_keeps_history_columns_and_undo(tmp_path):
+    engine, services = open_engine(tmp_path)
+    sheets, history, comments = services
+    history.log_batch("s1", [("A1", None, "ünïcode", None, "=B1&\"✓\"")], "u1")
+    comments.add_comment("s1", "A1", "u2", "naïve ✓")
+    engine.checkpoint()
+    engine.close()
+
+    engine, services = open_engine(tmp_path)
+    assert engine.recover() == (1, 0)
+    sheets, history, comments = services
+    entry = history.get_history("s1", "A1")[0]
+    assert (entry.new_value, entry.new_formula, entry.user_id) == ("ünïcode", "=B1&\"✓\"", "u1")
+    assert history.pending_undo("s1", "u1") == [("A1", "ünïcode", None, "=B1&\"✓\"", None)]
+    assert [(c.user_id, c.text) for c in comments.get_comments("s1", "A1")] == [("u2", "naïve ✓")]
+
+
+def test_edits_during_checkpoint_write_are_kept(tmp_path):
+    engine, services = open_engine(tmp_path)
+    services[0].set_cell_value("s1", "A1", "1")
+    finish = engine.start_checkpoint()
+    # Lands in the new log while the snapshot is still being written
+    services[0].set_cell_value("s1", "A2", "2")
+    assert os.path.exists(engine.old_wal_path)
+    assert finish() == 1
+    assert not os.path.exists(engine.old_wal_path)
+    engine.close()
+
+    engine, services = open_engine(tmp_path)
+    assert engine.recover() == (1, 1)
+    assert services[0].get_cell_value("s1", "A2").value == 2.0
+
+
+def test_unfinished_checkpoint_replays_old_log(tmp_path):
+    engine, services = open_engine(tmp_path)
+    services[0].set_cell_value("s1", "A1", "1")
+    engine.start_checkpoint()
+    # Crash before the snapshot was written
+    services[0].set_cell_value("s1", "A2", "2")
+    engine.close()
+
+    engine, services = open_engine(tmp_path)
+    assert engine.recover() == (0, 2)
+    assert services[0].get_cell_value("s1", "A1").value == 1.0
+    assert engine.checkpoint() == 1
+    assert not os.path.exists(engine.old_wal_path)
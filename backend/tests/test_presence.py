@@ -0,0 +1,62 @@
+import asyncio
+import pytest
+from presence import PresenceHub
+from user import UserService
+
+
+@pytest.fixture
+def published():
+    return []
+
+
+@pytest.fixture
+def hub(published):
+    users = UserService()
+    users.add_user("s", "alice", "u1")
+    users.add_user("s", "bob", "u2")
+    return PresenceHub(lambda sheet_id, message, key: published.append(message), users.get_users)
+
+
+def test_cursor_moves_are_coalesced_per_tick(hub, published):
+    for col in range(10):
+        hub.update_cursor("s", "u1", {"cellRef": f"A{col}"})
+    hub.update_cursor("s", "u2", {"cellRef": "B1"})
+    assert hub.tick("s") == 1
+    assert published == [{"type": "cursor_batch", "cursors": [
+        {"userId": "u1", "position": {"cellRef": "A9"}},
+        {"userId": "u2", "position": {"cellRef": "B1"}},
+    ]}]
+
+
+def test_only_deltas_are_sent(hub, published):
+    hub.update_cursor("s", "u1", {"cellRef": "A1"})
+    hub.update_cursor("s", "u2", {"cellRef": "B1"})
+    hub.tick("s")
+    hub.update_cursor("s", "u1", {"cellRef": "A2"})
+    hub.update_cursor("s", "u2", {"cellRef": "B1"})
+    hub.tick("s")
+    assert published[-1]["cursors"] == [{"userId": "u1", "position": {"cellRef": "A2"}}]
+    # Nothing moved: the tick is idle
+    assert hub.tick("s") == 0
+
+
+def test_membership_changes_send_one_user_list(hub, published):
+    hub.members_changed("s", "u1")
+    hub.members_changed("s", "u2")
+    hub.remove_user("s", "u2")
+    assert hub.tick("s") == 1
+    assert published[0]["type"] == "user_presence"
+    assert published[0]["users"][0]["userId"] == "u1"
+    assert published[0]["users"][0]["lastActive"] > 0
+
+
+def test_ticker_runs_at_rate_and_stops_when_idle(published):
+    async def run():
+        hub = PresenceHub(lambda sheet_id, message, key: published.append(message), lambda sheet_id: [], hz=100)
+        for n in range(50):
+            hub.update_cursor("s", "u1", n)
+        await asyncio.sleep(0.05)
+        return hub._tasks["s"].done()
+
+    assert asyncio.run(run())
+    assert published == [{"type": "cursor_batch", "cursors": [{"userId": "u1", "position": 49}]}]
@@ -0,0 +1,78 @@
+import random
+import pytest
+from formula import Area
+from range_index import ColumnLookupIndex, FenwickTree
+from storage import ColumnStore, KIND_NUMBER, KIND_TEXT, AGGREGATE_INDEX_MIN_ROWS, LOOKUP_INDEX_MIN_ROWS
+
+def test_fenwick_matches_naive_sums():
+    values = [float(random.randint(-50, 50)) for _ in range(300)]
+    tree = FenwickTree(values)
+    for _ in range(50):
+        position = random.randrange(len(values))
+        delta = float(random.randint(-10, 10))
+        values[position] += delta
+        tree.add(position, delta)
+        start = random.randrange(len(values))
+        stop = random.randint(start, len(values))
+        assert tree.range_sum(start, stop) == sum(values[start:stop])
+
+def test_store_keeps_index_in_step_with_writes():
+    store = ColumnStore()
+    rows = AGGREGATE_INDEX_MIN_ROWS * 2
+    for row in range(rows):
+        store.set(row, 0, 1.0, None, KIND_NUMBER, 1)
+    area = Area(0, 0, rows - 1, 0)
+    assert store.sum(area) == rows
+    assert store.columns[0].index is None
+    assert store.sum(area) == rows
+    assert store.columns[0].index is not None
+
+    store.set(10, 0, 101.0, None, KIND_NUMBER, 2)
+    store.set(11, 0, "text", None, KIND_TEXT, 2)
+    store.delete(12, 0)
+    assert store.sum(area) == rows + 100 - 2
+    assert store.count_numbers(area) == rows - 2
+    assert store.sum(Area(13, 0, rows - 1, 0)) == rows - 13
+
+def test_lookup_index_first_count_and_compare():
+    index = ColumnLookupIndex([(0, 5.0), (1, "Ann"), (3, 5.0), (4, 2.0), (6, "ann")])
+    assert index.first("ANN", 0, 10) == 1
+    assert index.first("ann", 2, 10) == 6
+    assert index.first(5.0, 1, 3) is None
+    assert index.count(5.0, 0, 10) == 2
+    assert index.count_compare(">", 2.0, 0, 10) == 2
+    assert index.count_compare("<=", 5.0, 1, 10) is None
+
+    index.remove(0, 5.0)
+    index.add(8, 1.0)
+    assert index.first(5.0, 0, 10) == 3
+    assert index.count_compare("<", 5.0, 0, 10) == 2
+
+def test_store_lookups_follow_writes():
+    store = ColumnStore()
+    rows = LOOKUP_INDEX_MIN_ROWS * 2
+    for row in range(rows):
+        store.set(row, 0, f"key{row}", None, KIND_TEXT, 1)
+        store.set(row, 1, float(row % 10), None, KIND_NUMBER, 1)
+    column = Area(0, 0, rows - 1, 0)
+    assert store.lookup(column, "KEY70") == 70
+    assert store.columns[0].lookup is not None
+
+    store.set(70, 0, "moved", None, KIND_TEXT, 2)
+    store.set(100, 0, "key70", None, KIND_TEXT, 2)
+    store.delete(5, 0)
+    assert store.lookup(column, "key70") == 100
+    assert store.lookup(column, "moved") == 70
+    assert store.lookup(column, "key5") is None
+    assert store.lookup(Area(80, 0, rows - 1, 0), "key70") == 20
+
+    numbers = Area(0, 1, rows - 1, 1)
+    for op, operand in (("=", 3.0), (">", 6.0), ("<=", 2.0), ("=", "x")):
+        assert store.count_if(numbers, op, operand) == store._scan_count_if(numbers, op, operand)
+    store.set(3, 1, 100.0, None, KIND_NUMBER, 2)
+    assert store.count_if(numbers, ">", 6.0) == store._scan_count_if(numbers, ">", 6.0)
+
+    # Row moves drop the index; the next lookup rebuilds it
+    store.delete_rows(0, 1)
+    assert store.columns[0].lookup is None
+    assert store.lookup(column, "key70") == 99
@@ -0,0 +1,77 @@
+import pytest
+from comments import CommentService
+from history import HistoryService
+from persistence import PersistenceEngine
+from residency import SheetResidency
+from spreadsheet import SpreadsheetService
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def setup(tmp_path):
+    services = SpreadsheetService(), HistoryService(), CommentService()
+    engine = PersistenceEngine(str(tmp_path))
+    engine.attach(*services)
+    clock = Clock()
+    connected = set()
+    residency = SheetResidency(engine, budget_bytes=10 ** 9, idle_seconds=60,
+                               pinned=connected.__contains__, clock=clock)
+    residency.attach()
+    return residency, services, clock, connected
+
+
+def test_evicted_sheet_reloads_on_access(setup):
+    residency, (sheets, history, comments), clock, _ = setup
+    sheets.set_cell_value("s1", "A1", "42")
+    history.log_edit("s1", "A1", None, 42.0, "u1")
+    comments.add_comment("s1", "A1", "u1", "answer")
+
+    residency.evict("s1")
+    assert "s1" not in sheets.spreadsheets and "s1" not in history.logs
+    assert residency.evicted == {"s1"}
+
+    assert [c.text for c in comments.get_comments("s1", "A1")] == ["answer"]
+    assert sheets.get_cell_value("s1", "A1").value == 42.0
+    assert len(history.get_history("s1", "A1")) == 1
+    assert residency.reloads == 1 and residency.evicted == set()
+
+
+def test_enforce_evicts_lru_unpinned_over_budget(setup):
+    residency, (sheets, _, _), clock, connected = setup
+    for sheet_id in ("a", "b", "c"):
+        sheets.load_rows(sheet_id, 0, [["1", "x"]] * 500)
+        clock.now += 1
+    connected.add("a")
+    residency.budget_bytes = residency.sheet_bytes("c") + 1
+    # "a" is the least recently used but pinned, so "b" and "c" make room
+    assert residency.enforce() == ["b", "c"]
+    assert set(sheets.spreadsheets) == {"a"}
+    metrics = residency.metrics()
+    assert metrics["residentSheets"] == 1 and metrics["evictedSheets"] == 2
+    assert metrics["sheets"][0]["pinned"] is True
+
+
+def test_idle_sheets_hibernate(setup):
+    residency, (sheets, _, _), clock, _ = setup
+    sheets.set_cell_value("old", "A1", "1")
+    clock.now = 30
+    sheets.set_cell_value("new", "A1", "1")
+    clock.now = 70
+    assert residency.enforce() == ["old"]
+    clock.now = 200
+    assert residency.enforce() == ["new"]
+
+
+def test_sheet_bytes_tracks_store_size(setup):
+    residency, (sheets, _, _), _, _ = setup
+    sheets.set_cell_value("s1", "A1", "1")
+    small = residency.sheet_bytes("s1")
+    sheets.load_rows("s1", 0, [["1"] * 10] * 1000)
+    assert residency.sheet_bytes("s1") > small + 1000 * 10 * 18
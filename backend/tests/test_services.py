@@ -0,0 +1,24 @@
+import asyncio
+from services import SheetLocks
+
+
+def test_sheet_locks_serialize_work_per_sheet():
+    locks = SheetLocks()
+    events = []
+
+    async def work(sheet_id, name):
+        async with locks(sheet_id):
+            events.append(f"{name} start")
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            events.append(f"{name} end")
+
+    async def main():
+        await asyncio.gather(work("s1", "a"), work("s1", "b"), work("s2", "c"))
+
+    asyncio.run(main())
+    assert events.index("a end") < events.index("b start")
+    # Another sheet is not held up
+    assert events.index("c start") < events.index("a end")
+    # Unused locks are not kept around
+    assert len(locks.locks) == 0
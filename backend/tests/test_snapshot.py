@@ -0,0 +1,50 @@
+import pytest
+from formula import parse_range
+from snapshot import build_snapshot, sheet_etag
+from spreadsheet import SpreadsheetService
+
+
+@pytest.fixture
+def sheet():
+    service = SpreadsheetService()
+    service.set_cell_value("snap", "A1", "name")
+    service.set_cell_value("snap", "B1", "10")
+    service.set_cell_value("snap", "B5", "", formula="=B1*2")
+    sheet = service.get_or_create_sheet("snap")
+    sheet.rows, sheet.columns = 8, 3
+    return sheet
+
+
+def test_row_major_snapshot_skips_empty_rows(sheet):
+    snapshot = build_snapshot(sheet)
+    assert snapshot["range"] == "A1:C8"
+    assert snapshot["data"] == [[0, ["name", 10.0, None]], [4, [None, 20.0, None]]]
+    assert snapshot["formulas"] == {"B5": "=B1*2"}
+    assert snapshot["nextPage"] is None
+
+
+def test_columnar_snapshot_pages(sheet):
+    first = build_snapshot(sheet, parse_range("A1:C8"), page=0, page_rows=4, fmt="columns")
+    assert first["data"] == {"A": ["name", None, None, None], "B": [10.0, None, None, None]}
+    assert first["formulas"] == {} and first["nextPage"] == 1
+    second = build_snapshot(sheet, parse_range("A1:C8"), page=1, page_rows=4, fmt="columns")
+    assert second["firstRow"] == 4
+    assert second["data"] == {"B": [20.0, None, None, None]}
+    assert second["formulas"] == {"B5": "=B1*2"} and second["nextPage"] is None
+
+
+def test_etag_changes_with_every_edit(sheet):
+    etag = sheet_etag(sheet)
+    assert sheet_etag(sheet) == etag
+    sheet.store.delete(0, 0)
+    assert sheet_etag(sheet) != etag
+    etag = sheet_etag(sheet)
+    sheet.store.clear()
+    assert sheet_etag(sheet) != etag
+
+
+def test_invalid_snapshot_requests(sheet):
+    with pytest.raises(ValueError):
+        build_snapshot(sheet, fmt="xml")
+    with pytest.raises(ValueError):
+        build_snapshot(sheet, page_rows=0)
@@ -1,5 +1,5 @@
 import pytest
-from spreadsheet import SpreadsheetService
+from spreadsheet import FormulaError, SpreadsheetService
 from models import CellType, Spreadsheet
 
 @pytest.fixture
@@ -70,4 +70,151 @@ def test_sort_column_ascending(service, sheet_id):
     service.sort_column(sheet_id, "A", ascending=True)
     sheet = service.get_or_create_sheet(sheet_id)
     values_sorted = [sheet.cells.get(f"A{i}").value for i in range(1, 6)]
-    assert values_sorted == [1, 3, 5, 7, "NULL"] or values_sorted[:-1] == [1, 3, 5, 7]
\ No newline at end of file
+    assert values_sorted == [1, 3, 5, 7, "NULL"] or values_sorted[:-1] == [1, 3, 5, 7]
+
+def test_formula_dependents_recalculated(service, sheet_id):
+    for i in range(1, 4):
+        service.set_cell_value(sheet_id, f"A{i}", str(i))
+    service.set_cell_value(sheet_id, "B1", "", formula="=SUM(A1:A3)")
+    service.set_cell_value(sheet_id, "C1", "", formula="SUM(B1:B1)")
+    assert service.get_cell_value(sheet_id, "C1").value == 6
+
+    service.set_cell_value(sheet_id, "A2", "10")
+    assert service.get_cell_value(sheet_id, "B1").value == 14
+    assert service.get_cell_value(sheet_id, "C1").value == 14
+    assert service.get_dependents(sheet_id, "A2") == ["B1", "C1"]
+
+def test_circular_formula_rejected(service, sheet_id):
+    service.set_cell_value(sheet_id, "B1", "", formula="SUM(A1:A3)")
+    with pytest.raises(Exception):
+        service.set_cell_value(sheet_id, "A2", "", formula="SUM(B1:B2)")
+    assert service.get_cell_value(sheet_id, "A2").formula is None
+
+def test_formula_range_aggregates(service, sheet_id):
+    for i, value in enumerate(["4", "8", "open", "6", "Open"], start=1):
+        service.set_cell_value(sheet_id, f"A{i}", value)
+    sheet = service.get_or_create_sheet(sheet_id)
+    assert service.evaluate_formula(sheet, "=MIN(A1:A5)") == 4
+    assert service.evaluate_formula(sheet, "=MAX(A1:A5)") == 8
+    assert service.evaluate_formula(sheet, "=STDEV(A1:A5)") == pytest.approx(2.0)
+    assert service.evaluate_formula(sheet, "=AVERAGE(A1:A5)") == pytest.approx(6.0)
+    assert service.evaluate_formula(sheet, '=COUNTIF(A1:A5, ">5")') == 2
+    assert service.evaluate_formula(sheet, '=COUNTIF(A1:A5, "open")') == 2
+    assert service.evaluate_formula(sheet, '=COUNTIF(A1:A5, "<>open")') == 3
+
+def test_insert_and_delete_row_shift_cells_and_formulas(service, sheet_id):
+    for i in range(1, 6):
+        service.set_cell_value(sheet_id, f"A{i}", str(i))
+    service.set_cell_value(sheet_id, "B1", "", formula="=SUM(A1:A5)")
+    service.set_cell_value(sheet_id, "B2", "", formula="=A4*2")
+
+    service.insert_row(sheet_id, 2)
+    assert service.get_cell_value(sheet_id, "A2").value is None
+    assert service.get_cell_value(sheet_id, "A3").value == 2
+    assert service.get_cell_value(sheet_id, "B3").formula == "=A5*2"
+    assert service.get_cell_value(sheet_id, "B1").formula == "=SUM(A1:A6)"
+
+    service.set_cell_value(sheet_id, "A2", "100")
+    assert service.get_cell_value(sheet_id, "B1").value == 115
+
+    service.delete_row(sheet_id, 5)
+    assert service.get_cell_value(sheet_id, "A5").value == 5
+    assert service.get_cell_value(sheet_id, "B1").formula == "=SUM(A1:A5)"
+    assert service.get_cell_value(sheet_id, "B1").value == 111
+    assert service.get_cell_value(sheet_id, "B3").value == "#REF!"
+
+def test_insert_and_delete_column_shift_cells(service, sheet_id):
+    service.set_cell_value(sheet_id, "A1", "1")
+    service.set_cell_value(sheet_id, "B1", "2")
+    service.set_cell_value(sheet_id, "C1", "", formula="=A1+B1")
+
+    service.insert_column(sheet_id, "B")
+    assert service.get_cell_value(sheet_id, "C1").value == 2
+    assert service.get_cell_value(sheet_id, "D1").formula == "=A1+C1"
+
+    service.delete_column(sheet_id, "A")
+    assert service.get_cell_value(sheet_id, "B1").value == 2
+    assert service.get_cell_value(sheet_id, "C1").value == "#REF!"
+
+
+def test_set_cells_batch_recalculates_once(service, sheet_id):
+    service.set_cell_value(sheet_id, "C1", "", formula="=SUM(A1:A3)")
+    cells, recalculated = service.set_cells(sheet_id, [
+        ("A1", "1", None), ("A2", "2", None), ("A3", "3", None),
+        ("B1", "", "=A1*10"), ("B2", "", "=B1+A2"),
+    ])
+    assert cells["B2"].value == 12 and cells["A3"].value == 3
+    assert recalculated == ["C1"]
+    c1 = service.get_cell_value(sheet_id, "C1")
+    assert c1.value == 6 and c1.version == 2
+
+
+def test_set_cells_evaluates_formulas_without_references(service, sheet_id):
+    cells, _ = service.set_cells(sheet_id, [("A1", "", "=1+2"), ("B1", "", "=A1*2")])
+    assert cells["A1"].value == 3 and cells["B1"].value == 6
+    assert service.get_cell_value(sheet_id, "A1").formula == "=1+2"
+
+
+def test_set_cells_rejects_whole_batch(service, sheet_id):
+    service.set_cell_value(sheet_id, "A1", "5")
+    with pytest.raises(ValueError):
+        service.set_cells(sheet_id, [("A1", "6", None), ("not a ref", "1", None)])
+    with pytest.raises(FormulaError):
+        service.set_cells(sheet_id, [("A1", "7", None), ("B1", "", "=C1"), ("C1", "", "=B1")])
+    assert service.get_cell_value(sheet_id, "A1").value == 5
+    assert not service.get_or_create_sheet(sheet_id).dependencies.has_formula((0, 1))
+
+def test_sort_rows_moves_whole_rows_and_recalculates(service, sheet_id):
+    for row, (name, score) in enumerate([("cy", "3"), ("al", "1"), ("bo", "2")], start=2):
+        service.set_cell_value(sheet_id, f"A{row}", name)
+        service.set_cell_value(sheet_id, f"B{row}", score)
+    service.set_cell_value(sheet_id, "A1", "name")
+    service.set_cell_value(sheet_id, "C2", "", formula="=B2*10")
+    service.set_cell_value(sheet_id, "D1", "", formula="=B2")
+
+    recalculated = service.sort_rows(sheet_id, [(1, False)], row_start=1, row_end=3)
+    sheet = service.get_or_create_sheet(sheet_id)
+    assert [sheet.cells.get(f"A{row}").value for row in range(1, 5)] == ["name", "cy", "bo", "al"]
+    # The formula moved with its row (text unchanged); D1 reads the new B2
+    assert service.get_cell_value(sheet_id, "C2").formula == "=B2*10"
+    assert service.get_cell_value(sheet_id, "D1").value == 3
+    assert sorted(recalculated) == ["C2", "D1"]
+    assert sorted(service.get_dependents(sheet_id, "B2")) == ["C2", "D1"]
+
+    with pytest.raises(ValueError):
+        service.sort_rows(sheet_id, [])
+
+
+def test_lookup_functions(service, sheet_id):
+    for row, (name, score) in enumerate([("al", "10"), ("bo", "20"), ("cy", "30")], start=1):
+        service.set_cell_value(sheet_id, f"A{row}", name)
+        service.set_cell_value(sheet_id, f"B{row}", score)
+
+    def formula(text):
+        return service.set_cell_value(sheet_id, "D1", "", formula=text).value
+
+    assert formula('=VLOOKUP("BO", A1:B3, 2, FALSE)') == 20
+    assert formula("=VLOOKUP(25, B1:B3, 1)") == 20
+    assert formula('=VLOOKUP("zz", A1:B3, 2, FALSE)') == "#N/A"
+    assert formula('=VLOOKUP("al", A1:B3, 3, FALSE)') == "#REF!"
+    assert formula('=XLOOKUP("cy", A1:A3, B1:B3)') == 30
+    assert formula('=XLOOKUP("zz", A1:A3, B1:B3, "none")') == "none"
+    assert formula('=MATCH("CY", A1:A3, 0)') == 3
+    assert formula("=MATCH(25, B1:B3)") == 2
+    assert formula("=MATCH(5, B1:B3)") == "#N/A"
+
+    # Lookups recalculate when the table changes
+    service.set_cell_value(sheet_id, "E1", "", formula='=XLOOKUP("bo", A1:A3, B1:B3)')
+    service.set_cell_value(sheet_id, "B2", "99")
+    assert service.get_cell_value(sheet_id, "E1").value == 99
+
+
+def test_dependent_errors_do_not_abort_an_edit(service, sheet_id):
+    journal = []
+    service.journal = lambda method, args: journal.append((method, args))
+    service.set_cell_value(sheet_id, "A1", "2")
+    service.set_cell_value(sheet_id, "B1", "", formula="=10^A1")
+    cell, recalculated = service.set_cell(sheet_id, "A1", "400")
+    assert cell.value == 400 and recalculated == ["B1"]
+    assert service.get_cell_value(sheet_id, "B1").value == "#NUM!"
+    assert journal[-1] == ("set_cell_value", [sheet_id, "A1", "400", None])
@@ -0,0 +1,101 @@
+import pytest
+from formula import Area
+from models import Cell, CellType, Spreadsheet
+from storage import ColumnStore, KIND_NUMBER, KIND_TEXT
+
+@pytest.fixture
+def store():
+    return ColumnStore()
+
+def test_set_get_and_delete(store):
+    store.set(2, 1, 4.5, None, KIND_NUMBER, 1)
+    store.set(0, 3, "hello", None, KIND_TEXT, 2)
+    assert store.get(2, 1) == (4.5, None, KIND_NUMBER, 1)
+    assert store.value(0, 3) == "hello"
+    assert store.value(500, 1) is None
+    assert len(store) == 2
+
+    assert store.delete(2, 1)
+    assert not store.delete(2, 1)
+    assert store.get(2, 1) is None
+    assert list(store.cells()) == [(0, 3)]
+
+def test_strings_are_interned(store):
+    for row in range(100):
+        store.set(row, 0, "open" if row % 2 else "closed", None, KIND_TEXT, 1)
+    assert store.strings.strings == ["closed", "open"]
+
+def test_area_aggregates(store):
+    for row in range(10):
+        store.set(row, 0, float(row), None, KIND_NUMBER, 1)
+    store.set(3, 1, "x", None, KIND_TEXT, 1)
+    area = Area(0, 0, 4, 1)
+    assert sum(store.numbers(area)) == 10
+    assert store.count(area) == 6
+
+def test_cells_view_round_trip():
+    sheet = Spreadsheet()
+    sheet.cells["B2"] = Cell(value="=SUM", formula="SUM(A1:A2)", cell_type=CellType.FORMULA, version=3)
+    cell = sheet.cells["B2"]
+    assert cell.formula == "SUM(A1:A2)"
+    assert cell.cell_type == CellType.FORMULA
+    assert cell.version == 3
+    assert "B2" in sheet.cells
+    assert "NULL" not in sheet.cells
+    assert list(sheet.cells) == ["B2"]
+
+    sheet.cells.clear()
+    assert sheet.cells.get("B2") is None
+
+def test_row_indirection_moves_no_data(store):
+    for row in range(2000):
+        store.set(row, 0, float(row), None, KIND_NUMBER, 1)
+    store.set(1999, 1, "=A1", "=A1", KIND_TEXT, 1)
+    numbers = store.columns[0].numbers
+
+    store.insert_rows(0, 3)
+    assert store.columns[0].numbers is numbers
+    assert store.value(3, 0) == 0.0
+    assert store.value(0, 0) is None
+    assert (2002, 1) in store.formulas
+    assert store.sum(Area(0, 0, 2002, 0)) == sum(range(2000))
+
+    store.delete_rows(3, 10)
+    assert store.value(3, 0) == 10.0
+    assert len(store) == 1991
+    # Freed slots get reused by the next insert, already cleared
+    store.insert_rows(0, 1)
+    assert store.value(0, 0) is None
+    assert store.count(Area(0, 0, 5000, 0)) == 1990
+
+
+def test_populated_rows(store):
+    store.set(5, 1, "x", None, KIND_TEXT, 1)
+    store.set(2, 3, 1.0, None, KIND_NUMBER, 1)
+    store.set(900, 0, 3.0, None, KIND_NUMBER, 1)
+    assert store.populated_rows(0, 1000, range(4)) == [2, 5, 900]
+    assert store.populated_rows(3, 10, [1, 3]) == [5]
+    store.insert_rows(0, 2)
+    assert store.populated_rows(0, 1000, range(4)) == [4, 7, 902]
+
+def test_sort_order_multi_key_and_permute(store):
+    rows = [("b", 2.0), ("A", 1.0), (None, 5.0), ("a", 3.0), (7.0, 0.0), ("b", 1.0)]
+    for row, (first, second) in enumerate(rows):
+        if first is not None:
+            store.set(row, 0, first, None, KIND_NUMBER if isinstance(first, float) else KIND_TEXT, row + 1)
+        store.set(row, 1, second, None, KIND_NUMBER, 1)
+
+    # Numbers, then text case-insensitively, blanks last; ties by the second key
+    assert store.sort_order(0, 6, [(0, True), (1, True)]) == [4, 1, 3, 5, 0, 2]
+    # Descending keeps blanks last and equal rows in order
+    assert store.sort_order(0, 6, [(0, False)]) == [0, 5, 1, 3, 4, 2]
+    # Rows past the data are blanks
+    assert store.sort_order(4, 8, [(0, True)]) == [0, 1, 2, 3]
+
+    store.set(5, 2, 2.0, "=B6*2", KIND_NUMBER, 1)
+    store.permute_rows(0, [4, 1, 3, 5, 0, 2])
+    assert [store.value(row, 0) for row in range(6)] == [7.0, "A", "a", "b", "b", None]
+    assert [store.value(row, 1) for row in range(6)] == [0.0, 1.0, 3.0, 1.0, 2.0, 5.0]
+    # Whole rows move with their versions and formulas
+    assert store.get(3, 0)[3] == 6
+    assert store.formulas == {(3, 2): "=B6*2"}
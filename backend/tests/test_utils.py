@@ -0,0 +1,19 @@
+import pytest
+from utils import (MAX_COLUMNS, MAX_ROWS, cell_ref_to_index, column_index,
+                   column_letters, index_to_cell_ref, validate_cell_ref)
+
+def test_round_trip_multi_letter_columns():
+    for ref, coords in [("A1", (0, 0)), ("Z99", (98, 25)), ("AA1", (0, 26)),
+                        ("AZ250000", (249999, 51)), ("XFD1048576", (MAX_ROWS - 1, MAX_COLUMNS - 1))]:
+        assert cell_ref_to_index(ref) == coords
+        assert index_to_cell_ref(*coords) == ref
+
+def test_column_letters():
+    assert column_letters(0) == "A"
+    assert column_letters(701) == "ZZ"
+    assert column_index("AAA") == 702
+
+def test_validate_cell_ref():
+    assert validate_cell_ref("B120000")
+    for ref in ["", "A", "1", "A0", "a1", "A01", "A1B", "XFE1", "A1048577", "A١"]:
+        assert not validate_cell_ref(ref)
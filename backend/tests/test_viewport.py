@@ -0,0 +1,72 @@
+import pytest
+from formula import Area, parse_range
+from utils import MAX_ROWS
+from viewport import MAX_MARGIN, ViewportIndex
+
+
+@pytest.fixture
+def index():
+    index = ViewportIndex(bucket_rows=16)
+    index.set("top", parse_range("A1:J40"))
+    index.set("bottom", parse_range("A1001:J1040"), margin=5)
+    return index
+
+
+def test_set_applies_margin_and_buckets(index):
+    assert index.viewports["bottom"] == Area(995, 0, 1044, 14)
+    assert index.clients_for(Area(10, 2, 10, 2)) == {"top"}
+    assert index.clients_for(Area(998, 12, 998, 12)) == {"bottom"}
+    assert index.clients_for(Area(0, 0, 2000, 0)) == {"top", "bottom"}
+    index.remove("bottom")
+    assert index.clients_for(Area(998, 12, 998, 12)) == set()
+    assert all("bottom" not in clients for clients in index.buckets.values())
+
+
+def test_set_validates_margin_and_clips_to_the_sheet(index):
+    for margin in (-1, MAX_MARGIN + 1, 10 ** 15):
+        with pytest.raises(ValueError):
+            index.set("huge", parse_range("A1:B2"), margin)
+    assert "huge" not in index
+    area = index.set("edge", Area(MAX_ROWS - 2, 0, MAX_ROWS - 1, 0), MAX_MARGIN)
+    assert area.row_end == MAX_ROWS - 1
+    assert max(index.buckets) == (MAX_ROWS - 1) // index.bucket_rows
+
+
+def test_route_splits_full_partial_and_dirty(index):
+    full, partial = index.route([(5, 1), (6, 1)])
+    assert full == {"top"} and partial == {}
+    assert index.take_dirty() == {"bottom": Area(5, 1, 6, 1)}
+
+    # One cell on each screen
+    full, partial = index.route([(5, 1), (1000, 1)])
+    assert full == set()
+    assert partial == {"top": [0], "bottom": [1]}
+    assert index.take_dirty() == {"top": Area(1000, 1, 1000, 1), "bottom": Area(5, 1, 5, 1)}
+
+
+def test_dirty_regions_accumulate_until_taken(index):
+    index.route([(500, 3)])
+    index.route([(700, 8)])
+    assert index.take_dirty() == {"top": Area(500, 3, 700, 8), "bottom": Area(500, 3, 700, 8)}
+    assert index.take_dirty() == {}
+
+
+def test_route_leaves_clients_that_miss_the_change_alone(index):
+    index.route([(500, 3)])
+    # Worked out when the notices are taken, not per edit
+    assert index.dirty == {}
+    # A viewport set after a change is not told about it
+    index.set("late", parse_range("A2001:J2040"))
+    index.route([(700, 8)])
+    assert index.take_dirty() == {"top": Area(500, 3, 700, 8), "bottom": Area(500, 3, 700, 8),
+                                  "late": Area(700, 8, 700, 8)}
+    assert not index.has_dirty()
+
+
+def test_dirty_boxes_overflow_is_sent_to_everyone():
+    index = ViewportIndex(bucket_rows=16, dirty_boxes=2)
+    index.set("top", parse_range("A1:J40"))
+    for row in (5, 500, 600):
+        index.route([(row, 0)])
+    # The change on screen was merged into the overflow box
+    assert index.take_dirty() == {"top": Area(5, 0, 600, 0)}
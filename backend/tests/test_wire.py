@@ -0,0 +1,70 @@
+import asyncio
+import pytest
+from fanout import FanOut
+from wire import FIELD_IDS, JSON, TYPE_IDS, compact, expand, negotiate
+
+
+def test_compact_uses_short_ids_and_coordinates():
+    message = {"type": "cells_update", "userId": "u1",
+               "cells": [["B3", 5.0, None, 2]], "recalculated": [["C1", 6.0, "=SUM(B1:B3)", 4]]}
+    compacted = compact(message)
+    assert compacted == {
+        FIELD_IDS["type"]: TYPE_IDS["cells_update"],
+        FIELD_IDS["userId"]: "u1",
+        FIELD_IDS["cells"]: [[2, 1, 5.0, None, 2]],
+        FIELD_IDS["recalculated"]: [[0, 2, 6.0, "=SUM(B1:B3)", 4]],
+    }
+    assert expand(compacted) == message
+
+
+def test_compact_round_trips_nested_and_unknown_fields():
+    message = {"type": "cursor_batch", "cursors": [{"userId": "u1", "position": {"cellRef": "AA10", "top": 1}}],
+               "somethingNew": {"cellRef": "not a ref"}}
+    compacted = compact(message)
+    assert compacted[FIELD_IDS["cursors"]][0][FIELD_IDS["position"]][FIELD_IDS["cellRef"]] == [9, 26]
+    assert expand(compacted) == message
+
+
+def test_negotiation_defaults_to_json():
+    assert negotiate([]) is JSON
+    assert negotiate(["something.else"]) is JSON
+
+
+def test_msgpack_codec_round_trip():
+    pytest.importorskip("msgpack")
+    from wire import MsgpackCodec
+    codec = negotiate(["sheet.v1.json", MsgpackCodec.subprotocol])
+    message = {"type": "cell_update", "cellRef": "A1", "value": 1.5, "version": 3}
+    data = codec.encode(message)
+    assert isinstance(data, bytes) and len(data) < len(JSON.encode(message))
+    assert codec.decode(data) == message
+
+
+def test_fanout_encodes_once_per_codec():
+    class CountingCodec:
+        name = "counting"
+        binary = False
+
+        def __init__(self):
+            self.calls = 0
+
+        def encode(self, message):
+            self.calls += 1
+            return JSON.encode(message)
+
+    async def run():
+        codec = CountingCodec()
+        fanout = FanOut()
+        sent = []
+
+        async def send(frame):
+            sent.append(frame)
+
+        for client in range(5):
+            fanout.add("s", client, send, codec=codec)
+        fanout.add("s", "json", send)
+        fanout.publish("s", {"type": "cell_update"})
+        await fanout.drain("s")
+        return codec.calls, len(sent)
+
+    assert asyncio.run(run()) == (1, 6)
@@ -1,8 +1,63 @@
-from typing import Optional
-import re
+from functools import lru_cache
+from typing import Optional, Tuple
+
+# Sheet bounds, matching common spreadsheet limits (column XFD, row 1048576)
+MAX_ROWS = 1_048_576
+MAX_COLUMNS = 16_384
+
+# A1 <-> zero-based (row, col) codec. References are parsed by hand rather
+# than with a regex, and hot references are served from LRU caches, so
+# repeated lookups of the same cells allocate nothing.
+
+@lru_cache(maxsize=65536)
+def cell_ref_to_index(cell_ref: str) -> Tuple[int, int]:
+    # "B3" -> (2, 1), "AA10" -> (9, 26)
+    col = 0
+    i = 0
+    length = len(cell_ref)
+    while i < length and "A" <= cell_ref[i] <= "Z":
+        col = col * 26 + (ord(cell_ref[i]) - 64)
+        i += 1
+    digits = cell_ref[i:]
+    if i == 0 or not digits or digits[0] == "0" or not (digits.isascii() and digits.isdigit()):
+        raise ValueError(f"Invalid cell reference: {cell_ref}")
+    row = int(digits)
+    if row > MAX_ROWS or col > MAX_COLUMNS:
+        raise ValueError(f"Cell reference out of bounds: {cell_ref}")
+    return row - 1, col - 1
+
+@lru_cache(maxsize=65536)
+def index_to_cell_ref(row: int, col: int) -> str:
+    return f"{column_letters(col)}{row + 1}"
+
+@lru_cache(maxsize=MAX_COLUMNS)
+def column_letters(col: int) -> str:
+    # 0 -> "A", 25 -> "Z", 26 -> "AA"
+    letters = ""
+    col += 1
+    while col:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+@lru_cache(maxsize=MAX_COLUMNS)
+def column_index(letters: str) -> int:
+    # "A" -> 0, "AA" -> 26
+    if not letters or not ("A" <= min(letters) and max(letters) <= "Z"):
+        raise ValueError(f"Invalid column: {letters}")
+    col = 0
+    for ch in letters:
+        col = col * 26 + (ord(ch) - 64)
+    if col > MAX_COLUMNS:
+        raise ValueError(f"Column out of bounds: {letters}")
+    return col - 1
 
 def validate_cell_ref(cell_ref: str) -> bool:
-    return re.match(r"^[A-Z]{1}[1-9][0-9]{0,1}$", cell_ref) is not None
+    try:
+        cell_ref_to_index(cell_ref)
+    except (TypeError, ValueError):
+        return False
+    return True
 
 def parse_formula(formula: str) -> Optional[str]:
     # Placeholder parsing function, extend as needed
@@ -0,0 +1,157 @@
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+from formula import Area
+from utils import MAX_COLUMNS, MAX_ROWS
+
+# Viewport subscriptions for one sheet. A client registers the rectangle it
+# has on screen (plus a margin), and cell updates are routed only to clients
+# whose viewport covers the changed cells. Clients that did not register a
+# viewport are not in the index and keep receiving everything.
+#
+# Viewports are indexed by row bucket: a viewport is listed in every bucket of
+# BUCKET_ROWS rows it overlaps, so finding the clients for a cell or a block
+# only looks at the buckets that block spans. Changes a client cannot see are
+# folded into one pending "dirty" rectangle per client, sent as a cheap notice
+# so the client knows to refetch that region when it scrolls there.
+#
+# Routing an edit only touches the clients whose viewport overlaps it. The
+# clients that miss it entirely are worked out when the notices are taken:
+# the index keeps the bounding box of every change since then, numbered, and
+# a client gets the boxes outside its viewport that are newer than the
+# viewport itself. Past DIRTY_BOXES changes, the older boxes are merged into
+# one that every client is told about.
+
+BUCKET_ROWS = 64
+DIRTY_BOXES = 256
+# Largest margin a client may ask for around its viewport
+MAX_MARGIN = 1000
+
+
+def _union(a: Optional[Area], b: Area) -> Area:
+    if a is None:
+        return b
+    return Area(min(a.row_start, b.row_start), min(a.col_start, b.col_start),
+                max(a.row_end, b.row_end), max(a.col_end, b.col_end))
+
+
+def _contains(outer: Area, inner: Area) -> bool:
+    return (outer.row_start <= inner.row_start and inner.row_end <= outer.row_end
+            and outer.col_start <= inner.col_start and inner.col_end <= outer.col_end)
+
+
+def _intersects(a: Area, b: Area) -> bool:
+    return (a.row_start <= b.row_end and b.row_start <= a.row_end
+            and a.col_start <= b.col_end and b.col_start <= a.col_end)
+
+
+def bounding_area(coords: Iterable[Tuple[int, int]]) -> Optional[Area]:
+    rows, cols = zip(*coords) if coords else ((), ())
+    if not rows:
+        return None
+    return Area(min(rows), min(cols), max(rows), max(cols))
+
+
+class ViewportIndex:
+    def __init__(self, bucket_rows: int = BUCKET_ROWS, dirty_boxes: int = DIRTY_BOXES):
+        self.bucket_rows = bucket_rows
+        self.dirty_boxes = dirty_boxes
+        self.viewports: Dict[Hashable, Area] = {}
+        self.buckets: Dict[int, Set[Hashable]] = {}
+        # Cells hidden from clients that saw only part of a change
+        self.dirty: Dict[Hashable, Area] = {}
+        # (seq, bounding box) of the changes since the last take_dirty, the
+        # merged box of older ones, and the seq each viewport was set at
+        self.changes: List[Tuple[int, Area]] = []
+        self.overflow: Optional[Area] = None
+        self.seq = 0
+        self.since: Dict[Hashable, int] = {}
+
+    def __contains__(self, client: Hashable) -> bool:
+        return client in self.viewports
+
+    def _bucket_range(self, area: Area) -> range:
+        return range(area.row_start // self.bucket_rows, area.row_end // self.bucket_rows + 1)
+
+    def set(self, client: Hashable, area: Area, margin: int = 0) -> Area:
+        # The viewport grown by margin and clipped to the sheet limits;
+        # raises ValueError for a margin outside 0..MAX_MARGIN
+        if not 0 <= margin <= MAX_MARGIN:
+            raise ValueError(f"margin must be between 0 and {MAX_MARGIN}")
+        self.remove(client)
+        area = Area(max(area.row_start - margin, 0), max(area.col_start - margin, 0),
+                    min(area.row_end + margin, MAX_ROWS - 1), min(area.col_end + margin, MAX_COLUMNS - 1))
+        self.viewports[client] = area
+        self.since[client] = self.seq
+        for bucket in self._bucket_range(area):
+            self.buckets.setdefault(bucket, set()).add(client)
+        return area
+
+    def remove(self, client: Hashable) -> None:
+        area = self.viewports.pop(client, None)
+        self.dirty.pop(client, None)
+        self.since.pop(client, None)
+        if area is None:
+            return
+        for bucket in self._bucket_range(area):
+            clients = self.buckets.get(bucket)
+            if clients is not None:
+                clients.discard(client)
+                if not clients:
+                    del self.buckets[bucket]
+
+    def clients_for(self, area: Area) -> Set[Hashable]:
+        # Clients whose viewport overlaps `area`
+        candidates: Set[Hashable] = set()
+        for bucket in self._bucket_range(area):
+            candidates |= self.buckets.get(bucket, set())
+        return {client for client in candidates if _intersects(self.viewports[client], area)}
+
+    def route(self, coords: List[Tuple[int, int]]) -> Tuple[Set[Hashable], Dict[Hashable, List[int]]]:
+        # Split the registered clients for a set of changed cells into those
+        # that see all of them and those that see only some (with the indexes
+        # of the cells they see). Everything a client cannot see ends up in
+        # its dirty rectangle.
+        full: Set[Hashable] = set()
+        partial: Dict[Hashable, List[int]] = {}
+        box = bounding_area(coords)
+        if box is None:
+            return full, partial
+        self.seq += 1
+        self.changes.append((self.seq, box))
+        if len(self.changes) > self.dirty_boxes:
+            for _, older in self.changes[:-self.dirty_boxes]:
+                self.overflow = _union(self.overflow, older)
+            del self.changes[:-self.dirty_boxes]
+        for client in self.clients_for(box):
+            viewport = self.viewports[client]
+            if _contains(viewport, box):
+                full.add(client)
+            else:
+                visible = []
+                for i, (row, col) in enumerate(coords):
+                    if (viewport.row_start <= row <= viewport.row_end
+                            and viewport.col_start <= col <= viewport.col_end):
+                        visible.append(i)
+                    else:
+                        self.dirty[client] = _union(self.dirty.get(client), Area(row, col, row, col))
+                partial[client] = visible
+        return full, partial
+
+    def has_dirty(self) -> bool:
+        return bool(self.changes)
+
+    def take_dirty(self) -> Dict[Hashable, Area]:
+        # Each client's dirty rectangle since the last call
+        dirty, self.dirty = self.dirty, {}
+        for client, viewport in self.viewports.items():
+            area = dirty.get(client)
+            if self.overflow is not None:
+                area = _union(area, self.overflow)
+            since = self.since[client]
+            for seq, box in self.changes:
+                if seq > since and not _intersects(viewport, box):
+                    area = _union(area, box)
+            if area is not None:
+                dirty[client] = area
+        self.changes = []
+        self.overflow = None
+        return dirty
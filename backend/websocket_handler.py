@@ -1,73 +1,328 @@
 from fastapi import WebSocket, WebSocketDisconnect
-from typing import Dict, List
-import json
+from typing import Callable, Dict, Hashable, List, Optional
+import asyncio
+import logging
+import os
+from cluster import Cluster
 from collaboration import CollaborationService
+from fanout import DEFAULT_QUEUE_SIZE, POLICY_COALESCE, FanOut
+from presence import PRESENCE_HZ, PresenceHub
 from user import UserService
-from spreadsheet import SpreadsheetService
+from comments import CommentService
+from history import HistoryService
+from models import Comment
+from services import SheetLocks
+from spreadsheet import FormulaError, SpreadsheetService
+from filters import FILTER_ROW_LIMIT, parse_predicates, run_filter
+from formula import parse_range
+from utils import cell_ref_to_index, column_index, index_to_cell_ref, validate_cell_ref
+from viewport import ViewportIndex
+from wire import negotiate
+
+# Seconds between "dirty_region" notices for changes outside a client's viewport
+VIEWPORT_DIRTY_INTERVAL = float(os.environ.get("VIEWPORT_DIRTY_INTERVAL", 0.1))
+
+# Messages handled by the worker owning the sheet; see cluster.py
+OWNER_MESSAGES = {"cell_update", "cells_update", "undo", "redo", "comment_add", "resync", "history_request",
+                  "filter"}
+
+logger = logging.getLogger(__name__)
 
 
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, spreadsheet_service: SpreadsheetService, history_service: HistoryService,
+                 comment_service: CommentService, sheet_locks: SheetLocks, cluster: Optional[Cluster] = None):
+        # The services are the shared instances from services.py
         self.active_connections: Dict[str, List[WebSocket]] = {}
         self.user_service = UserService()
-        self.spreadsheet_service = SpreadsheetService()
+        self.spreadsheet_service = spreadsheet_service
+        self.history_service = history_service
+        self.comment_service = comment_service
+        self.sheet_locks = sheet_locks
         self.collaboration_service = CollaborationService(
             self.spreadsheet_service)
         self.usernames: Dict[str, Dict[WebSocket, str]] = {}
+        # Wire codec chosen for each connection; see wire.py
+        self.codecs: Dict[WebSocket, object] = {}
+        # Outbound traffic goes through per-connection queues; see fanout.py
+        self.fanout = FanOut(
+            max_queue=int(os.environ.get("WS_QUEUE_SIZE", DEFAULT_QUEUE_SIZE)),
+            policy=os.environ.get("WS_OVERFLOW_POLICY", POLICY_COALESCE),
+            on_disconnect=lambda sheet_id, websocket: self.disconnect(websocket, sheet_id))
+        # Cursor moves and user list changes are coalesced into ticks
+        self.presence = PresenceHub(
+            self.fanout.publish, self.user_service.get_users,
+            hz=float(os.environ.get("PRESENCE_HZ", PRESENCE_HZ)))
+        # Visible ranges of clients that registered one, per sheet
+        self.viewports: Dict[str, ViewportIndex] = {}
+        self._dirty_flushes: Dict[str, asyncio.Task] = {}
+        # Multi-worker mode: connection ids for replies from sheet owners
+        self.cluster = cluster
+        self.client_ids: Dict[WebSocket, int] = {}
+        self.clients_by_id: Dict[int, WebSocket] = {}
+        if cluster is not None:
+            cluster.bus.subscribe(cluster.worker_topic(cluster.worker_id), self._on_worker_message)
 
     async def connect(self, websocket: WebSocket, sheet_id: str):
-        await websocket.accept()
+        codec = negotiate(websocket.scope.get("subprotocols", []))
+        await websocket.accept(subprotocol=codec.subprotocol)
+        self.codecs[websocket] = codec
         if sheet_id not in self.active_connections:
             self.active_connections[sheet_id] = []
             self.usernames[sheet_id] = {}
         self.active_connections[sheet_id].append(websocket)
+        if self.cluster is not None:
+            client_id = self.client_ids[websocket] = self.cluster.next_client_id()
+            self.clients_by_id[client_id] = websocket
+            if len(self.active_connections[sheet_id]) == 1:
+                self.cluster.bus.subscribe(self.cluster.sheet_topic(sheet_id), self._on_sheet_message)
+                # Other workers announce their users on the sheet
+                self.cluster.publish_sheet(sheet_id, {"kind": "hello"})
+        # 1013: try again later, for clients that cannot keep up
+        send = websocket.send_bytes if codec.binary else websocket.send_text
+        self.fanout.add(sheet_id, websocket, send, lambda: websocket.close(code=1013), codec)
 
     def disconnect(self, websocket: WebSocket, sheet_id: str):
-        if sheet_id in self.active_connections:
+        # Called from the receive loop and when the fan-out drops a slow or
+        # dead client, so it may run twice for one socket
+        self.fanout.remove(sheet_id, websocket)
+        self.codecs.pop(websocket, None)
+        if sheet_id in self.viewports:
+            self.viewports[sheet_id].remove(websocket)
+        if sheet_id in self.active_connections and websocket in self.active_connections[sheet_id]:
             self.active_connections[sheet_id].remove(websocket)
             
             # Remove user from user service if they had a username
             if sheet_id in self.usernames and websocket in self.usernames[sheet_id]:
                 user_id = self.usernames[sheet_id].pop(websocket)
                 self.user_service.remove_user(sheet_id, user_id)
+                self.presence.remove_user(sheet_id, user_id)
+                if self.cluster is not None:
+                    self.cluster.publish_sheet(sheet_id, {"kind": "leave", "userId": user_id})
+
+            if self.cluster is not None:
+                self.clients_by_id.pop(self.client_ids.pop(websocket, None), None)
+                if not self.active_connections[sheet_id]:
+                    self.cluster.bus.unsubscribe(self.cluster.sheet_topic(sheet_id), self._on_sheet_message)
+
+    async def broadcast(self, sheet_id: str, message: dict, key: Optional[Hashable] = None):
+        # Queues the message for every connection and returns without waiting
+        # for any socket. Messages with a key may be coalesced or dropped for
+        # clients that fall behind.
+        if self.cluster is not None:
+            # Every worker with clients on the sheet delivers it
+            self.cluster.publish_sheet(sheet_id, {"kind": "broadcast", "message": message, "key": key})
+        else:
+            self.fanout.publish(sheet_id, message, key)
+
+    def publish_cells(self, sheet_id: str, message: dict, edited: List[list], recalculated: List[list]) -> None:
+        # Send a cell change message to the clients that can see it. edited
+        # and recalculated are the [cellRef, value, formula, version] tuples
+        # the message carries. Clients without a viewport and clients seeing
+        # every changed cell get `message` itself; clients seeing some of
+        # them get a cells_update with just those; the rest only hear about
+        # the change through a later dirty_region notice.
+        self.collaboration_service.oplog.append(sheet_id, message)
+        if self.cluster is not None:
+            self.cluster.publish_sheet(sheet_id, {
+                "kind": "cells", "message": message, "edited": edited, "recalculated": recalculated})
+        else:
+            self._route_cells(sheet_id, message, edited, recalculated)
+
+    def _route_cells(self, sheet_id: str, message: dict, edited: List[list], recalculated: List[list]) -> None:
+        # Local half of publish_cells: fan out to this worker's clients
+        seq = message["seq"]
+        index = self.viewports.get(sheet_id)
+        if index is None or not index.viewports:
+            self.fanout.publish(sheet_id, message)
+            return
+        cells = edited + recalculated
+        full, partial = index.route([cell_ref_to_index(cell[0]) for cell in cells])
+        clients = self.fanout.channels.get(sheet_id, {})
+        self.fanout.publish(sheet_id, message, clients=[c for c in clients if c not in index or c in full])
+        for client, visible in partial.items():
+            if visible:
+                self.fanout.send(sheet_id, client, {
+                    "type": "cells_update",
+                    "userId": message.get("userId"),
+                    "cells": [cells[i] for i in visible if i < len(edited)],
+                    "recalculated": [cells[i] for i in visible if i >= len(edited)],
+                    "seq": seq,
+                })
+        if index.has_dirty() and sheet_id not in self._dirty_flushes:
+            self._dirty_flushes[sheet_id] = asyncio.get_running_loop().create_task(self._flush_dirty(sheet_id))
+
+    async def _flush_dirty(self, sheet_id: str) -> None:
+        # One notice per client per interval, however many changes it missed
+        try:
+            await asyncio.sleep(VIEWPORT_DIRTY_INTERVAL)
+        finally:
+            self._dirty_flushes.pop(sheet_id, None)
+        for client, area in self.viewports[sheet_id].take_dirty().items():
+            self.fanout.send(sheet_id, client, {
+                "type": "dirty_region",
+                "range": f"{index_to_cell_ref(area.row_start, area.col_start)}:"
+                         f"{index_to_cell_ref(area.row_end, area.col_end)}",
+            })
+
+    async def apply_cells_update(self, sheet_id: str, edits: List[dict], user_id: Optional[str]) -> dict:
+        # Batch edit shared by the "cells_update" message and the REST bulk
+        # endpoint: one validation pass, one grouped history entry, one recalc
+        # and one broadcast. Cells go out as [cellRef, value, formula, version].
+        # Raises ValueError or FormulaError and applies nothing on a bad edit.
+        changes = []
+        for edit in edits:
+            if not isinstance(edit, dict) or not isinstance(edit.get("cellRef"), str):
+                raise ValueError("Each edit needs a cellRef")
+            changes.append((edit["cellRef"], edit.get("value", ""), edit.get("formula")))
+        async with self.sheet_locks(sheet_id):
+            return self._apply_cells_update(sheet_id, changes, user_id)
 
-    async def broadcast(self, sheet_id: str, message: dict):
-        if sheet_id in self.active_connections:
-            data = json.dumps(message)
-            for connection in self.active_connections[sheet_id]:
-                await connection.send_text(data)
+    async def apply_undo(self, sheet_id: str, user_id: Optional[str], redo: bool = False) -> Optional[dict]:
+        # Undo (or redo) the user's last edit or batch edit. Cells changed by
+        # someone else since are left alone. Returns the cells_update message,
+        # or None when there is nothing to undo.
+        async with self.sheet_locks(sheet_id):
+            pending = self.history_service.pending_undo(sheet_id, user_id, redo)
+            if pending is None:
+                return None
+            store = self.spreadsheet_service.get_or_create_sheet(sheet_id).store
+            changes = []
+            for cell_ref, expected, target, expected_formula, target_formula in pending:
+                entry = store.get(*cell_ref_to_index(cell_ref))
+                value, formula = (entry[0], entry[1]) if entry is not None else (None, None)
+                # A cleared cell holds "" rather than no value
+                if formula != expected_formula or (formula is None and value != expected
+                                                   and {value, expected} != {"", None}):
+                    continue
+                changes.append((cell_ref, "" if target is None else target, target_formula))
+            return self._apply_cells_update(sheet_id, changes, user_id, "redo" if redo else "undo")
+
+    async def publish_comment(self, sheet_id: str, msg_type: str, comment: Comment) -> None:
+        # comment_added, comment_edited or comment_deleted, shared with the
+        # REST comment routes
+        message = {
+            "type": msg_type,
+            "cellRef": comment.cell_ref,
+            "commentId": comment.comment_id,
+            "userId": comment.user_id,
+            "timestamp": comment.timestamp,
+        }
+        if msg_type != "comment_deleted":
+            message["text"] = comment.text
+        self.collaboration_service.oplog.append(sheet_id, message)
+        await self.broadcast(sheet_id, message)
+
+    async def sheet_replaced(self, sheet_id: str) -> None:
+        # The whole sheet changed outside the op log (a CSV import): clients
+        # reload it, and resyncs from before this point get a snapshot
+        message = {"type": "sheet_replaced", "snapshot": f"/api/sheet/{sheet_id}/snapshot"}
+        self.collaboration_service.oplog.replace(sheet_id, message)
+        await self.broadcast(sheet_id, message)
+
+    async def sort_rows(self, sheet_id: str, keys: List[dict], user_id: Optional[str],
+                        start_row: Optional[int] = None, end_row: Optional[int] = None) -> dict:
+        # Whole-row sort shared with the REST endpoint. keys are
+        # {"column": "B", "ascending": true}, first key first; rows are
+        # one-based and default to the whole sheet. Clients get a rows_sorted
+        # notice and reload the rows they show. Raises ValueError on bad input.
+        sort_keys = []
+        for key in keys:
+            if not isinstance(key, dict) or not isinstance(key.get("column"), str):
+                raise ValueError("Each sort key needs a column")
+            sort_keys.append((column_index(key["column"]), bool(key.get("ascending", True))))
+        async with self.sheet_locks(sheet_id):
+            sheet = self.spreadsheet_service.get_or_create_sheet(sheet_id)
+            start = 1 if start_row is None else start_row
+            end = sheet.rows if end_row is None else end_row
+            recalculated = self.spreadsheet_service.sort_rows(sheet_id, sort_keys, start - 1, end - 1)
+            message = {
+                "type": "rows_sorted",
+                "userId": user_id,
+                "startRow": start,
+                "endRow": end,
+                "keys": keys,
+                "recalculated": [],
+            }
+            for ref in recalculated:
+                cell = self.spreadsheet_service.get_cell_value(sheet_id, ref)
+                message["recalculated"].append([ref, cell.value, cell.formula, cell.version])
+            self.collaboration_service.oplog.append(sheet_id, message)
+            await self.broadcast(sheet_id, message)
+            return message
+
+    def _apply_cells_update(self, sheet_id: str, changes: List[tuple], user_id: Optional[str],
+                            action: str = "edit") -> dict:
+        store = self.spreadsheet_service.get_or_create_sheet(sheet_id).store
+        old_cells = [store.get(*cell_ref_to_index(ref)) if validate_cell_ref(ref) else None
+                     for ref, _, _ in changes]
+
+        cells, recalculated = self.collaboration_service.apply_edits(sheet_id, changes, user_id)
+
+        self.history_service.log_batch(sheet_id, [
+            (ref, old and old[0], cells[ref].value, old and old[1], cells[ref].formula)
+            for (ref, _, _), old in zip(changes, old_cells)
+        ], user_id, action)
+
+        message = {
+            "type": "cells_update",
+            "userId": user_id,
+            "cells": [[ref, cell.value, cell.formula, cell.version] for ref, cell in cells.items()],
+            "recalculated": [],
+        }
+        for ref in recalculated:
+            cell = self.spreadsheet_service.get_cell_value(sheet_id, ref)
+            message["recalculated"].append([ref, cell.value, cell.formula, cell.version])
+        if cells:
+            self.publish_cells(sheet_id, message, message["cells"], message["recalculated"])
+        return message
 
     async def receive(self, websocket: WebSocket, sheet_id: str):
+        codec = self.codecs[websocket]
         try:
             while True:
-                data = await websocket.receive_text()
-                message = json.loads(data)
-                await self.handle_message(sheet_id, websocket, message)
+                if codec.binary:
+                    data = await websocket.receive_bytes()
+                else:
+                    data = await websocket.receive_text()
+                message = None
+                try:
+                    message = codec.decode(data)
+                    await self.handle_message(sheet_id, websocket, message)
+                except Exception:
+                    # A bad or failing message must not end the connection
+                    logger.exception("Message for sheet %s failed", sheet_id)
+                    self.fanout.send(sheet_id, websocket, {
+                        "type": "error",
+                        "request": message.get("type") if isinstance(message, dict) else None,
+                        "message": "Could not handle the message",
+                    })
         except WebSocketDisconnect:
+            pass
+        finally:
+            # Whatever ends the loop, release the client's channel, presence
+            # and viewport; the updated user list goes out on the next tick
             self.disconnect(websocket, sheet_id)
-            # Broadcast updated user list after disconnect
-            users = self.user_service.get_users(sheet_id)
-            await self.broadcast(sheet_id, {
-                "type": "user_presence", 
-                "users": [
-                    {
-                        "userId": u.user_id,
-                        "username": u.username,
-                        "color": u.color,
-                        "status": "online",
-                        "lastActive": 0
-                    } for u in users
-                ]
-            })
 
     async def handle_message(self, sheet_id: str, websocket: WebSocket, message: dict):
-        # Example message types: 'join', 'user_join', 'user_leave', 'cell_update', 'cursor_update', 'user_presence', 'comment_add', 'history_request'
+        # Example message types: 'join', 'user_join', 'user_leave', 'cell_update', 'cells_update', 'viewport', 'resync', 'cursor_update', 'user_presence', 'comment_add', 'history_request'
         msg_type = message.get("type")
-        if msg_type == "join":
+        if msg_type in OWNER_MESSAGES:
+            user_id = self.usernames[sheet_id].get(websocket)
+            if self.cluster is not None and not self.cluster.owns(sheet_id):
+                # The sheet lives on another worker, which replies through ours
+                self.cluster.send_to_worker(self.cluster.owner(sheet_id), {
+                    "kind": "command", "sheet": sheet_id, "message": message,
+                    "userId": user_id, "client": self.client_ids[websocket]})
+                return
+            await self.handle_owned(sheet_id, message, user_id,
+                                    lambda reply: self.fanout.send(sheet_id, websocket, reply))
+        elif msg_type == "join":
             username = message.get("username", "Anonymous")
             user = self.user_service.add_user(sheet_id, username)
             self.usernames[sheet_id][websocket] = user.user_id
-            await self.broadcast(sheet_id, {"type": "user_presence", "users": [u.username for u in self.user_service.get_users(sheet_id)]})
+            self.presence.members_changed(sheet_id, user.user_id)
+            self._announce_user(sheet_id, user.user_id)
         elif msg_type == "user_join":
             # Handle authenticated user joining
             user_data = message.get("user", {})
@@ -79,20 +334,8 @@ class ConnectionManager:
             user = self.user_service.add_user(sheet_id, username, user_id, color)
             self.usernames[sheet_id][websocket] = user_id
             
-            # Broadcast updated user list to all clients
-            users = self.user_service.get_users(sheet_id)
-            await self.broadcast(sheet_id, {
-                "type": "user_presence", 
-                "users": [
-                    {
-                        "userId": u.user_id,
-                        "username": u.username,
-                        "color": u.color,
-                        "status": "online",
-                        "lastActive": user_data.get("lastActive", 0)
-                    } for u in users
-                ]
-            })
+            self.presence.members_changed(sheet_id, user_id)
+            self._announce_user(sheet_id, user_id)
         elif msg_type == "user_leave":
             # Handle authenticated user leaving
             user_id = message.get("userId")
@@ -107,57 +350,25 @@ class ConnectionManager:
                 if websocket_to_remove:
                     self.usernames[sheet_id].pop(websocket_to_remove, None)
                     self.user_service.remove_user(sheet_id, user_id)
-                    
-                    # Broadcast updated user list
-                    users = self.user_service.get_users(sheet_id)
-                    await self.broadcast(sheet_id, {
-                        "type": "user_presence", 
-                        "users": [
-                            {
-                                "userId": u.user_id,
-                                "username": u.username,
-                                "color": u.color,
-                                "status": "online",
-                                "lastActive": 0
-                            } for u in users
-                        ]
-                    })
-        elif msg_type == "cell_update":
-            cell_ref = message.get("cellRef")
-            value = message.get("value")
-            formula = message.get("formula")
-            user_id = self.usernames[sheet_id].get(websocket)
-            is_conflict_resolved = message.get("conflictResolved", False)
-            
-            # Store old value for history
-            old_cell = self.spreadsheet_service.get_cell_value(sheet_id, cell_ref)
-            old_value = old_cell.value if old_cell else None
-            
-            cell = self.collaboration_service.apply_edit(
-                sheet_id, cell_ref, value, formula, user_id)
-            
-            # Log edit in history
-            from main import history_service
-            history_service.log_edit(sheet_id, cell_ref, old_value, cell.value, user_id)
-            
-            # Broadcast updated cell to all clients
-            await self.broadcast(sheet_id, {
-                "type": "cell_update",
-                "cellRef": cell_ref,
-                "value": cell.value,
-                "formula": cell.formula,
-                "version": cell.version,
-                "userId": user_id,
-                "conflictResolved": is_conflict_resolved,
-            })
+                    self.presence.remove_user(sheet_id, user_id)
+                    if self.cluster is not None:
+                        self.cluster.publish_sheet(sheet_id, {"kind": "leave", "userId": user_id})
+        elif msg_type == "viewport":
+            # {"range": "A1:Z50", "margin": 20}; no range means "send me everything"
+            index = self.viewports.setdefault(sheet_id, ViewportIndex())
+            if not message.get("range"):
+                index.remove(websocket)
+            else:
+                try:
+                    index.set(websocket, parse_range(message["range"]), int(message.get("margin") or 0))
+                except (TypeError, ValueError, OverflowError) as e:
+                    self.fanout.send(sheet_id, websocket, {"type": "error", "request": "viewport", "message": str(e)})
         elif msg_type == "cursor_update":
             user_id = self.usernames[sheet_id].get(websocket)
             cursor_pos = message.get("position")
-            await self.broadcast(sheet_id, {
-                "type": "cursor_update",
-                "userId": user_id,
-                "position": cursor_pos,
-            })
+            self.presence.update_cursor(sheet_id, user_id, cursor_pos)
+            if self.cluster is not None:
+                self.cluster.publish_sheet(sheet_id, {"kind": "cursor", "userId": user_id, "position": cursor_pos})
         elif msg_type == "conflict_resolved":
             # Handle conflict resolution messages
             cell_ref = message.get("cellRef")
@@ -169,34 +380,117 @@ class ConnectionManager:
                 "cellRef": cell_ref,
                 "resolvedBy": user_id,
             })
+
+    async def handle_owned(self, sheet_id: str, message: dict, user_id: Optional[str],
+                           reply: Callable[[dict], None]) -> None:
+        # Messages that read or change the sheet's data, handled by the worker
+        # owning the sheet for clients of any worker. reply() answers the
+        # client that sent the message.
+        msg_type = message.get("type")
+        if msg_type == "cell_update":
+            cell_ref = message.get("cellRef")
+            value = message.get("value")
+            formula = message.get("formula")
+            is_conflict_resolved = message.get("conflictResolved", False)
+            
+            async with self.sheet_locks(sheet_id):
+                # Store old value for history
+                old_cell = self.spreadsheet_service.get_cell_value(sheet_id, cell_ref)
+                old_value = old_cell.value if old_cell else None
+                old_formula = old_cell.formula if old_cell else None
+
+                try:
+                    cell, updated = self.collaboration_service.apply_edit(
+                        sheet_id, cell_ref, value, formula, user_id)
+                except (ValueError, FormulaError) as e:
+                    # Invalid ref or formula, or a circular reference
+                    reply({"type": "error", "request": msg_type, "message": str(e)})
+                    return
+
+                # Log edit in history
+                self.history_service.log_edit(sheet_id, cell_ref, old_value, cell.value, user_id,
+                                              old_formula, cell.formula)
+
+                # Formula cells that were recalculated because of this edit,
+                # as [cellRef, value, formula, version] like cells_update
+                recalculated = []
+                for ref in updated:
+                    dependent = self.spreadsheet_service.get_cell_value(sheet_id, ref)
+                    recalculated.append([ref, dependent.value, dependent.formula, dependent.version])
+            
+            # Send the updated cell to the clients that can see it
+            self.publish_cells(sheet_id, {
+                "type": "cell_update",
+                "cellRef": cell_ref,
+                "value": cell.value,
+                "formula": cell.formula,
+                "version": cell.version,
+                "userId": user_id,
+                "conflictResolved": is_conflict_resolved,
+                "recalculated": recalculated,
+            }, [[cell_ref, cell.value, cell.formula, cell.version]], recalculated)
+        elif msg_type == "cells_update":
+            try:
+                await self.apply_cells_update(sheet_id, message.get("edits", []), user_id)
+            except (ValueError, FormulaError) as e:
+                reply({"type": "error", "request": "cells_update", "message": str(e)})
+        elif msg_type in ("undo", "redo"):
+            try:
+                applied = await self.apply_undo(sheet_id, user_id, redo=msg_type == "redo")
+            except (ValueError, FormulaError) as e:
+                reply({"type": "error", "request": msg_type, "message": str(e)})
+            else:
+                if applied is None:
+                    reply({"type": "error", "request": msg_type, "message": f"Nothing to {msg_type}"})
+        elif msg_type == "filter":
+            # Rows matching every condition; see filters.py
+            try:
+                predicates = parse_predicates(message.get("where"))
+                result = run_filter(self.spreadsheet_service.get_or_create_sheet(sheet_id), predicates,
+                                    message.get("format", "rows"), int(message.get("limit", FILTER_ROW_LIMIT)))
+            except (TypeError, ValueError) as e:
+                reply({"type": "error", "request": msg_type, "message": str(e)})
+            else:
+                reply({"type": "filter_result", "where": message.get("where"), **result})
         elif msg_type == "comment_add":
             cell_ref = message.get("cellRef")
             text = message.get("text")
-            user_id = self.usernames[sheet_id].get(websocket)
-            
+
             # Add comment
-            from main import comment_service
-            comment = comment_service.add_comment(sheet_id, cell_ref, user_id, text)
+            try:
+                comment = self.comment_service.add_comment(sheet_id, cell_ref, user_id, text)
+            except ValueError as e:
+                reply({"type": "error", "request": msg_type, "message": str(e)})
+                return
             
             # Broadcast comment to all clients
-            await self.broadcast(sheet_id, {
-                "type": "comment_added",
-                "cellRef": cell_ref,
-                "commentId": comment.comment_id,
-                "userId": user_id,
-                "text": text,
-                "timestamp": comment.timestamp
+            await self.publish_comment(sheet_id, "comment_added", comment)
+        elif msg_type == "resync":
+            # Reconnecting client: replay what it missed since lastSeq, or
+            # send it to the snapshot endpoint when that is no longer possible
+            oplog = self.collaboration_service.oplog
+            try:
+                ops = oplog.since(sheet_id, int(message.get("lastSeq", 0)), message.get("epoch"))
+            except (TypeError, ValueError):
+                ops = None
+            reply({
+                "type": "resync",
+                "seq": oplog.current(sheet_id),
+                "epoch": oplog.epoch(sheet_id),
+                "ops": ops,
+                "snapshot": None if ops is not None else f"/api/sheet/{sheet_id}/snapshot",
             })
         elif msg_type == "history_request":
             cell_ref = message.get("cellRef")
-            user_id = self.usernames[sheet_id].get(websocket)
-            
-            # Get cell history
-            from main import history_service
-            history = history_service.get_history(sheet_id, cell_ref)
+            if not isinstance(cell_ref, str) or not validate_cell_ref(cell_ref):
+                reply({"type": "error", "request": msg_type, "message": f"Invalid cell reference: {cell_ref}"})
+                return
+
+            # Get cell history, newest HISTORY_PAGE_SIZE entries at most
+            history = self.history_service.get_history(sheet_id, cell_ref)
             
             # Send history directly to the requesting client
-            await websocket.send_json({
+            reply({
                 "type": "history_response",
                 "cellRef": cell_ref,
                 "history": [
@@ -204,7 +498,61 @@ class ConnectionManager:
                         "oldValue": entry.old_value,
                         "newValue": entry.new_value,
                         "userId": entry.user_id,
-                        "timestamp": entry.timestamp
+                        "timestamp": entry.timestamp,
+                        "action": entry.action,
                     } for entry in history
                 ]
             })
+
+    def _announce_user(self, sheet_id: str, user_id: str) -> None:
+        # Tell the other workers about a user of one of our connections
+        user = self.user_service.get_user(sheet_id, user_id)
+        if self.cluster is not None and user is not None:
+            self.cluster.publish_sheet(sheet_id, {
+                "kind": "join", "userId": user.user_id, "username": user.username, "color": user.color})
+
+    def _on_sheet_message(self, message: dict) -> None:
+        # Bus traffic for a sheet this worker has clients on
+        sheet_id, kind = message["sheet"], message["kind"]
+        if kind == "cells":
+            self._route_cells(sheet_id, message["message"], message["edited"], message["recalculated"])
+        elif kind == "broadcast":
+            key = message.get("key")
+            self.fanout.publish(sheet_id, message["message"], tuple(key) if isinstance(key, list) else key)
+        elif message["worker"] == self.cluster.worker_id:
+            # Our own presence changes, already applied
+            return
+        elif kind == "hello":
+            for user_id in list(self.usernames.get(sheet_id, {}).values()):
+                self._announce_user(sheet_id, user_id)
+        elif kind == "join":
+            self.user_service.add_user(sheet_id, message["username"], message["userId"], message["color"])
+            self.presence.members_changed(sheet_id, message["userId"])
+        elif kind == "leave":
+            self.user_service.remove_user(sheet_id, message["userId"])
+            self.presence.remove_user(sheet_id, message["userId"])
+        elif kind == "cursor":
+            self.presence.update_cursor(sheet_id, message["userId"], message["position"])
+
+    def _on_worker_message(self, message: dict) -> None:
+        # Commands for sheets this worker owns, and replies to our clients
+        if message["kind"] == "command":
+            sheet_id, origin, client = message["sheet"], message["worker"], message["client"]
+
+            def reply(reply_message: dict) -> None:
+                self.cluster.send_to_worker(origin, {
+                    "kind": "reply", "sheet": sheet_id, "client": client, "message": reply_message})
+            asyncio.get_running_loop().create_task(
+                self._run_command(sheet_id, message["message"], message["userId"], reply))
+        elif message["kind"] == "reply":
+            websocket = self.clients_by_id.get(message["client"])
+            if websocket is not None:
+                self.fanout.send(message["sheet"], websocket, message["message"])
+
+    async def _run_command(self, sheet_id: str, message: dict, user_id: Optional[str],
+                           reply: Callable[[dict], None]) -> None:
+        try:
+            await self.handle_owned(sheet_id, message, user_id, reply)
+        except Exception:
+            logger.exception("Command for sheet %s failed", sheet_id)
+            reply({"type": "error", "request": message.get("type"), "message": "Could not handle the message"})
@@ -0,0 +1,148 @@
+import json
+from typing import Any, Dict, List, Optional
+from utils import cell_ref_to_index, index_to_cell_ref
+
+try:
+    import msgpack
+except ImportError:  # optional: without it every connection speaks JSON
+    msgpack = None
+
+# WebSocket wire codecs. JSON is the default. Clients that want the compact
+# binary protocol offer the "sheet.v1.msgpack" subprotocol when connecting;
+# the server accepts it when msgpack is installed and falls back to JSON
+# otherwise.
+#
+# The binary protocol keeps the JSON message shapes but replaces field names
+# and message types with small integers, and cell refs with [row, col]
+# (zero-based). Cell tuples in "cells"/"recalculated" become
+# [row, col, value, formula, version]. Names missing from the tables below
+# are passed through unchanged, so new fields work before they get an id.
+
+FIELDS = [
+    "type", "cellRef", "value", "formula", "version", "userId", "position",
+    "cells", "recalculated", "cursors", "users", "username", "color", "status",
+    "lastActive", "conflictResolved", "resolvedBy", "commentId", "text",
+    "timestamp", "history", "oldValue", "newValue", "edits", "message",
+    "request", "top", "left", "range", "margin", "seq", "lastSeq", "ops",
+    "snapshot", "action", "startRow", "endRow", "keys", "where", "format",
+    "limit", "count", "rowCount", "revision", "rows", "truncated", "bitmap",
+    "epoch",
+]
+MESSAGE_TYPES = [
+    "join", "user_join", "user_leave", "user_presence", "cell_update",
+    "cells_update", "cursor_update", "cursor_batch", "conflict_resolved",
+    "comment_add", "comment_added", "history_request", "history_response",
+    "error", "viewport", "dirty_region", "resync", "undo", "redo", "rows_sorted",
+    "filter", "filter_result", "sheet_replaced", "comment_edited", "comment_deleted",
+]
+
+FIELD_IDS = {name: i for i, name in enumerate(FIELDS)}
+TYPE_IDS = {name: i for i, name in enumerate(MESSAGE_TYPES)}
+_CELL_LISTS = ("cells", "recalculated")
+
+
+def _ref_to_coords(ref: Any) -> Any:
+    if isinstance(ref, str):
+        try:
+            return list(cell_ref_to_index(ref))
+        except ValueError:
+            pass
+    return ref
+
+
+def _coords_to_ref(coords: Any) -> Any:
+    if isinstance(coords, list) and len(coords) == 2 and all(isinstance(i, int) for i in coords):
+        return index_to_cell_ref(*coords)
+    return coords
+
+
+def _compact_value(name: str, value: Any) -> Any:
+    if name == "type":
+        return TYPE_IDS.get(value, value)
+    if name == "cellRef":
+        return _ref_to_coords(value)
+    if name in _CELL_LISTS and isinstance(value, list):
+        compacted = []
+        for cell in value:
+            if isinstance(cell, list) and cell:
+                coords = _ref_to_coords(cell[0])
+                if isinstance(coords, list):
+                    cell = coords + cell[1:]
+            compacted.append(cell)
+        return compacted
+    return compact(value)
+
+
+def compact(message: Any) -> Any:
+    # Message shape with short ids, ready for a binary encoder
+    if isinstance(message, dict):
+        return {FIELD_IDS.get(name, name): _compact_value(name, value) for name, value in message.items()}
+    if isinstance(message, list):
+        return [compact(item) for item in message]
+    return message
+
+
+def _expand_value(name: Any, value: Any) -> Any:
+    if name == "type":
+        return MESSAGE_TYPES[value] if isinstance(value, int) and 0 <= value < len(MESSAGE_TYPES) else value
+    if name == "cellRef":
+        return _coords_to_ref(value)
+    if name in _CELL_LISTS and isinstance(value, list):
+        expanded = []
+        for cell in value:
+            if isinstance(cell, list) and len(cell) >= 2 and isinstance(cell[0], int) and isinstance(cell[1], int):
+                cell = [index_to_cell_ref(cell[0], cell[1])] + cell[2:]
+            expanded.append(cell)
+        return expanded
+    return expand(value)
+
+
+def expand(message: Any) -> Any:
+    # Inverse of compact()
+    if isinstance(message, dict):
+        expanded = {}
+        for key, value in message.items():
+            name = FIELDS[key] if isinstance(key, int) and 0 <= key < len(FIELDS) else key
+            expanded[name] = _expand_value(name, value)
+        return expanded
+    if isinstance(message, list):
+        return [expand(item) for item in message]
+    return message
+
+
+class JsonCodec:
+    name = "json"
+    subprotocol: Optional[str] = None
+    binary = False
+
+    def encode(self, message: dict) -> str:
+        return json.dumps(message)
+
+    def decode(self, data: str) -> dict:
+        return json.loads(data)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    subprotocol = "sheet.v1.msgpack"
+    binary = True
+
+    def encode(self, message: dict) -> bytes:
+        return msgpack.packb(compact(message), use_bin_type=True)
+
+    def decode(self, data: bytes) -> dict:
+        return expand(msgpack.unpackb(data, raw=False, strict_map_key=False))
+
+
+JSON = JsonCodec()
+CODECS: Dict[str, Any] = {JSON.name: JSON}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+
+def negotiate(offered: List[str]):
+    # Pick the codec for a connection from the client's subprotocol offer
+    for codec in CODECS.values():
+        if codec.subprotocol is not None and codec.subprotocol in offered:
+            return codec
+    return JSON
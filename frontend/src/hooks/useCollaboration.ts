@@ -16,6 +16,9 @@ const useCollaboration = (sheetId: string) => {
         dispatch(userPresenceUpdate(data.users))
       if (data.type === "cursor_update")
         dispatch(cursorUpdate({ userId: data.userId, position: data.position }))
+      if (data.type === "cursor_batch")
+        for (const cursor of data.cursors)
+          dispatch(cursorUpdate({ userId: cursor.userId, position: cursor.position }))
     })
     return () => {
       unsub()
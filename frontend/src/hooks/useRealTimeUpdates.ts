@@ -12,6 +12,9 @@ const useRealTimeUpdates = (sheetId: string) => {
       if (data.type === 'cell_update') dispatch(updateCell(data));
       if (data.type === 'user_presence') dispatch(userPresenceUpdate(data.users));
       if (data.type === 'cursor_update') dispatch(cursorUpdate({ userId: data.userId, position: data.position }));
+      if (data.type === 'cursor_batch') {
+        for (const cursor of data.cursors) dispatch(cursorUpdate({ userId: cursor.userId, position: cursor.position }));
+      }
     });
     return () => { unsub(); ws.close(); };
   }, [dispatch, sheetId]);
@@ -76,6 +76,19 @@ export function useWebSocketConnection(sheetId: string) {
               action: 'edit' 
             }));
           }
+          // Dependent formulas changed for every client, the editor included
+          for (const [cellRef, value, formula] of msg.recalculated ?? []) {
+            dispatch(updateCell({ cellRef, value, formula: formula ?? undefined }));
+          }
+          break;
+        }
+        case "cells_update": {
+          // Batch edit (paste, fill-down); cells are [cellRef, value, formula, version]
+          const isOwnUpdate = currentUser && msg.userId === `auth_${currentUser.username}`;
+          const cells = isOwnUpdate ? msg.recalculated : [...msg.cells, ...msg.recalculated];
+          for (const [cellRef, value, formula] of cells) {
+            dispatch(updateCell({ cellRef, value, formula: formula ?? undefined }));
+          }
           break;
         }
         case "user_presence":
@@ -87,6 +100,14 @@ export function useWebSocketConnection(sheetId: string) {
             dispatch(cursorUpdate({ userId: msg.userId, position: msg.position }));
           }
           break;
+        case "cursor_batch":
+          // Cursors that moved since the last presence tick
+          for (const cursor of msg.cursors) {
+            if (!currentUser || cursor.userId !== `auth_${currentUser.username}`) {
+              dispatch(cursorUpdate({ userId: cursor.userId, position: cursor.position }));
+            }
+          }
+          break;
         case "conflict_resolved":
           // Handle conflict resolution messages
           dispatch(setConflict({ cellRef: msg.cellRef, conflicted: false }));
@@ -8,6 +8,10 @@ export default class WebsocketService {
   private ws: WebSocket;
   private listeners: WSListener[] = [];
   private onOpenCallbacks: (() => void)[] = [];
+  // Sequence number of the last sheet operation applied, and the epoch of
+  // the server log it belongs to
+  private lastSeq = 0;
+  private epoch: string | null = null;
 
   constructor(sheetId: string) {
     // Use the centralized WebSocket URL configuration
@@ -24,7 +28,11 @@ export default class WebsocketService {
     this.ws.onmessage = (event) => {
       try {
         const data = JSON.parse(event.data);
-        this.listeners.forEach((listener) => listener(data));
+        if (data.type === "resync" && Array.isArray(data.ops)) {
+          data.ops.forEach((op: { seq: number }) => this.dispatch(op));
+        } else {
+          this.dispatch(data);
+        }
       } catch (e) {
         console.error("Failed to parse WS message", e);
       }
@@ -39,6 +47,29 @@ export default class WebsocketService {
     };
   }
 
+  // eslint-disable-next-line @typescript-eslint/no-explicit-any
+  private dispatch(data: any) {
+    if (typeof data.seq === "number") {
+      if (typeof data.epoch === "string" && data.epoch !== this.epoch) {
+        // A new server log (restart, evicted sheet): its seqs start over
+        this.epoch = data.epoch;
+      } else if (data.seq <= this.lastSeq) {
+        // Ops can arrive twice when a resync races live broadcasts
+        return;
+      }
+      this.lastSeq = data.seq;
+    }
+    this.listeners.forEach((listener) => listener(data));
+  }
+
+  /**
+   * Ask for the operations missed since the last one applied, e.g. after
+   * reconnecting. The server replies with the ops or a snapshot URL.
+   */
+  resync() {
+    this.send({ type: "resync", lastSeq: this.lastSeq, epoch: this.epoch });
+  }
+
   /**
    * Send a message through the WebSocket.
    */
@@ -9,6 +9,9 @@ export interface WSJoinMessage extends WSMessageBase {
   username: string;
 }
 
+// [cellRef, value, formula, version]
+export type WSCellTuple = [string, string | number | null, string | null, number];
+
 export interface WSCellUpdateMessage extends WSMessageBase {
   type: 'cell_update';
   cellRef: string;
@@ -16,6 +19,15 @@ export interface WSCellUpdateMessage extends WSMessageBase {
   formula?: string;
   version: number;
   userId: string;
+  // Formula cells the edit recalculated
+  recalculated: WSCellTuple[];
+}
+
+export interface WSCellsUpdateMessage extends WSMessageBase {
+  type: 'cells_update';
+  userId: string;
+  cells: WSCellTuple[];
+  recalculated: WSCellTuple[];
 }
 
 export interface WSCursorUpdateMessage extends WSMessageBase {
@@ -28,6 +40,14 @@ export interface WSCursorUpdateMessage extends WSMessageBase {
   };
 }
 
+export interface WSCursorBatchMessage extends WSMessageBase {
+  type: 'cursor_batch';
+  cursors: {
+    userId: string;
+    position: WSCursorUpdateMessage['position'];
+  }[];
+}
+
 export interface WSUserPresenceMessage extends WSMessageBase {
   type: 'user_presence';
   users: {